@@ -1,25 +1,62 @@
-import pandas as pd
-import numpy as np
-import re
 from pathlib import Path
 import os
-import tkinter as tk
-from tkinter import filedialog, messagebox, ttk
-from ftplib import FTP
-import tempfile
-import shutil
 import threading
 import struct
-import io
 from datetime import datetime
 import traceback
-import zlib
-import gzip
 
-print("🚀 Sistema SIA APAC Medicamentos - Carregando...")
 
-base_path = r"E:\Projetos\SIA\dados"
-os.makedirs(base_path, exist_ok=True)
+class _ImportacaoTardia:
+    """
+    Módulo importado no primeiro acesso a um atributo.
+
+    pandas/numpy só são carregados quando alguma função os usa, então
+    importar este módulo (ex.: para usar validar_cns) é rápido. No primeiro
+    acesso o nome global é trocado pelo módulo real.
+    """
+
+    def __init__(self, modulo, nome):
+        self._modulo = modulo
+        self._nome = nome
+
+    def __getattr__(self, atributo):
+        import importlib
+
+        modulo = importlib.import_module(self._modulo)
+        globals()[self._nome] = modulo
+        return getattr(modulo, atributo)
+
+
+pd = _ImportacaoTardia('pandas', 'pd')
+np = _ImportacaoTardia('numpy', 'np')
+
+# Diretório de dados: resolvido no primeiro uso por diretorio_dados()
+base_path = None
+
+
+def definir_diretorio_dados(caminho):
+    """Define o diretório de dados (DBC, caches e arquivos gerados)"""
+    global base_path
+    base_path = str(caminho)
+
+
+def diretorio_dados():
+    """
+    Diretório de dados, criado no primeiro uso.
+    Ordem: definir_diretorio_dados() > variável de ambiente SIA_DADOS >
+    E:\\Projetos\\SIA\\dados no Windows, ./dados ao lado do script nos demais sistemas.
+    """
+    global base_path
+    if base_path is None:
+        if os.environ.get('SIA_DADOS'):
+            base_path = os.environ['SIA_DADOS']
+        elif os.name == 'nt':
+            base_path = r"E:\Projetos\SIA\dados"
+        else:
+            base_path = str(Path(__file__).resolve().parent / 'dados')
+    os.makedirs(base_path, exist_ok=True)
+    return Path(base_path)
+
 
 ESTADOS = {
     'AC': 'Acre', 'AL': 'Alagoas', 'AP': 'Amapá', 'AM': 'Amazonas',
@@ -31,34 +68,454 @@ ESTADOS = {
     'SP': 'São Paulo', 'SE': 'Sergipe', 'TO': 'Tocantins'
 }
 
+# Tabelas do PKWare Data Compression Library (implode), mesmas do blast.c de
+# Mark Adler usado pelo pyreaddbc. Cada byte: (repetições - 1) << 4 | bits.
+_BLAST_LITLEN = bytes([
+    11, 124, 8, 7, 28, 7, 188, 13, 76, 4, 10, 8, 12, 10, 12, 10, 8, 23, 8,
+    9, 7, 6, 7, 8, 7, 6, 55, 8, 23, 24, 12, 11, 7, 9, 11, 12, 6, 7, 22, 5,
+    7, 24, 6, 11, 9, 6, 7, 22, 7, 11, 38, 7, 9, 8, 25, 11, 8, 11, 9, 12,
+    8, 12, 5, 38, 5, 38, 5, 11, 7, 5, 6, 21, 6, 10, 53, 8, 7, 24, 10, 27,
+    44, 253, 253, 253, 252, 252, 252, 13, 12, 45, 12, 45, 12, 61, 12, 45,
+    44, 173])
+_BLAST_LENLEN = bytes([2, 35, 36, 53, 38, 23])
+_BLAST_DISTLEN = bytes([2, 20, 53, 230, 247, 151, 248])
+_BLAST_LEN_BASE = (3, 2, 4, 5, 6, 7, 8, 9, 10, 12, 16, 24, 40, 72, 136, 264)
+_BLAST_LEN_EXTRA = (0, 0, 0, 0, 0, 0, 0, 0, 1, 2, 3, 4, 5, 6, 7, 8)
+_BLAST_TABELAS = None
+
+
+def _blast_construir_tabela(rep):
+    """
+    Monta tabela de consulta direta para um código Huffman do implode.
+    Índice: próximos `maxbits` bits do fluxo (LSB primeiro).
+    Valor: (símbolo << 4) | tamanho do código em bits.
+    """
+    comprimentos = []
+    for byte in rep:
+        comprimentos.extend([byte & 15] * ((byte >> 4) + 1))
+
+    maxbits = max(comprimentos)
+    contagem = [0] * (maxbits + 1)
+    for tamanho in comprimentos:
+        contagem[tamanho] += 1
+    contagem[0] = 0
+
+    # Símbolos ordenados por tamanho de código e depois por valor (canônico)
+    simbolos = sorted((s for s, t in enumerate(comprimentos) if t),
+                      key=lambda s: (comprimentos[s], s))
+
+    tabela = [0] * (1 << maxbits)
+    for valor in range(1 << maxbits):
+        code = first = index = 0
+        for tamanho in range(1, maxbits + 1):
+            # Códigos vêm invertidos no fluxo (ver decode() do blast.c)
+            code |= ((valor >> (tamanho - 1)) & 1) ^ 1
+            count = contagem[tamanho]
+            if code < first + count:
+                tabela[valor] = (simbolos[index + code - first] << 4) | tamanho
+                break
+            index += count
+            first = (first + count) << 1
+            code <<= 1
+
+    return tabela, maxbits
+
+
+def _blast_tabelas():
+    """Constrói (uma vez) as tabelas de literais, comprimentos e distâncias"""
+    global _BLAST_TABELAS
+    if _BLAST_TABELAS is None:
+        _BLAST_TABELAS = (
+            _blast_construir_tabela(_BLAST_LITLEN),
+            _blast_construir_tabela(_BLAST_LENLEN),
+            _blast_construir_tabela(_BLAST_DISTLEN),
+        )
+    return _BLAST_TABELAS
+
+
+def _iter_pkware_explode(arquivo, tamanho_bloco=1 << 20):
+    """
+    Descomprime incrementalmente um fluxo PKWare DCL "imploded" lido de `arquivo`.
+    Implementação em Python puro equivalente ao blast() do zlib/contrib.
+
+    Mantém em memória apenas um bloco de entrada e a janela de 4 KB do
+    dicionário além do bloco de saída corrente.
+
+    Args:
+        arquivo: objeto binário com read(), posicionado no início do fluxo
+        tamanho_bloco (int): tamanho aproximado de cada bloco gerado
+
+    Yields:
+        bytes: blocos consecutivos dos dados descomprimidos
+    """
+    (lit_tab, lit_bits), (len_tab, len_bits), (dist_tab, dist_bits) = _blast_tabelas()
+    lit_mask = (1 << lit_bits) - 1
+    len_mask = (1 << len_bits) - 1
+    dist_mask = (1 << dist_bits) - 1
+    janela = 4096
+
+    cabecalho = arquivo.read(2)
+    if len(cabecalho) < 2:
+        raise ValueError("Fluxo implode truncado")
+
+    literais_codificados = cabecalho[0]
+    dict_bits = cabecalho[1]
+    if literais_codificados > 1:
+        raise ValueError(f"Cabeçalho implode inválido (literal={literais_codificados})")
+    if dict_bits < 4 or dict_bits > 6:
+        raise ValueError(f"Cabeçalho implode inválido (dicionário={dict_bits})")
+
+    src = b''
+    pos = 0
+    limite = -1
+    fim_entrada = False
+    tamanho_entrada = 0
+    bitbuf = 0
+    bitcnt = 0
+    out = bytearray()
+
+    while True:
+        # Garante ao menos 16 bytes de entrada à frente (um símbolo usa até 4)
+        while pos > limite and not fim_entrada:
+            novo = arquivo.read(tamanho_bloco)
+            src = src[pos:] + novo
+            pos = 0
+            if not novo:
+                # Bytes extras permitem "espiar" bits à frente sem checar o fim
+                fim_entrada = True
+                tamanho_entrada = len(src)
+                src += b'\x00' * 16
+            limite = len(src) - 16
+
+        if len(out) >= tamanho_bloco + janela:
+            yield bytes(out[:-janela])
+            del out[:-janela]
+
+        while bitcnt < 32:
+            bitbuf |= src[pos] << bitcnt
+            pos += 1
+            bitcnt += 8
+
+        if fim_entrada and pos - (bitcnt >> 3) > tamanho_entrada:
+            raise ValueError("Fluxo implode truncado")
+
+        flag = bitbuf & 1
+        bitbuf >>= 1
+        bitcnt -= 1
+
+        if flag:
+            # Par comprimento/distância
+            entrada = len_tab[bitbuf & len_mask]
+            n = entrada & 15
+            bitbuf >>= n
+            bitcnt -= n
+            simbolo = entrada >> 4
+            extra = _BLAST_LEN_EXTRA[simbolo]
+            comprimento = _BLAST_LEN_BASE[simbolo] + (bitbuf & ((1 << extra) - 1))
+            bitbuf >>= extra
+            bitcnt -= extra
+
+            if comprimento == 519:  # código de fim
+                break
+
+            if bitcnt < 16:
+                while bitcnt < 32:
+                    bitbuf |= src[pos] << bitcnt
+                    pos += 1
+                    bitcnt += 8
+
+            entrada = dist_tab[bitbuf & dist_mask]
+            n = entrada & 15
+            bitbuf >>= n
+            bitcnt -= n
+            extra = 2 if comprimento == 2 else dict_bits
+            distancia = ((entrada >> 4) << extra) + (bitbuf & ((1 << extra) - 1)) + 1
+            bitbuf >>= extra
+            bitcnt -= extra
+
+            inicio = len(out) - distancia
+            if inicio < 0:
+                raise ValueError("Distância implode antes do início dos dados")
+
+            if distancia >= comprimento:
+                out += out[inicio:inicio + comprimento]
+            else:
+                # Cópia sobreposta: repete o padrão dos últimos `distancia` bytes
+                padrao = out[inicio:]
+                repeticoes, resto = divmod(comprimento, distancia)
+                out += padrao * repeticoes + padrao[:resto]
+        elif literais_codificados:
+            entrada = lit_tab[bitbuf & lit_mask]
+            n = entrada & 15
+            bitbuf >>= n
+            bitcnt -= n
+            out.append(entrada >> 4)
+        else:
+            out.append(bitbuf & 0xFF)
+            bitbuf >>= 8
+            bitcnt -= 8
+
+    if out:
+        yield bytes(out)
+
+
+_DBF_TABELAS = {}
+
+
+def _dbf_tabelas_decodificacao(encoding):
+    """
+    Tabelas de 256 entradas para decodificar campos DBF byte a byte.
+    Retorna None para encodings que não são de 1 byte por caractere.
+    """
+    if encoding not in _DBF_TABELAS:
+        texto = bytes(range(256)).decode(encoding, errors='replace')
+        if len(texto) != 256:
+            _DBF_TABELAS[encoding] = None
+        else:
+            _DBF_TABELAS[encoding] = (
+                np.array([ord(c) for c in texto], dtype=np.uint32),
+                np.array([c.isspace() for c in texto], dtype=bool),
+                np.array([c == '\x00' for c in texto], dtype=bool),
+                np.array([not (c.isprintable() or c in '\n\t') for c in texto], dtype=bool),
+            )
+    return _DBF_TABELAS[encoding]
+
+
+def _fatorar_linhas(brutos):
+    """
+    Fatoriza as linhas de uma matriz uint8 (registros x largura).
+
+    Returns:
+        tuple: (código de cada linha, índice da primeira ocorrência de cada código)
+    """
+    linhas, largura = brutos.shape
+    largura_8 = -(-largura // 8) * 8
+    if largura_8 != largura:
+        alinhado = np.zeros((linhas, largura_8), dtype=np.uint8)
+        alinhado[:, :largura] = brutos
+    else:
+        alinhado = np.ascontiguousarray(brutos)
+
+    # Combina blocos de 8 bytes: código = código anterior * distintos + bloco
+    codigos = None
+    for bloco in alinhado.view(np.uint64).T:
+        codigos_bloco, distintos = pd.factorize(bloco)
+        if codigos is None:
+            codigos = codigos_bloco
+        else:
+            codigos, _ = pd.factorize(codigos * len(distintos) + codigos_bloco)
+
+    # pd.factorize numera na ordem de primeira ocorrência
+    primeiros = np.flatnonzero(np.diff(np.maximum.accumulate(codigos), prepend=-1) > 0)
+    return codigos, primeiros
+
+
+def converter_cns_para_numeros(valor):
+    """
+    Converte caracteres Latin-1 especiais para dígitos.
+    DBC usa codificação especial: 0x7B-0x84 representam dígitos 0-9
+    Baseado na tabela: 0x7B=0, 0x7C=1, 0x7D=2, ..., 0x84=9
+
+    Versão escalar (referência); para colunas use converter_coluna_cns.
+    """
+    if pd.isna(valor) or valor == '':
+        return ''
+
+    mapa = {chr(0x7B + i): str(i) for i in range(10)}
+
+    resultado = ''
+    for char in str(valor):
+        if char in mapa:
+            resultado += mapa[char]
+        elif char.isdigit():
+            resultado += char
+
+    return resultado
+
+
+def converter_coluna_cns(valores):
+    """
+    Versão vetorizada de converter_cns_para_numeros para uma coluna inteira.
+    Usada tanto na conversão nativa quanto nos scripts do Docker (o código
+    desta função é embutido neles), por isso só depende de numpy e pandas.
+
+    Uma tabela de 256 posições troca 0x7B-0x84 por '0'-'9', mantém dígitos
+    e marca os demais caracteres para remoção; a compactação de cada linha é
+    feita com um argsort estável sobre a matriz de code points.
+
+    Args:
+        valores (pd.Series): coluna AP_CNSPCN já decodificada
+
+    Returns:
+        pd.Series: somente dígitos, '' para valores nulos ou vazios
+    """
+    import numpy as np
+    import pandas as pd
+
+    valores = pd.Series(valores)
+    texto = valores.to_numpy(dtype=object, na_value='').astype(str)
+
+    largura = texto.dtype.itemsize // 4
+    if len(texto) == 0 or largura == 0:
+        return pd.Series([''] * len(texto), index=valores.index)
+
+    tabela = np.array([c if chr(c).isdigit() else 0 for c in range(256)], dtype=np.uint32)
+    tabela[0x7B:0x85] = np.arange(ord('0'), ord('9') + 1, dtype=np.uint32)
+
+    cps = texto.view(np.uint32).reshape(len(texto), largura)
+    fora_tabela = cps > 0xFF
+    convertidos = tabela[np.minimum(cps, 0xFF)]
+
+    # Manter os caracteres válidos na ordem original, zeros (removidos) ao final.
+    # Só as linhas com caractere removido no meio precisam ser compactadas.
+    removidos = convertidos == 0
+    compactar = (removidos[:, :-1] & ~removidos[:, 1:]).any(axis=1)
+    if compactar.any():
+        ordem = np.argsort(removidos[compactar], axis=1, kind='stable')
+        convertidos[compactar] = np.take_along_axis(convertidos[compactar], ordem, axis=1)
+    resultado = np.ascontiguousarray(convertidos).view(f'<U{largura}').ravel().astype(object)
+
+    # Caracteres fora do Latin-1 (raros): aplicar a regra caractere a caractere
+    for i in np.flatnonzero(fora_tabela.any(axis=1)):
+        resultado[i] = ''.join(
+            str(ord(c) - 0x7B) if 0x7B <= ord(c) <= 0x84 else c
+            for c in texto[i] if 0x7B <= ord(c) <= 0x84 or c.isdigit()
+        )
+
+    return pd.Series(resultado, index=valores.index)
+
+
 class DBCConverter:
-    """Conversor de arquivos .dbc usando Docker PySUS"""
+    """Conversor de arquivos .dbc (nativo em Python, com Docker PySUS como alternativa)"""
+
+    # Cache de _versao_conversor()
+    _versao = None
 
     @staticmethod
-    def read_dbc(dbc_file, encoding='latin-1'):
+    def read_dbc(dbc_file, encoding='latin-1', engine='native', worker=None, cache=True, sha256=None,
+                 parcial=None, cache_limite_mb=4096):
         """
-        Lê arquivo .dbc e retorna DataFrame usando Docker com PySUS
-        DBC do DATASUS precisa de ambiente Linux com PySUS
+        Lê arquivo .dbc e retorna DataFrame.
+
+        engine='native' descomprime o DBC no próprio processo (sem Docker) e,
+        se falhar, recorre ao Docker com PySUS. engine='docker' usa apenas
+        o Docker. Com `worker` (DBCDockerWorker) o Docker reaproveita um
+        container já iniciado em vez de criar um por arquivo.
+
+        Com cache=True o resultado fica em dados/cache_conversao, indexado pelo
+        SHA-256 do DBC (`sha256`, se já conhecido), encoding, engine e versão do
+        conversor; abrir o mesmo DBC de novo lê o Parquet sem converter. Acima
+        de `cache_limite_mb` as conversões menos usadas são removidas (CacheConversao).
+
+        Com `parcial`, parcial(df, total) recebe os registros já lidos enquanto
+        a leitura continua (conversão nativa e cache; ver _ler_parquet_progressivo).
         """
         try:
             print(f"🔧 Convertendo {Path(dbc_file).name}...")
 
-            # Usar Docker com PySUS
-            return DBCConverter._read_dbc_with_docker(dbc_file, encoding)
+            cache_path = None
+            if cache:
+                cache_path = DBCConverter._caminho_cache_conversao(dbc_file, encoding, engine, sha256)
+                if cache_path is not None and cache_path.exists():
+                    try:
+                        if parcial is not None:
+                            df = _ler_parquet_progressivo(cache_path, parcial)
+                        else:
+                            df = pd.read_parquet(cache_path)
+                        print(f"   ♻️  Conversão em cache: {len(df):,} registros, {len(df.columns)} colunas")
+                        CacheConversao.registrar_acesso(cache_path)
+                        return df
+                    except Exception as e:
+                        print(f"   ⚠️  Cache de conversão ilegível ({e}), convertendo de novo")
+                        cache_path.unlink(missing_ok=True)
+
+            df = DBCConverter._converter_dbc(dbc_file, encoding, engine, worker, parcial)
+
+            if cache_path is not None and df is not None and len(df) > 0:
+                tmp = cache_path.with_name(cache_path.name + '.tmp')
+                try:
+                    cache_path.parent.mkdir(parents=True, exist_ok=True)
+                    df.to_parquet(tmp, index=False)
+                    os.replace(tmp, cache_path)
+                    CacheConversao.registrar_acesso(cache_path)
+                    CacheConversao(limite_mb=cache_limite_mb).podar(manter=cache_path)
+                except Exception as e:
+                    print(f"   ⚠️  Não foi possível salvar o cache de conversão: {e}")
+                    tmp.unlink(missing_ok=True)
+
+            return df
 
         except Exception as e:
             print(f"❌ Erro na conversão DBC: {e}")
             traceback.print_exc()
             return pd.DataFrame()
 
+    @staticmethod
+    def _converter_dbc(dbc_file, encoding, engine, worker, parcial=None):
+        """Conversão propriamente dita (nativa, com Docker como alternativa)"""
+        if engine == 'native':
+            df = DBCConverter._parse_dbf_from_file(dbc_file, encoding, parcial)
+            if df is not None and len(df) > 0:
+                return df
+            print("   ⚠️  Conversão nativa falhou, tentando Docker...")
+
+        # Usar Docker com PySUS
+        if worker is not None:
+            return worker.converter(dbc_file, encoding)
+        return DBCConverter._read_dbc_with_docker(dbc_file, encoding)
+
+    @staticmethod
+    def _versao_conversor():
+        """
+        Hash do código que produz o DataFrame (descompressão e suas tabelas,
+        parse do DBF, remapeamento de AP_CNSPCN e scripts Docker). Qualquer alteração nesse
+        código gera uma versão nova e invalida o cache de conversão.
+        None se o código-fonte não estiver disponível.
+        """
+        import hashlib
+        import inspect
+
+        if DBCConverter._versao is None:
+            try:
+                partes = [inspect.getsource(f) for f in (
+                    _blast_construir_tabela, _blast_tabelas, _iter_pkware_explode,
+                    _dbf_tabelas_decodificacao, _fatorar_linhas, converter_coluna_cns,
+                    DBCConverter._parse_dbf_from_file, DBCConverter.iter_batches,
+                    DBCConverter._read_dbf_fields, DBCConverter._montar_dataframe, DBCConverter._tipar_coluna,
+                    DBCConverter._decode_dbf_value, DBCConverter._decode_dbf_column,
+                    DBCConverter._decode_dbf_rows, DBCConverter._decode_dbf_records,
+                    DBCConverter._read_dbc_with_docker)]
+            except (OSError, TypeError):
+                return None
+            # Tabelas de Huffman do implode e scripts do Docker
+            partes += [repr((_BLAST_LITLEN, _BLAST_LENLEN, _BLAST_DISTLEN, _BLAST_LEN_BASE, _BLAST_LEN_EXTRA)),
+                       _DOCKER_WORKER_SCRIPT]
+            DBCConverter._versao = hashlib.sha256('\n'.join(partes).encode('utf-8')).hexdigest()[:16]
+        return DBCConverter._versao
+
+    @staticmethod
+    def _caminho_cache_conversao(dbc_file, encoding, engine, sha256=None):
+        """Arquivo do cache de conversão para este DBC (None se o cache não puder ser usado)"""
+        import hashlib
+
+        versao = DBCConverter._versao_conversor()
+        if versao is None:
+            return None
+
+        if sha256 is None:
+            sha256 = DBCCache._sha256(dbc_file)
+        chave = hashlib.sha256(f"{sha256}|{encoding}|{engine}|{versao}".encode('utf-8')).hexdigest()
+        return CacheConversao().diretorio / f"{chave}.parquet"
+
     @staticmethod
     def _read_dbc_with_docker(dbc_file, encoding='latin-1'):
         """Usa Docker com PySUS para converter DBC"""
         try:
+            import inspect
             import subprocess
 
             dbc_path = Path(dbc_file).absolute()
-            dados_dir = Path(base_path).absolute()
+            dados_dir = diretorio_dados().absolute()
 
             # Garantir que o diretório dados existe
             dados_dir.mkdir(parents=True, exist_ok=True)
@@ -67,45 +524,16 @@ class DBCConverter:
             output_name = dbc_path.stem + "_converted.parquet"
             output_path = dados_dir / output_name
 
+            # Conversor de AP_CNSPCN compartilhado com a conversão nativa
+            fonte_conversor_cns = inspect.getsource(converter_coluna_cns)
+
             # Script Python para rodar no Docker
             script = f'''
 import pyreaddbc
 import pandas as pd
 import sys
 
-def converter_cns_para_numeros(valor):
-    """
-    Converte caracteres Latin-1 especiais para dígitos.
-    DBC usa codificação especial: 0x7B-0x84 representam dígitos 0-9
-    Baseado na tabela: 0x7B=0, 0x7C=1, 0x7D=2, ..., 0x84=9
-    """
-    if pd.isna(valor) or valor == '':
-        return ''
-
-    # Mapeamento de bytes Latin-1 para dígitos (comum em arquivos DBC)
-    # Baseado na análise: {{{{ aparece muito, sugerindo que {{ = 0
-    mapa = {{
-        chr(0x7B): '0',  # {{
-        chr(0x7C): '1',  # |
-        chr(0x7D): '2',  # }}
-        chr(0x7E): '3',  # ~
-        chr(0x7F): '4',  # DEL
-        chr(0x80): '5',  # €
-        chr(0x81): '6',  #
-        chr(0x82): '7',  # ‚
-        chr(0x83): '8',  # ƒ
-        chr(0x84): '9',  # „
-    }}
-
-    resultado = ''
-    for char in str(valor):
-        if char in mapa:
-            resultado += mapa[char]
-        elif char.isdigit():
-            resultado += char
-
-    return resultado
-
+{fonte_conversor_cns}
 try:
     print("📖 Lendo DBC com encoding {encoding}...")
     df = pyreaddbc.read_dbc("/data/{dbc_path.name}", encoding="{encoding}")
@@ -116,7 +544,7 @@ try:
         # CONVERTER AP_CNSPCN para números legíveis
         if 'AP_CNSPCN' in df.columns:
             print("🔧 Convertendo AP_CNSPCN de Latin-1 especial para números...")
-            df['AP_CNSPCN'] = df['AP_CNSPCN'].apply(converter_cns_para_numeros)
+            df['AP_CNSPCN'] = converter_coluna_cns(df['AP_CNSPCN'])
             print(f"✅ Amostra AP_CNSPCN convertido: {{df['AP_CNSPCN'].head(5).tolist()}}")
 
         # Salvar como parquet
@@ -194,201 +622,405 @@ except Exception as e:
             return pd.DataFrame()
 
     @staticmethod
-    def _parse_dbf_from_file(dbc_file, encoding):
-        """Método alternativo caso pyreaddbc não funcione"""
-        try:
-            with open(dbc_file, 'rb') as f:
-                compressed_data = f.read()
+    def iter_batches(dbc_file, batch_rows=200000, encoding='latin-1'):
+        """
+        Lê um .dbc (ou .dbf) em lotes de até `batch_rows` registros.
 
-            if len(compressed_data) < 32:
+        A descompressão e o parse são incrementais: a memória usada fica
+        limitada a um lote, qualquer que seja o tamanho do arquivo. O
+        AP_CNSPCN já vem convertido para dígitos (mesma regra do Docker) e os
+        campos N/F/D/L já vêm tipados pelo cabeçalho (_tipar_coluna): todos
+        os lotes têm os mesmos dtypes, mesmo com um campo todo vazio num deles.
+
+        Yields:
+            pd.DataFrame: lotes consecutivos, com índice contínuo entre lotes
+        """
+        with open(dbc_file, 'rb') as f:
+            inicio = f.read(32)
+            if len(inicio) < 32:
                 raise ValueError("Arquivo muito pequeno")
 
-            # Tentar descomprimir com zlib
-            print("   🗜️  Tentando descompressão manual...")
-            dbf_data = None
+            dbf_type = inicio[0]
+            if dbf_type not in [0x03, 0x83, 0x8B, 0xF5]:  # Tipos válidos DBF
+                raise ValueError(f"Tipo DBF não reconhecido: 0x{dbf_type:02X}")
 
-            for offset in [0, 4, 8, 16, 32]:
-                try:
-                    dbf_data = zlib.decompress(compressed_data[offset:], -zlib.MAX_WBITS)
-                    print(f"   ✅ Descomprimido com offset {offset}")
+            record_count = struct.unpack('<I', inicio[4:8])[0]
+            header_length = struct.unpack('<H', inicio[8:10])[0]
+            record_length = struct.unpack('<H', inicio[10:12])[0]
+            if header_length < 32 or record_length == 0:
+                raise ValueError(f"Cabeçalho DBF inválido ({header_length}/{record_length})")
+
+            header = bytearray(inicio + f.read(header_length - 32))
+            if len(header) < header_length:
+                raise ValueError("Cabeçalho DBF truncado")
+
+            if Path(dbc_file).suffix.lower() == '.dbc':
+                # Cabeçalho DBF sem compressão, CRC32 e registros em PKWare implode
+                header[-1] = 0x0D  # terminador do cabeçalho DBF
+                f.read(4)
+                blocos = _iter_pkware_explode(f)
+            else:
+                blocos = iter(lambda: f.read(1 << 20), b'')
+
+            num_fields = (header_length - 32 - 1) // 32
+            fields, _ = DBCConverter._read_dbf_fields(bytes(header), num_fields, encoding,
+                                                      detect_encoding=False)
+            if not fields:
+                raise ValueError("Nenhum campo encontrado")
+
+            print(f"   📊 DBF: {record_count:,} registros, {record_length} bytes/registro, "
+                  f"{len(fields)} campos")
+
+            avisados = set()
+            tamanho_lote = batch_rows * record_length
+            restantes = record_count
+            proximo_indice = 0
+            buffer = bytearray()
+
+            def montar_lote(dados, registros):
+                colunas = DBCConverter._decode_dbf_records(
+                    dados, fields, 0, record_length, registros, encoding
+                )
+                if colunas is None:
+                    return None
+
+                indice = pd.RangeIndex(proximo_indice, proximo_indice + len(colunas[0]))
+                df = DBCConverter._montar_dataframe(fields, colunas, indice, avisados)
+
+                # Mesma correção aplicada no script do Docker
+                if 'AP_CNSPCN' in df.columns:
+                    df['AP_CNSPCN'] = converter_coluna_cns(df['AP_CNSPCN'])
+                return df
+
+            for bloco in blocos:
+                buffer += bloco
+                while restantes > 0 and len(buffer) >= tamanho_lote:
+                    df = montar_lote(bytes(buffer[:tamanho_lote]), min(batch_rows, restantes))
+                    del buffer[:tamanho_lote]
+                    restantes -= batch_rows
+                    if df is not None:
+                        proximo_indice += len(df)
+                        yield df
+                if restantes <= 0:
                     break
-                except:
-                    continue
 
-            if dbf_data:
-                return DBCConverter._parse_dbf(dbf_data, encoding)
+            # Último lote (parcial)
+            if restantes > 0 and len(buffer) >= record_length:
+                df = montar_lote(bytes(buffer), restantes)
+                if df is not None:
+                    yield df
+
+    @staticmethod
+    def _parse_dbf_from_file(dbc_file, encoding, parcial=None):
+        """
+        Conversão nativa: descomprime e faz o parse do DBC em lotes.
+
+        Com `parcial`, os lotes têm LINHAS_PREVIA registros e parcial(df, total)
+        recebe o que já foi convertido: o primeiro lote logo que sai e depois a
+        cada 4× registros, até a metade do arquivo (total = registros no
+        cabeçalho, inclui os apagados).
+        """
+        try:
+            print("   🗜️  Descomprimindo DBC (PKWare implode)...")
+            if parcial is None:
+                lotes = list(DBCConverter.iter_batches(dbc_file, encoding=encoding))
             else:
-                print("   ❌ Falha na descompressão")
+                with open(dbc_file, 'rb') as f:
+                    total = struct.unpack('<I', f.read(8)[4:8])[0]
+                lotes = []
+                lidos = entregues = 0
+                for lote in DBCConverter.iter_batches(dbc_file, batch_rows=LINHAS_PREVIA, encoding=encoding):
+                    lotes.append(lote)
+                    lidos += len(lote)
+                    if lidos >= 4 * entregues and lidos <= total // 2:
+                        parcial(pd.concat(lotes) if len(lotes) > 1 else lote, total)
+                        entregues = lidos
+
+            if not lotes:
+                print("   ⚠️  Nenhum registro válido encontrado")
                 return pd.DataFrame()
 
+            df = pd.concat(lotes) if len(lotes) > 1 else lotes[0]
+            print(f"   ✅ Conversão: {len(df):,} registros, {len(df.columns)} colunas")
+            return df
+
         except Exception as e:
             print(f"   ❌ Erro: {e}")
             return pd.DataFrame()
 
     @staticmethod
-    def _parse_dbf(dbf_data, encoding='cp850'):
-        """Parse arquivo DBF (descomprimido)"""
-        try:
-            if len(dbf_data) < 32:
-                return pd.DataFrame()
-            
-            # Ler cabeçalho DBF
-            header = dbf_data[:32]
-            
-            # Verificar assinatura DBF
-            dbf_type = header[0]
-            if dbf_type not in [0x03, 0x83, 0x8B, 0xF5]:  # Tipos válidos DBF
-                print(f"   ⚠️  Tipo DBF não reconhecido: 0x{dbf_type:02X}")
-                return DBCConverter._parse_as_text(dbf_data, encoding)
-            
-            # Extrair informações do cabeçalho
-            record_count = struct.unpack('<I', header[4:8])[0]
-            header_length = struct.unpack('<H', header[8:10])[0]
-            record_length = struct.unpack('<H', header[10:12])[0]
-            
-            print(f"   📊 DBF: {record_count:,} registros, {record_length} bytes/registro")
-            
-            # Calcular número de campos
-            field_desc_length = header_length - 32 - 1  # -1 para o terminador 0x0D
-            num_fields = field_desc_length // 32
-            
-            print(f"   📋 Campos detectados: {num_fields}")
-            
-            # TENTAR MÚLTIPLOS ENCODINGS
-            encodings_to_try = ['cp850', 'cp437', 'latin-1', 'iso-8859-1', 'windows-1252']
-            best_encoding = encoding
-            
-            # Ler descrição dos campos
-            fields = []
-            pos = 32
+    def _read_dbf_fields(dbf_data, num_fields, encoding, detect_encoding=True):
+        """
+        Lê os descritores de campo do cabeçalho DBF.
+
+        Returns:
+            tuple: (lista de campos {'name', 'type', 'length', 'decimal'}, encoding escolhido)
+        """
+        # TENTAR MÚLTIPLOS ENCODINGS
+        encodings_to_try = ['cp850', 'cp437', 'latin-1', 'iso-8859-1', 'windows-1252']
+        best_encoding = encoding
+        
+        # Ler descrição dos campos
+        fields = []
+        pos = 32
+        
+        for i in range(num_fields):
+            field_desc = dbf_data[pos:pos+32]
             
-            for i in range(num_fields):
-                field_desc = dbf_data[pos:pos+32]
-                
-                # Nome do campo (primeiros 11 bytes, zero-terminated)
-                # Tentar diferentes encodings para nome do campo
-                field_name = None
-                for enc in encodings_to_try:
-                    try:
-                        name = field_desc[:11].split(b'\x00')[0].decode(enc, errors='strict').strip()
-                        if name and name.isprintable():
-                            field_name = name
+            # Nome do campo (primeiros 11 bytes, zero-terminated)
+            # Tentar diferentes encodings para nome do campo
+            field_name = None
+            for enc in encodings_to_try:
+                try:
+                    name = field_desc[:11].split(b'\x00')[0].decode(enc, errors='strict').strip()
+                    if name and name.isprintable():
+                        field_name = name
+                        if detect_encoding:
                             best_encoding = enc
-                            break
-                    except:
-                        continue
-                
-                if not field_name:
-                    # Fallback: usar cp850 com ignorar erros
-                    field_name = field_desc[:11].split(b'\x00')[0].decode('cp850', errors='ignore').strip()
-                
-                # Tipo do campo
-                field_type = chr(field_desc[11])
-                
-                # Tamanho do campo
-                field_length = field_desc[16]
-                
-                if field_name:  # Ignorar campos vazios
-                    fields.append({
-                        'name': field_name if field_name else f'FIELD_{i}',
-                        'type': field_type,
-                        'length': field_length
-                    })
-                
-                pos += 32
+                        break
+                except:
+                    continue
             
-            if not fields:
-                print("   ⚠️  Nenhum campo encontrado")
-                return DBCConverter._parse_as_text(dbf_data, encoding)
+            if not field_name:
+                # Fallback: usar cp850 com ignorar erros
+                field_name = field_desc[:11].split(b'\x00')[0].decode('cp850', errors='ignore').strip()
             
-            print(f"   ✅ Campos válidos: {len(fields)}")
-            print(f"   🔤 Encoding detectado: {best_encoding}")
+            # Tipo do campo
+            field_type = chr(field_desc[11])
             
-            for i, field in enumerate(fields[:10]):  # Mostrar primeiros 10
-                print(f"      {i+1}. {field['name']} ({field['type']}, {field['length']})")
+            # Tamanho do campo e casas decimais (campos N)
+            field_length = field_desc[16]
+            field_decimal = field_desc[17]
             
-            # Ler registros COM O MELHOR ENCODING
-            data_start = header_length
-            records = []
+            if field_name:  # Ignorar campos vazios
+                fields.append({
+                    'name': field_name if field_name else f'FIELD_{i}',
+                    'type': field_type,
+                    'length': field_length,
+                    'decimal': field_decimal
+                })
             
-            for rec_num in range(record_count):
-                rec_start = data_start + (rec_num * record_length)
-                rec_end = rec_start + record_length
-                
-                if rec_end > len(dbf_data):
-                    break
-                
-                record_data = dbf_data[rec_start:rec_end]
-                
-                # Primeiro byte: flag de deletado
-                if record_data[0] == 0x2A:  # Deletado
-                    continue
-                
-                # Extrair valores dos campos
-                row = []
-                field_pos = 1  # Pular flag
-                
-                for field in fields:
-                    field_value = record_data[field_pos:field_pos + field['length']]
+            pos += 32
 
-                    try:
-                        # Decodificar com encoding detectado
-                        # Para arquivos DATASUS, latin-1 é o padrão
-                        value_str = field_value.decode(best_encoding, errors='replace').strip()
-
-                        # Se o campo contém apenas dígitos e espaços (campo numérico)
-                        # preservar todos os dígitos sem limpeza adicional
-                        if field['type'] in ['N', 'C']:  # Numeric ou Character
-                            # Preservar dígitos e espaços, remover apenas null bytes
-                            value_str = value_str.replace('\x00', '').strip()
-                        else:
-                            # Limpar caracteres de controle para outros tipos
-                            value_str = ''.join(char for char in value_str if char.isprintable() or char in ['\n', '\t'])
+        return fields, best_encoding
 
-                        row.append(value_str)
-                    except:
-                        row.append('')
+    @staticmethod
+    def _decode_dbf_value(field_value, field_type, encoding):
+        """Decodifica um valor de campo DBF (referência escalar do decodificador vetorizado)"""
+        try:
+            # Para arquivos DATASUS, latin-1 é o padrão
+            value_str = field_value.decode(encoding, errors='replace').strip()
 
-                    field_pos += field['length']
-                
-                if any(row):  # Pelo menos um campo não vazio
-                    records.append(row)
-            
-            if not records:
-                print("   ⚠️  Nenhum registro válido encontrado")
-                return pd.DataFrame()
-            
-            # Criar DataFrame
-            column_names = [field['name'] for field in fields]
-            df = pd.DataFrame(records, columns=column_names)
-            
-            # Limpar dados
-            for col in df.columns:
-                # Remover caracteres nulos e espaços extras
-                df[col] = df[col].astype(str).str.replace('\x00', '').str.strip()
-                # Substituir strings vazias por None
-                df[col] = df[col].replace('', None)
-                df[col] = df[col].replace('nan', None)
-            
-            print(f"   ✅ Conversão: {len(df):,} registros, {len(df.columns)} colunas")
-            
-            # Mostrar amostra
-            print("\n   📋 Primeiras colunas:")
-            for col in df.columns[:5]:
-                non_null = df[col].notna().sum()
-                sample = df[col].dropna().head(3).tolist()
-                print(f"      • {col}: {non_null:,} valores | Ex: {sample}")
-            
-            return df
-            
-        except Exception as e:
-            print(f"   ❌ Erro no parse DBF: {e}")
-            traceback.print_exc()
-            return DBCConverter._parse_as_text(dbf_data, encoding)
+            if field_type in ['N', 'C']:  # Numeric ou Character
+                # Preservar dígitos e espaços, remover apenas null bytes
+                value_str = value_str.replace('\x00', '').strip()
+            else:
+                # Limpar caracteres de controle para outros tipos
+                value_str = ''.join(char for char in value_str if char.isprintable() or char in ['\n', '\t'])
+
+            return value_str.strip()
+        except:
+            return ''
 
     @staticmethod
-    def _split_fixed_width(text, widths=None):
-        """Divide texto em campos de largura fixa"""
+    def _decode_dbf_column(brutos, field_type, encoding):
+        """
+        Decodifica uma coluna DBF inteira (matriz uint8 registros x largura).
+        Cada valor distinto é decodificado uma única vez e o resultado é
+        espalhado de volta para os registros (as strings são compartilhadas).
+
+        Returns:
+            tuple: (array object de strings, máscara de vazios, máscara de 'nan')
+        """
+        linhas, largura = brutos.shape
+        if largura == 0 or linhas == 0:
+            return np.full(linhas, '', dtype=object), np.ones(linhas, dtype=bool), np.zeros(linhas, dtype=bool)
+
+        # Colunas quase sem repetição (valores, nomes) não compensam a fatoração
+        amostra = brutos[:10000]
+        if len(_fatorar_linhas(amostra)[1]) > len(amostra) // 2:
+            return DBCConverter._decode_dbf_rows(brutos, field_type, encoding)
+
+        codigos, primeiros = _fatorar_linhas(brutos)
+        valores, vazio, nan = DBCConverter._decode_dbf_rows(brutos[primeiros], field_type, encoding)
+        return valores.take(codigos), vazio.take(codigos), nan.take(codigos)
+
+    @staticmethod
+    def _decode_dbf_rows(brutos, field_type, encoding):
+        """
+        Decodifica linhas de bytes DBF de largura fixa.
+        Para encodings de 1 byte por caractere, traduz os bytes por tabela
+        para UCS-4 e monta strings numpy '<U' sem laço Python por registro.
+        """
+        linhas, largura = brutos.shape
+
+        tabelas = _dbf_tabelas_decodificacao(encoding)
+        if tabelas is not None:
+            codepoints, espaco, especial_nc, especial_outros = tabelas
+            especial = especial_nc if field_type in ['N', 'C'] else especial_outros
+        if tabelas is None or especial[brutos].any():
+            # Bytes nulos, caracteres de controle ou encoding multibyte
+            valores = np.array(
+                [DBCConverter._decode_dbf_value(v.tobytes(), field_type, encoding) for v in brutos],
+                dtype=object
+            )
+            return valores, valores == '', valores == 'nan'
+
+        # strip(): localizar primeiro e último caractere que não é espaço
+        conteudo = ~espaco[brutos]
+        tem_conteudo = conteudo.any(axis=1)
+        primeiro = conteudo.argmax(axis=1)
+        ultimo = largura - 1 - conteudo[:, ::-1].argmax(axis=1)
+
+        cps = codepoints[brutos]
+        if primeiro.any():
+            # Deslocar cada linha para remover espaços à esquerda
+            indices = np.arange(largura) + primeiro[:, None]
+            np.minimum(indices, largura - 1, out=indices)
+            cps = np.take_along_axis(cps, indices, axis=1)
+            ultimo = ultimo - primeiro
+
+        # Zeros à direita são descartados pelo dtype '<U' do numpy
+        cps[np.arange(largura)[None, :] > ultimo[:, None]] = 0
+        cps[~tem_conteudo] = 0
+
+        texto = np.ascontiguousarray(cps).view(f'<U{largura}').ravel()
+        return texto.astype(object), ~tem_conteudo, texto == 'nan'
+
+    @staticmethod
+    def _decode_dbf_records(dbf_data, fields, header_length, record_length,
+                            record_count, encoding):
+        """
+        Decodifica o bloco de registros DBF de largura fixa via np.frombuffer.
+        Descarta registros deletados (0x2A) e registros totalmente vazios.
+
+        Returns:
+            list: um array object por campo, ou None se não houver registros
+        """
+        if record_length <= 0 or header_length >= len(dbf_data):
+            return None
+
+        disponiveis = (len(dbf_data) - header_length) // record_length
+        total = min(record_count, disponiveis)
+        if total <= 0:
+            return None
+
+        registros = np.frombuffer(dbf_data, dtype=np.uint8, count=total * record_length,
+                                  offset=header_length).reshape(total, record_length)
+
+        # Primeiro byte: flag de deletado
+        ativos = registros[:, 0] != 0x2A
+        total_ativos = int(ativos.sum())
+        if total_ativos == total:
+            ativos = slice(None)  # evita copiar o bloco quando nada foi deletado
+
+        colunas = []
+        vazios = np.ones(total_ativos, dtype=bool)
+        field_pos = 1  # Pular flag
+
+        for field in fields:
+            inicio = min(field_pos, record_length)
+            fim = min(field_pos + field['length'], record_length)
+            field_pos += field['length']
+
+            valores, vazio, nan = DBCConverter._decode_dbf_column(
+                registros[ativos, inicio:fim], field['type'], encoding
+            )
+            vazios &= vazio
+            colunas.append((valores, vazio | nan))
+
+        # Pelo menos um campo não vazio
+        manter = ~vazios
+        if not manter.any():
+            return None
+
+        resultado = []
+        for valores, nulos in colunas:
+            if not manter.all():
+                valores, nulos = valores[manter], nulos[manter]
+            valores[nulos] = None
+            resultado.append(valores)
+
+        return resultado
+
+    @staticmethod
+    def _montar_dataframe(fields, colunas, indice, avisados):
+        """
+        DataFrame de colunas decodificadas por _decode_dbf_records, com os
+        tipos do cabeçalho (_tipar_coluna). Texto tem dtype fixo: um lote com
+        coluna toda nula não pode virar outro tipo. O aviso de valores
+        inválidos sai uma vez por campo (`avisados`).
+        """
+        tipo_texto = pd.Series(['']).dtype
+        series = {}
+        for i, (field, valores) in enumerate(zip(fields, colunas)):
+            tipada = DBCConverter._tipar_coluna(valores, field)
+            if tipada is None:
+                series[i] = pd.Series(valores, index=indice, dtype=tipo_texto)
+                continue
+            tipada, invalidos = tipada
+            if invalidos and field['name'] not in avisados:
+                avisados.add(field['name'])
+                print(f"   ⚠️  Campo {field['name']} ({field['type']}) com valores inválidos, convertidos para vazio")
+            series[i] = pd.Series(tipada, index=indice)
+        df = pd.DataFrame(series)
+        df.columns = [field['name'] for field in fields]
+        return df
+
+    @staticmethod
+    def _tipar_coluna(valores, field):
+        """
+        Converte uma coluna decodificada (texto, None nos vazios) para o tipo
+        do campo DBF. O tipo vem só do cabeçalho, nunca dos valores, para que
+        todos os lotes de iter_batches tenham o mesmo esquema:
+
+        - N e F: float64 (vazio vira NaN).
+        - D: datas Arrow date32 (vazio ou só zeros vira nulo).
+        - L: boolean ('T/t/Y/y' e 'F/f/N/n'; '?' ou vazio vira nulo).
+
+        Cada valor distinto é convertido uma vez; valores que não convertem
+        viram nulos. Retorna (array, há valores inválidos), ou None para
+        campos C e de outros tipos (a coluna fica como texto).
+        """
+        import pyarrow as pa
+
+        tipo = field['type']
+        if tipo not in ('N', 'F', 'D', 'L'):
+            return None
+
+        codigos, distintos = pd.factorize(pd.Series(valores, dtype=object))
+        distintos = pd.Series(distintos, dtype=object)
+        nulos = codigos < 0
+
+        if tipo in ('N', 'F'):
+            # dbfread: strip() e strip('*'); N aceita vírgula decimal
+            texto = distintos.str.strip('*')
+            if tipo == 'N':
+                texto = texto.str.replace(',', '.', regex=False)
+            texto = texto.where(texto != '', None)
+            numeros = pd.to_numeric(texto, errors='coerce')
+            invalidos = numeros.isna() & texto.notna()
+            convertidos = np.append(numeros.to_numpy(dtype='float64'), np.nan)
+        elif tipo == 'D':
+            datas = pd.to_datetime(distintos, format='%Y%m%d', errors='coerce')
+            invalidos = datas.isna() & (distintos.str.strip('0') != '')
+            convertidos = np.append(datas.to_numpy(dtype='datetime64[D]'), np.datetime64('NaT'))
+        else:
+            mapa = {c: True for c in 'TtYy'} | {c: False for c in 'FfNn'}
+            invalidos = ~distintos.isin(list(mapa) + ['?'])
+            convertidos = np.array([mapa.get(v) for v in distintos] + [None], dtype=object)
+
+        # Código -1 (vazio) pega o nulo do final
+        resultado = convertidos.take(np.where(nulos, len(convertidos) - 1, codigos))
+        if tipo == 'D':
+            resultado = pd.arrays.ArrowExtensionArray(pa.array(resultado, type=pa.date32(), from_pandas=True))
+        elif tipo == 'L':
+            resultado = pd.array(resultado, dtype='boolean')
+        return resultado, bool(invalidos.any())
+
+    @staticmethod
+    def _split_fixed_width(text, widths=None):
+        """Divide texto em campos de largura fixa"""
         if not widths:
             # Tentar detectar larguras automaticamente
             # Procurar por sequências de espaços como separadores
@@ -422,221 +1054,1271 @@ except Exception as e:
         
         return fields
 
+
+# Script do worker persistente: lê jobs JSON (um por linha) no stdin,
+# responde um JSON por linha no stdout e manda o log para o stderr.
+# "# CONVERSOR_CNS" é substituído pelo código de converter_coluna_cns.
+_DOCKER_WORKER_SCRIPT = """
+import json
+import sys
+
+import pandas as pd
+import pyreaddbc
+
+
+def log(msg):
+    print(msg, file=sys.stderr, flush=True)
+
+
+# CONVERSOR_CNS
+
+
+def responder(resposta):
+    sys.stdout.write(json.dumps(resposta) + '\\n')
+    sys.stdout.flush()
+
+
+log("🐳 Worker PySUS pronto")
+for linha in sys.stdin:
+    linha = linha.strip()
+    if not linha:
+        continue
+    job = json.loads(linha)
+    try:
+        log(f"📖 Lendo {job['arquivo']} com encoding {job['encoding']}...")
+        df = pyreaddbc.read_dbc("/data/" + job['arquivo'], encoding=job['encoding'])
+        if df is None or len(df) == 0:
+            responder({'id': job['id'], 'ok': False, 'erro': 'DataFrame vazio'})
+            continue
+        if 'AP_CNSPCN' in df.columns:
+            df['AP_CNSPCN'] = converter_coluna_cns(df['AP_CNSPCN'])
+        df.to_parquet("/data/" + job['saida'], index=False)
+        log(f"💾 Salvo: /data/{job['saida']} ({len(df):,} registros)")
+        responder({'id': job['id'], 'ok': True, 'registros': len(df)})
+    except Exception as e:
+        responder({'id': job['id'], 'ok': False, 'erro': str(e)})
+"""
+
+
+class DBCDockerWorker:
+    """
+    Container PySUS de longa duração para converter vários DBC em sequência.
+
+    O container é iniciado na primeira conversão e recebe os jobs pelo stdin
+    (docker run -i), evitando um `docker run` e um import do pandas/pyreaddbc
+    por arquivo. Cada chamada de converter() só retorna quando o job termina.
+    Use como context manager ou chame encerrar() ao final do lote.
+    """
+
+    def __init__(self, dados_dir=None, imagem='pysus:local', timeout=300):
+        self.dados_dir = Path(dados_dir or diretorio_dados()).absolute()
+        self.imagem = imagem
+        self.timeout = timeout
+        self.nome = f"sia_worker_{os.getpid()}_{id(self):x}"
+        self._proc = None
+        self._respostas = None
+        self._lock = threading.Lock()
+        self._proximo_id = 0
+        self._atexit_registrado = False
+        self._script_path = self.dados_dir / f"{self.nome}.py"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.encerrar()
+
+    @property
+    def ativo(self):
+        return self._proc is not None and self._proc.poll() is None
+
+    def iniciar(self):
+        """Inicia o container (se ainda não estiver rodando)"""
+        if self.ativo:
+            return
+
+        import atexit
+        import queue
+        import subprocess
+
+        self.dados_dir.mkdir(parents=True, exist_ok=True)
+        import inspect
+
+        script = _DOCKER_WORKER_SCRIPT.replace('# CONVERSOR_CNS\n', inspect.getsource(converter_coluna_cns))
+        self._script_path.write_text(script, encoding='utf-8')
+
+        print("   🐳 Iniciando worker Docker PySUS...")
+        cmd = [
+            'docker', 'run', '--rm', '-i',
+            '--name', self.nome,
+            '-v', f'{str(self.dados_dir)}:/data',
+            self.imagem,
+            'python', '-u', f'/data/{self._script_path.name}'
+        ]
+        self._proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            encoding='utf-8',
+            errors='replace',
+            bufsize=1
+        )
+
+        self._respostas = queue.Queue()
+        proc = self._proc
+        respostas = self._respostas
+
+        def ler_stdout():
+            for linha in proc.stdout:
+                respostas.put(linha)
+            respostas.put(None)  # container terminou
+
+        def ler_stderr():
+            for linha in proc.stderr:
+                print(f"   {linha.rstrip()}")
+
+        threading.Thread(target=ler_stdout, daemon=True).start()
+        threading.Thread(target=ler_stderr, daemon=True).start()
+
+        if not self._atexit_registrado:
+            atexit.register(self.encerrar)
+            self._atexit_registrado = True
+
+    def converter(self, dbc_file, encoding='latin-1'):
+        """Envia um DBC ao worker e retorna o DataFrame convertido"""
+        import json
+        import queue
+        import shutil
+        import tempfile
+
+        dbc_path = Path(dbc_file).absolute()
+
+        with self._lock:
+            try:
+                self.iniciar()
+
+                # O container só enxerga o volume /data. A cópia ganha um nome
+                # único para não sobrescrever (e depois apagar) um arquivo de
+                # mesmo nome que já esteja lá.
+                copia = None
+                if dbc_path.parent != self.dados_dir:
+                    fd, nome = tempfile.mkstemp(dir=self.dados_dir, suffix='.dbc')
+                    os.close(fd)
+                    copia = Path(nome)
+                    try:
+                        shutil.copy2(dbc_path, copia)
+                    except Exception:
+                        copia.unlink()
+                        raise
+                entrada = copia or dbc_path
+
+                self._proximo_id += 1
+                job_id = self._proximo_id
+                output_path = self.dados_dir / f"{entrada.stem}_converted.parquet"
+                job = {
+                    'id': job_id,
+                    'arquivo': entrada.name,
+                    'saida': output_path.name,
+                    'encoding': encoding
+                }
+                self._proc.stdin.write(json.dumps(job) + '\n')
+                self._proc.stdin.flush()
+
+                try:
+                    while True:
+                        linha = self._respostas.get(timeout=self.timeout)
+                        if linha is None:
+                            print("   ❌ Worker Docker terminou inesperadamente")
+                            return pd.DataFrame()
+                        try:
+                            resposta = json.loads(linha)
+                        except ValueError:
+                            print(f"   {linha.rstrip()}")
+                            continue
+                        if resposta.get('id') == job_id:
+                            break
+                except queue.Empty:
+                    print("   ❌ Timeout na conversão Docker")
+                    self.encerrar()
+                    return pd.DataFrame()
+                finally:
+                    if copia is not None:
+                        try:
+                            copia.unlink()
+                        except:
+                            pass
+
+                if not resposta.get('ok'):
+                    print(f"   ❌ Worker falhou: {resposta.get('erro')}")
+                    return pd.DataFrame()
+
+                df = pd.read_parquet(output_path)
+                print(f"   ✅ Convertido: {len(df):,} registros, {len(df.columns)} colunas")
+                try:
+                    output_path.unlink()
+                except:
+                    pass
+                return df
+
+            except Exception as e:
+                print(f"   ❌ Erro Docker: {e}")
+                traceback.print_exc()
+                return pd.DataFrame()
+
+    def encerrar(self):
+        """Finaliza o container e remove o script do worker"""
+        import subprocess
+
+        proc, self._proc = self._proc, None
+        if proc is not None and proc.poll() is None:
+            print("   🐳 Encerrando worker Docker...")
+            try:
+                proc.stdin.close()
+                proc.wait(timeout=15)
+            except Exception:
+                subprocess.run(['docker', 'kill', self.nome],
+                               capture_output=True, timeout=30)
+                try:
+                    proc.wait(timeout=15)
+                except Exception:
+                    proc.kill()
+
+        try:
+            self._script_path.unlink()
+        except:
+            pass
+
+
+class FTPSessionPool:
+    """
+    Pool de sessões FTP reutilizáveis.
+
+    Cada sessão faz connect/login/cwd uma única vez e volta ao pool após o uso.
+    Sessões paradas há mais de `keepalive` segundos recebem um NOOP antes de
+    serem reutilizadas; se a conexão caiu, a sessão é descartada e uma nova é
+    aberta. No máximo `tamanho` sessões ficam abertas ao mesmo tempo.
+    """
+
+    def __init__(self, host, path, tamanho=4, port=21, timeout=120, keepalive=30):
+        self.host = host
+        self.path = path
+        self.port = port
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self._livres = []
+        self._vagas = threading.BoundedSemaphore(tamanho)
+        self._lock = threading.Lock()
+        self._atexit_registrado = False
+
+    def _conectar(self):
+        from ftplib import FTP
+
+        ftp = FTP(timeout=self.timeout)
+        ftp.connect(self.host, self.port)
+        ftp.login()
+        ftp.cwd(self.path)
+        return ftp
+
+    def _obter(self):
+        """Sessão livre (testada com NOOP se ficou parada) ou uma nova conexão"""
+        import ftplib
+        import time
+
+        with self._lock:
+            ftp, ultimo_uso = self._livres.pop() if self._livres else (None, None)
+
+        if ftp is not None and time.monotonic() - ultimo_uso > self.keepalive:
+            try:
+                ftp.voidcmd('NOOP')
+            except ftplib.all_errors:
+                self._descartar(ftp)
+                ftp = None
+
+        if ftp is None:
+            ftp = self._conectar()
+            if not self._atexit_registrado:
+                import atexit
+                atexit.register(self.fechar)
+                self._atexit_registrado = True
+        return ftp
+
+    def _devolver(self, ftp):
+        import time
+
+        with self._lock:
+            self._livres.append((ftp, time.monotonic()))
+
     @staticmethod
-    def _identify_columns(df):
-        """Tenta identificar nomes reais das colunas"""
-        # Padrões comuns no SIA
-        column_patterns = {
-            'AP_CNSPCN': ['CNS', 'CNSPCN', 'AP_CNS'],
-            'AP_MUNPCN': ['MUN', 'MUNIC', 'MUNPCN', 'COD_MUN'],
-            'AP_CIDPRI': ['CID', 'DIAG', 'CIDPRI'],
-            'AP_PRIPAL': ['PROC', 'PRIPAL', 'PROCED'],
-            'AP_VL_AP': ['VALOR', 'VL_AP', 'VALOR_AP'],
-            'AP_UFMUN': ['UF', 'UFMUN'],
-            'AP_CMP': ['CMP', 'COMPET'],
-            'AP_NUIDADE': ['IDADE', 'NUIDADE'],
-            'AP_SEXO': ['SEXO'],
-            'AP_RACACOR': ['RACA', 'RACACOR'],
-            'AP_DTINIC': ['DTINIC', 'DATA_INI'],
-            'AP_DTFIM': ['DTFIM', 'DATA_FIM'],
-        }
-        
-        # Verificar primeira linha para ver se é cabeçalho
-        first_row = df.iloc[0].astype(str).str.upper().tolist()
-        header_like = any(any(pattern in cell for pattern in ['AP_', 'CNS', 'MUN', 'CID']) 
-                         for cell in first_row)
-        
-        if header_like:
-            # Usar primeira linha como cabeçalho
-            new_columns = first_row
-            df = df.iloc[1:].reset_index(drop=True)
-            
-            # Renomear colunas
-            if len(new_columns) == len(df.columns):
-                df.columns = new_columns
-                print("✅ Usando primeira linha como cabeçalho")
-        
-        # Renomear colunas baseado em padrões
-        for i, col in enumerate(df.columns):
-            col_upper = str(col).upper()
-            for std_name, patterns in column_patterns.items():
-                for pattern in patterns:
-                    if pattern.upper() in col_upper:
-                        df = df.rename(columns={col: std_name})
-                        print(f"   🔄 Renomeada coluna {i}: {col} -> {std_name}")
-                        break
-        
-        return df
+    def _descartar(ftp):
+        try:
+            ftp.close()
+        except Exception:
+            pass
+
+    def executar(self, operacao, tentativas=2):
+        """
+        Executa operacao(ftp) numa sessão do pool.
+
+        Erros de conexão descartam a sessão e a operação é repetida numa
+        conexão nova (até `tentativas` vezes). Respostas 5xx (ex.: arquivo
+        inexistente) são repassadas sem descartar a sessão.
+        """
+        import ftplib
+
+        with self._vagas:
+            for tentativa in range(tentativas):
+                ftp = None
+                try:
+                    # Após uma queda, tentar numa conexão nova (as livres podem estar mortas)
+                    ftp = self._obter() if tentativa == 0 else self._conectar()
+                    resultado = operacao(ftp)
+                except ftplib.error_perm:
+                    # Sem sessão quando o próprio _obter()/_conectar() foi recusado
+                    if ftp is not None:
+                        self._devolver(ftp)
+                    raise
+                except ftplib.all_errors as e:
+                    if ftp is not None:
+                        self._descartar(ftp)
+                    if tentativa == tentativas - 1:
+                        raise
+                    print(f"   🔄 Conexão FTP perdida ({e}), reconectando...")
+                    continue
+                self._devolver(ftp)
+                return resultado
+
+    def fechar(self):
+        """Encerra as sessões livres"""
+        with self._lock:
+            livres, self._livres = self._livres, []
+        for ftp, _ in livres:
+            try:
+                ftp.quit()
+            except Exception:
+                self._descartar(ftp)
+
+
+class DBCCache:
+    """
+    Cache local dos DBC baixados do DATASUS.
+
+    Os arquivos ficam no diretório de dados (onde o Docker já os enxerga) e o
+    manifesto dbc_cache.json guarda, por arquivo, o tamanho e a data (MDTM) do
+    servidor, o SHA-256 do conteúdo e o último acesso. Um arquivo só é reaproveitado
+    se o tamanho e a data do servidor não mudaram. Ao passar de `limite_mb`, os
+    arquivos menos usados recentemente são removidos, exceto os entregues por
+    obter()/adicionar() que ainda não foram liberados com liberar().
+    """
+
+    MANIFESTO = 'dbc_cache.json'
+
+    def __init__(self, diretorio=None, limite_mb=4096):
+        import json
+
+        self.diretorio = Path(diretorio or diretorio_dados())
+        self.limite_mb = limite_mb
+        self._lock = threading.Lock()
+        self._em_uso = set()
+        self._manifesto_path = self.diretorio / self.MANIFESTO
+        try:
+            self._entradas = json.loads(self._manifesto_path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            self._entradas = {}
+
+    def _salvar(self):
+        import json
+
+        self.diretorio.mkdir(parents=True, exist_ok=True)
+        tmp = self._manifesto_path.with_name(self.MANIFESTO + '.tmp')
+        tmp.write_text(json.dumps(self._entradas, indent=1), encoding='utf-8')
+        os.replace(tmp, self._manifesto_path)
 
     @staticmethod
-    def _parse_as_text(data, encoding):
-        """Parsing alternativo como texto puro"""
-        print("📝 Usando parsing textual...")
-        
+    def _sha256(caminho):
+        import hashlib
+
+        h = hashlib.sha256()
+        with open(caminho, 'rb') as f:
+            for bloco in iter(lambda: f.read(1 << 20), b''):
+                h.update(bloco)
+        return h.hexdigest()
+
+    @property
+    def tamanho_total(self):
+        return sum(e['tamanho'] for e in self._entradas.values())
+
+    def obter(self, nome, tamanho, modificado):
+        """Caminho do arquivo em cache se ainda corresponde ao servidor, senão None"""
+        import time
+
+        if tamanho is None or modificado is None:
+            return None
+
+        with self._lock:
+            entrada = self._entradas.get(nome)
+            if (entrada is None or entrada['tamanho'] != tamanho
+                    or entrada['modificado'] != modificado.isoformat()):
+                return None
+
+            caminho = self.diretorio / nome
+            if not caminho.exists() or caminho.stat().st_size != tamanho:
+                del self._entradas[nome]
+                self._salvar()
+                return None
+
+            entrada['ultimo_acesso'] = time.time()
+            self._em_uso.add(nome)
+            self._salvar()
+            return caminho
+
+    def adicionar(self, caminho, tamanho, modificado):
+        """Registra um arquivo recém-baixado (já dentro do diretório do cache)"""
+        import time
+
+        caminho = Path(caminho)
+        sha256 = self._sha256(caminho)
+
+        with self._lock:
+            self._entradas[caminho.name] = {
+                'tamanho': tamanho,
+                'modificado': modificado.isoformat() if modificado else None,
+                'sha256': sha256,
+                'ultimo_acesso': time.time(),
+            }
+            self._em_uso.add(caminho.name)
+            self._remover_excedente(self.limite_mb)
+            self._salvar()
+
+    def liberar(self, nome):
+        """Permite que o arquivo volte a ser removido pela poda LRU"""
+        with self._lock:
+            self._em_uso.discard(nome)
+            if self.tamanho_total > self.limite_mb * 1024 * 1024:
+                self._remover_excedente(self.limite_mb)
+                self._salvar()
+
+    def hash_arquivo(self, nome):
+        """SHA-256 registrado no manifesto (None se o arquivo não está no cache)"""
+        with self._lock:
+            entrada = self._entradas.get(nome)
+            return entrada['sha256'] if entrada else None
+
+    def _remover_excedente(self, limite_mb):
+        """Remove arquivos em ordem LRU até caber em limite_mb (chamar com o lock)"""
+        removidos, liberado = 0, 0
+        limite = limite_mb * 1024 * 1024
+
+        # Entradas cujo arquivo sumiu
+        for nome in [n for n in self._entradas if not (self.diretorio / n).exists()]:
+            del self._entradas[nome]
+
+        total = self.tamanho_total
+        for nome in sorted(self._entradas, key=lambda n: self._entradas[n]['ultimo_acesso']):
+            if total <= limite:
+                break
+            if nome in self._em_uso:
+                continue
+            tamanho = self._entradas.pop(nome)['tamanho']
+            try:
+                (self.diretorio / nome).unlink()
+            except OSError:
+                pass
+            total -= tamanho
+            removidos += 1
+            liberado += tamanho
+
+        return removidos, liberado
+
+    def limpar(self, limite_mb=0):
+        """
+        Poda o cache até limite_mb (0 = esvaziar), e também o cache de
+        conversão (CacheConversao) do mesmo diretório, cada um até limite_mb.
+
+        Returns:
+            tuple: (arquivos removidos, bytes liberados), somando os dois caches
+        """
+        with self._lock:
+            removidos, liberado = self._remover_excedente(limite_mb)
+            self._salvar()
+        print(f"🧹 Cache DBC: {removidos} arquivos removidos, {liberado / (1024 * 1024):.2f} MB liberados")
+        conversoes = CacheConversao(self.diretorio).limpar(limite_mb)
+        return removidos + conversoes[0], liberado + conversoes[1]
+
+
+class CacheConversao:
+    """
+    Cache das conversões DBC → Parquet (dados/cache_conversao), um arquivo
+    por SHA-256 do DBC, encoding, engine e versão do conversor (ver
+    DBCConverter.read_dbc).
+
+    Como no DBCCache, ao passar de `limite_mb` os arquivos menos usados
+    recentemente são removidos. O último acesso é a data de modificação do
+    arquivo, atualizada a cada leitura (registrar_acesso), então não há
+    manifesto: arquivos de versões antigas do conversor saem primeiro.
+    """
+
+    DIRETORIO = 'cache_conversao'
+    _lock = threading.Lock()
+
+    def __init__(self, diretorio=None, limite_mb=4096):
+        self.diretorio = Path(diretorio or diretorio_dados()) / self.DIRETORIO
+        self.limite_mb = limite_mb
+
+    def _arquivos(self):
+        """(caminho, tamanho, último acesso) dos Parquet em cache (os .tmp em gravação ficam de fora)"""
+        arquivos = []
+        for caminho in self.diretorio.glob('*.parquet'):
+            try:
+                info = caminho.stat()
+            except OSError:
+                continue
+            arquivos.append((caminho, info.st_size, info.st_mtime))
+        return arquivos
+
+    @property
+    def tamanho_total(self):
+        return sum(tamanho for _, tamanho, _ in self._arquivos())
+
+    @staticmethod
+    def registrar_acesso(caminho):
+        """Marca o arquivo como usado agora (fica por último na poda LRU)"""
+        import time
+
+        # Hora explícita: os.utime(caminho) usa o relógio grosso do kernel e
+        # pode empatar com arquivos gravados logo antes
+        agora = time.time_ns()
         try:
-            # Decodificar todo o conteúdo
-            text = data.decode(encoding, errors='ignore')
-            
-            # Procurar por linhas estruturadas
-            lines = text.splitlines()
-            
-            # Filtrar linhas vazias
-            lines = [line.strip() for line in lines if line.strip()]
-            
-            if len(lines) < 2:
-                return pd.DataFrame()
-            
-            # Analisar estrutura
-            possible_delimiters = [';', '|', '\t', ',']
-            best_delimiter = None
-            best_field_count = 0
-            
-            for delim in possible_delimiters:
-                sample_lines = lines[:10]  # Analisar primeiras 10 linhas
-                field_counts = [len(line.split(delim)) for line in sample_lines]
-                avg_fields = np.mean(field_counts)
-                
-                if avg_fields > best_field_count and avg_fields > 1:
-                    best_field_count = avg_fields
-                    best_delimiter = delim
-            
-            if best_delimiter:
-                print(f"✅ Delimitador detectado: '{best_delimiter}' ({best_field_count:.1f} campos)")
-                
-                # Separar campos
-                all_fields = []
-                for line in lines:
-                    fields = line.split(best_delimiter)
-                    fields = [field.strip() for field in fields]
-                    if len(fields) > 1:  # Pelo menos 2 campos
-                        all_fields.append(fields)
-                
-                if all_fields:
-                    # Encontrar número máximo de campos
-                    max_fields = max(len(fields) for fields in all_fields)
-                    
-                    # Padronizar número de campos
-                    for fields in all_fields:
-                        while len(fields) < max_fields:
-                            fields.append('')
-                    
-                    # Criar DataFrame
-                    columns = [f'FIELD_{i:03d}' for i in range(max_fields)]
-                    df = pd.DataFrame(all_fields, columns=columns)
-                    
-                    # Tentar identificar cabeçalho
-                    df = DBCConverter._identify_columns(df)
-                    
-                    print(f"✅ Parsing textual: {len(df):,} registros")
-                    return df
-            
-            # Último recurso: criar DataFrame com uma coluna
-            df = pd.DataFrame({'CONTEUDO': lines})
-            print(f"⚠️  Criado DataFrame básico: {len(df):,} linhas")
-            return df
-            
-        except Exception as e:
-            print(f"❌ Erro no parsing textual: {e}")
-            return pd.DataFrame()
+            os.utime(caminho, ns=(agora, agora))
+        except OSError:
+            pass
+
+    def podar(self, manter=None):
+        """Remove arquivos em ordem LRU até caber em limite_mb, exceto `manter` (recém-gravado)"""
+        with self._lock:
+            return self._remover_excedente(self.limite_mb, manter)
+
+    def _remover_excedente(self, limite_mb, manter=None):
+        """Remove arquivos em ordem LRU até caber em limite_mb (chamar com o lock)"""
+        removidos, liberado = 0, 0
+        limite = limite_mb * 1024 * 1024
+
+        arquivos = self._arquivos()
+        total = sum(tamanho for _, tamanho, _ in arquivos)
+        for caminho, tamanho, _ in sorted(arquivos, key=lambda a: a[2]):
+            if total <= limite:
+                break
+            if manter is not None and caminho == Path(manter):
+                continue
+            try:
+                caminho.unlink()
+            except OSError:
+                continue
+            total -= tamanho
+            removidos += 1
+            liberado += tamanho
+
+        return removidos, liberado
+
+    def limpar(self, limite_mb=0):
+        """
+        Poda o cache até limite_mb (0 = esvaziar).
+
+        Returns:
+            tuple: (arquivos removidos, bytes liberados)
+        """
+        with self._lock:
+            removidos, liberado = self._remover_excedente(limite_mb)
+        print(f"🧹 Cache de conversão: {removidos} arquivos removidos, {liberado / (1024 * 1024):.2f} MB liberados")
+        return removidos, liberado
+
+
+class PipelineEstagios:
+    """
+    Pipeline de estágios (ex.: download → conversão → CNS → gravação).
+
+    Cada estágio é (nome, funcao, workers): `workers` threads consomem a fila
+    de entrada do estágio e chamam funcao(item, valor); o retorno segue para o
+    estágio seguinte. As filas entre estágios têm `capacidade` posições: quando
+    um estágio lento enche a sua fila, os anteriores esperam (backpressure) em
+    vez de acumular arquivos e DataFrames. Se a função retornar None ou levantar
+    exceção, o item sai do pipeline com valor None.
+
+    Assim o download dos próximos arquivos corre enquanto os anteriores são
+    convertidos e gravados. estatisticas() mostra a vazão de cada estágio e
+    qual deles é o gargalo.
+    """
+
+    _FIM = object()
+
+    def __init__(self, estagios, capacidade=2):
+        self.estagios = [(nome, funcao, max(1, int(workers))) for nome, funcao, workers in estagios]
+        self.capacidade = capacidade
+        self._lock = threading.Lock()
+        self._stats = []
+        self._duracao = 0.0
+
+    @staticmethod
+    def _medir(valor):
+        """Volume produzido por um estágio: registros de DataFrame ou bytes de arquivo"""
+        if hasattr(valor, 'shape'):
+            return 'registros', len(valor)
+        if isinstance(valor, (str, Path)) and os.path.isfile(valor):
+            return 'bytes', os.path.getsize(valor)
+        return None, 0
+
+    def executar(self, itens):
+        """
+        Processa os itens pelos estágios.
+
+        Yields:
+            tuple: (item, resultado do último estágio ou None), na ordem de conclusão
+        """
+        import queue
+        import time
+
+        parar = threading.Event()
+        filas = [queue.Queue(maxsize=self.capacidade) for _ in self.estagios]
+        saida = queue.Queue(maxsize=self.capacidade)
+        restantes = [workers for _, _, workers in self.estagios]
+        self._stats = [{'estagio': nome, 'workers': workers, 'itens': 0, 'falhas': 0,
+                        'ocupado_s': 0.0, 'espera_s': 0.0, 'registros': 0, 'bytes': 0}
+                       for nome, _, workers in self.estagios]
+
+        def colocar(fila, pacote):
+            # put com timeout para não travar se o consumidor desistir
+            while not parar.is_set():
+                try:
+                    fila.put(pacote, timeout=0.2)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def alimentar():
+            try:
+                for item in itens:
+                    if not colocar(filas[0], (item, item)):
+                        return
+            except Exception as e:
+                print(f"❌ Erro ao gerar itens do pipeline: {e}")
+                traceback.print_exc()
+            for _ in range(self.estagios[0][2]):
+                colocar(filas[0], self._FIM)
+
+        def trabalhar(k):
+            nome, funcao, _ = self.estagios[k]
+            entrada = filas[k]
+            proxima = filas[k + 1] if k + 1 < len(filas) else saida
+            stats = self._stats[k]
+
+            while not parar.is_set():
+                try:
+                    pacote = entrada.get(timeout=0.2)
+                except queue.Empty:
+                    continue
+
+                if pacote is self._FIM:
+                    with self._lock:
+                        restantes[k] -= 1
+                        ultimo = restantes[k] == 0
+                    if ultimo:
+                        # O último worker do estágio encerra os do estágio seguinte
+                        for _ in range(self.estagios[k + 1][2] if k + 1 < len(filas) else 1):
+                            colocar(proxima, self._FIM)
+                    return
+
+                item, valor = pacote
+                t0 = time.monotonic()
+                try:
+                    resultado = funcao(item, valor)
+                except Exception as e:
+                    print(f"❌ Erro no estágio {nome} ({item}): {e}")
+                    traceback.print_exc()
+                    resultado = None
+                t1 = time.monotonic()
+
+                if resultado is None:
+                    colocar(saida, (item, None))
+                else:
+                    colocar(proxima, (item, resultado))
+                t2 = time.monotonic()
+
+                medida, volume = self._medir(resultado)
+                with self._lock:
+                    stats['itens'] += 1
+                    stats['falhas'] += resultado is None
+                    stats['ocupado_s'] += t1 - t0
+                    stats['espera_s'] += t2 - t1
+                    if medida:
+                        stats[medida] += volume
+
+        inicio = time.monotonic()
+        threading.Thread(target=alimentar, daemon=True, name="pipeline-itens").start()
+        for k, (nome, _, workers) in enumerate(self.estagios):
+            for _ in range(workers):
+                threading.Thread(target=trabalhar, args=(k,), daemon=True, name=f"pipeline-{nome}").start()
+
+        try:
+            while True:
+                pacote = saida.get()
+                if pacote is self._FIM:
+                    break
+                yield pacote
+        finally:
+            parar.set()
+            self._duracao = time.monotonic() - inicio
+
+    def estatisticas(self):
+        """
+        Vazão por estágio da última execução.
+
+        vazao_itens_s é o ritmo que o estágio sustenta com seus workers (itens
+        por segundo de trabalho); utilizacao é a fração do tempo total em que os
+        workers estiveram ocupados. O estágio com maior utilização é o gargalo;
+        espera_s alto indica que o estágio ficou parado esperando o seguinte.
+        """
+        resultado = []
+        for stats in self._stats:
+            ativo = stats['ocupado_s'] / stats['workers']
+            item = dict(stats)
+            item['ocupado_s'] = round(stats['ocupado_s'], 3)
+            item['espera_s'] = round(stats['espera_s'], 3)
+            item['vazao_itens_s'] = round(stats['itens'] / ativo, 3) if ativo else 0.0
+            item['registros_s'] = round(stats['registros'] / ativo, 1) if ativo else 0.0
+            item['mb_s'] = round(stats['bytes'] / (1024 * 1024) / ativo, 3) if ativo else 0.0
+            item['utilizacao'] = round(ativo / self._duracao, 3) if self._duracao else 0.0
+            resultado.append(item)
+        return resultado
+
+    def imprimir_estatisticas(self):
+        """Imprime a vazão de cada estágio e destaca o gargalo"""
+        estatisticas = self.estatisticas()
+        if not estatisticas or not any(e['itens'] for e in estatisticas):
+            return
+        gargalo = max(estatisticas, key=lambda e: e['utilizacao'])['estagio']
+
+        print(f"\n⏱️  Pipeline ({self._duracao:.1f}s):")
+        for e in estatisticas:
+            volume = ""
+            if e['bytes']:
+                volume = f", {e['mb_s']:.2f} MB/s"
+            elif e['registros']:
+                volume = f", {e['registros_s']:,.0f} registros/s"
+            marca = "  🐢 gargalo" if e['estagio'] == gargalo and len(estatisticas) > 1 else ""
+            print(f"   {e['estagio']:<10} {e['workers']}w  {e['itens']:>4} itens  "
+                  f"{e['vazao_itens_s']:.2f} itens/s{volume}  "
+                  f"ocupado {e['utilizacao']:.0%}  espera {e['espera_s']:.1f}s{marca}")
 
 
 class SIADownloader:
     """Gerencia download do DATASUS e conversão"""
 
-    def __init__(self):
-        self.ftp_host = "ftp.datasus.gov.br"
-        self.ftp_path = "/dissemin/publicos/SIASUS/200801_/Dados/"
+    def __init__(self, ftp_host="ftp.datasus.gov.br", ftp_path="/dissemin/publicos/SIASUS/200801_/Dados/",
+                 ftp_port=21, sessoes=4, cache_ttl=3600, tentativas=5, backoff=2.0,
+                 cache_dbc=True, cache_limite_mb=4096):
+        self.ftp_host = ftp_host
+        self.ftp_path = ftp_path
+        self.pool = FTPSessionPool(ftp_host, ftp_path, tamanho=sessoes, port=ftp_port)
+        self.cache_ttl = cache_ttl
+        self.tentativas = tentativas
+        self.backoff = backoff
+        self.cache = DBCCache(limite_mb=cache_limite_mb) if cache_dbc else None
+        self.cache_limite_mb = cache_limite_mb
+        self._listagem = None
+        self._listagem_em = 0
+        self._lock_listagem = threading.Lock()
+        self.estatisticas_pipeline = []
+
+    @staticmethod
+    def _nome_arquivo(grupo, uf, ano, mes):
+        return f"{grupo}{uf}{str(ano)[2:]}{str(mes).zfill(2)}.dbc"
+
+    @staticmethod
+    def _ler_listagem(ftp):
+        """Lê o diretório com tamanhos e datas (MLSD) ou só os nomes (NLST)"""
+        import ftplib
+
+        arquivos = {}
+        try:
+            for nome, fatos in ftp.mlsd(facts=['type', 'size', 'modify']):
+                if fatos.get('type', 'file') != 'file':
+                    continue
+                modificado = fatos.get('modify')
+                arquivos[nome.upper()] = {
+                    'nome': nome,
+                    'tamanho': int(fatos['size']) if 'size' in fatos else None,
+                    'modificado': datetime.strptime(modificado[:14], '%Y%m%d%H%M%S') if modificado else None,
+                }
+        except ftplib.error_perm:
+            # Servidor sem MLSD: tamanho e MDTM são consultados sob demanda
+            for nome in ftp.nlst():
+                nome = nome.rsplit('/', 1)[-1]
+                arquivos[nome.upper()] = {'nome': nome, 'tamanho': None, 'modificado': None}
+        return arquivos
+
+    def listar_diretorio(self, atualizar=False):
+        """
+        Listagem do diretório do FTP em cache (válida por cache_ttl segundos).
+
+        Returns:
+            dict: NOME.DBC -> {'nome', 'tamanho', 'modificado'}, ou None se a listagem falhar
+        """
+        import time
+
+        with self._lock_listagem:
+            if (not atualizar and self._listagem is not None
+                    and time.monotonic() - self._listagem_em < self.cache_ttl):
+                return self._listagem
+
+            try:
+                print(f"📂 Listando {self.ftp_host}{self.ftp_path}...")
+                self._listagem = self.pool.executar(self._ler_listagem)
+                self._listagem_em = time.monotonic()
+                print(f"   ✅ {len(self._listagem):,} arquivos no diretório")
+            except Exception as e:
+                print(f"   ⚠️  Falha ao listar diretório: {e}")
+                return None
+            return self._listagem
+
+    def info_arquivo(self, filename):
+        """
+        Tamanho e data (MDTM) de um arquivo segundo a listagem em cache.
+
+        Returns:
+            dict com 'nome', 'tamanho', 'modificado'; None se o arquivo não existe no FTP.
+            Se a listagem não estiver disponível, retorna o nome com tamanho/data None.
+        """
+        listagem = self.listar_diretorio()
+        if listagem is None:
+            return {'nome': filename, 'tamanho': None, 'modificado': None}
+
+        info = listagem.get(filename.upper())
+        if info is None:
+            return None
+
+        if info['tamanho'] is None:
+            def consultar(ftp):
+                tamanho = ftp.size(info['nome'])
+                resposta = ftp.voidcmd(f"MDTM {info['nome']}")
+                return tamanho, datetime.strptime(resposta.split()[-1][:14], '%Y%m%d%H%M%S')
+
+            try:
+                info['tamanho'], info['modificado'] = self.pool.executar(consultar)
+            except Exception:
+                pass
+        return info
+
+    def planejar_downloads(self, grupo, uf, ano, meses):
+        """
+        Verifica na listagem quais meses existem no FTP antes de baixar.
+
+        Returns:
+            list: [{'mes', 'nome', 'tamanho', 'modificado'}, ...] na ordem de `meses`
+        """
+        plano = []
+        for mes in meses:
+            info = self.info_arquivo(self._nome_arquivo(grupo, uf, ano, mes))
+            if info is None:
+                print(f"⏭️  Mês {mes:02d} não disponível no FTP")
+                continue
+            plano.append({'mes': mes, **info})
+
+        total = sum(item['tamanho'] or 0 for item in plano)
+        print(f"📋 Plano: {len(plano)} de {len(meses)} meses, {total / (1024 * 1024):.2f} MB")
+        return plano
+
+    def fechar(self):
+        """Encerra as sessões FTP abertas"""
+        self.pool.fechar()
 
     def download_arquivo(self, grupo, uf, ano, mes):
-        """Baixa arquivo DBC do DATASUS para o diretório dados"""
-        filename = f"{grupo}{uf}{str(ano)[2:]}{str(mes).zfill(2)}.dbc"
+        """
+        Baixa arquivo DBC do DATASUS para o diretório dados.
+
+        O download vai para <arquivo>.dbc.part e, se a conexão cair, é retomado
+        do ponto em que parou (REST), com espera exponencial entre tentativas.
+        O tamanho e a data (MDTM) do servidor ficam em <arquivo>.dbc.part.json:
+        se o arquivo mudou no servidor desde então, o .part é descartado e o
+        download recomeça do zero. O .dbc só aparece (rename atômico) quando o
+        tamanho confere com o do servidor.
+        """
+        import ftplib
+        import json
+        import time
+
+        filename = self._nome_arquivo(grupo, uf, ano, mes)
+
+        info = self.info_arquivo(filename)
+        if info is None:
+            print(f"⏭️  Não disponível no FTP: {filename}")
+            return None
+
+        if self.cache is not None:
+            em_cache = self.cache.obter(filename, info['tamanho'], info['modificado'])
+            if em_cache is not None:
+                print(f"♻️  Em cache: {filename} (sem alteração no servidor)")
+                return str(em_cache)
 
         print(f"🌐 Baixando: {filename}")
 
         try:
-            ftp = FTP(self.ftp_host, timeout=120)
-            ftp.login()
-            ftp.cwd(self.ftp_path)
-
             # Salvar no diretório dados (para usar com Docker)
-            dados_dir = Path(base_path)
+            dados_dir = self.cache.diretorio if self.cache is not None else diretorio_dados()
             dados_dir.mkdir(parents=True, exist_ok=True)
             dbc_path = dados_dir / filename
+            part_path = dbc_path.with_name(dbc_path.name + '.part')
+            origem_path = part_path.with_name(part_path.name + '.json')
+            esperado = {'tamanho': info['tamanho'], 'modificado': info['modificado']}
 
-            # Baixar
-            with open(dbc_path, 'wb') as f:
-                ftp.retrbinary(f"RETR {filename}", f.write)
+            def descartar_parcial():
+                part_path.unlink(missing_ok=True)
+                origem_path.unlink(missing_ok=True)
 
-            ftp.quit()
+            # Baixar (sessão do pool), continuando o .part se já houver bytes
+            # do mesmo arquivo do servidor
+            def baixar(ftp):
+                ftp.voidcmd('TYPE I')
+                if esperado['tamanho'] is None:
+                    esperado['tamanho'] = ftp.size(info['nome'])
+                if esperado['modificado'] is None:
+                    try:
+                        resposta = ftp.voidcmd(f"MDTM {info['nome']}")
+                        esperado['modificado'] = datetime.strptime(resposta.split()[-1][:14], '%Y%m%d%H%M%S')
+                    except (ftplib.error_perm, ValueError):
+                        pass   # servidor sem MDTM: vale só o tamanho
+                origem = {'tamanho': esperado['tamanho'],
+                          'modificado': esperado['modificado'].isoformat() if esperado['modificado'] else None}
 
-            # Verificar se o arquivo foi baixado
-            if dbc_path.exists() and dbc_path.stat().st_size > 0:
-                size_mb = dbc_path.stat().st_size / (1024 * 1024)
+                offset = part_path.stat().st_size if part_path.exists() else 0
+                if offset:
+                    try:
+                        anterior = json.loads(origem_path.read_text(encoding='utf-8'))
+                    except (OSError, ValueError):
+                        anterior = None
+                    if anterior != origem:
+                        print(f"   ⚠️  {filename} mudou no servidor desde o download parcial, recomeçando")
+                        offset = 0
+                if offset > esperado['tamanho']:
+                    offset = 0
+                if offset and offset == esperado['tamanho']:
+                    return
+                if not offset:
+                    origem_path.write_text(json.dumps(origem), encoding='utf-8')
+                if offset:
+                    print(f"   ↪️  Retomando {filename} a partir de {offset / (1024 * 1024):.2f} MB")
+                with open(part_path, 'ab' if offset else 'wb') as f:
+                    ftp.retrbinary(f"RETR {info['nome']}", f.write, rest=offset or None)
+
+            for tentativa in range(1, self.tentativas + 1):
+                espera = self.backoff * 2 ** (tentativa - 1)
+                try:
+                    self.pool.executar(baixar)
+                except ftplib.error_perm as e:
+                    # Servidor sem suporte a REST: recomeçar do zero
+                    if part_path.exists() and part_path.stat().st_size > 0:
+                        print(f"   ⚠️  Retomada recusada ({e}), reiniciando download")
+                        descartar_parcial()
+                        continue
+                    print(f"❌ Erro FTP: {e}")
+                    return None
+                except ftplib.all_errors as e:
+                    print(f"   ⚠️  Falha no download ({e}), tentativa {tentativa}/{self.tentativas}")
+                    if tentativa < self.tentativas:
+                        time.sleep(espera)
+                    continue
+
+                baixado = part_path.stat().st_size if part_path.exists() else 0
+                if baixado == 0:
+                    print(f"❌ Arquivo vazio: {filename}")
+                    descartar_parcial()
+                    return None
+
+                if esperado['tamanho'] is not None and baixado != esperado['tamanho']:
+                    print(f"   ⚠️  Tamanho divergente: {baixado:,} de {esperado['tamanho']:,} bytes")
+                    if baixado > esperado['tamanho']:
+                        descartar_parcial()
+                    # Consultar tamanho e data de novo (a listagem pode estar desatualizada)
+                    esperado['tamanho'] = esperado['modificado'] = None
+                    if tentativa < self.tentativas:
+                        time.sleep(espera)
+                    continue
+
+                os.replace(part_path, dbc_path)
+                origem_path.unlink(missing_ok=True)
+                if self.cache is not None:
+                    self.cache.adicionar(dbc_path, esperado['tamanho'], esperado['modificado'])
+                size_mb = baixado / (1024 * 1024)
                 print(f"✅ Baixado: {filename} ({size_mb:.2f} MB)")
                 return str(dbc_path)
+
+            print(f"❌ Download falhou após {self.tentativas} tentativas: {filename}")
+            return None
+
+        except Exception as e:
+            print(f"❌ Erro FTP: {e}")
+            return None
+
+    def _converter_mes(self, dbc_path, uf, ano, mes, grupo, engine, worker, parcial=None):
+        """
+        Converte o DBC de um mês, adiciona os metadados e remove o arquivo.
+        Com `parcial`, recebe os registros já convertidos (com os metadados).
+        """
+        try:
+            aviso = ((lambda df, total: parcial(df.assign(UF=uf, ANO=ano, MES=mes, GRUPO=grupo), total))
+                     if parcial is not None else None)
+
+            # Converter DBC com encoding correto (latin-1 = ISO-8859-1 padrão DATASUS)
+            sha256 = self.cache.hash_arquivo(Path(dbc_path).name) if self.cache is not None else None
+            df = DBCConverter.read_dbc(dbc_path, encoding='latin-1', engine=engine, worker=worker,
+                                       sha256=sha256, parcial=aviso, cache_limite_mb=self.cache_limite_mb)
+
+            if df is not None and len(df) > 0:
+                # Adicionar metadados
+                df['UF'] = uf
+                df['ANO'] = ano
+                df['MES'] = mes
+                df['GRUPO'] = grupo
+
+                print(f"✅ Convertido {mes:02d}: {len(df):,} registros")
+                return df
+
+            print(f"❌ Conversão falhou ou dados vazios ({mes:02d})")
+            return None
+        finally:
+            # Limpar arquivo temporário (arquivos do cache ficam para a próxima execução)
+            if self.cache is not None:
+                self.cache.liberar(Path(dbc_path).name)
             else:
-                print(f"❌ Arquivo vazio: {filename}")
-                return None
+                try:
+                    os.unlink(dbc_path)
+                except:
+                    pass
+
+    def _baixar_e_converter(self, itens, engine='native', workers=1, estagios=(), conversores=1,
+                            parcial=None):
+        """
+        Baixa e converte uma lista de arquivos (grupo, uf, ano, mes).
+
+        Os arquivos passam por um PipelineEstagios: `workers` downloads em
+        paralelo, `conversores` conversões e os `estagios` extras de quem chama
+        (nome, funcao(item, df), workers), p.ex. CNS e gravação. Enquanto um mês
+        é convertido os próximos seguem baixando; as filas limitadas seguram os
+        downloads quando a conversão fica para trás.
+
+        Gera (item, resultado) à medida que cada arquivo sai do último estágio
+        (None se o download ou algum estágio falhar). A vazão de cada estágio
+        fica em self.estatisticas_pipeline.
+
+        `parcial` é repassado à conversão de cada arquivo (ver _converter_mes).
+        """
+        def baixar(item, _):
+            grupo, uf, ano, mes = item
+            dbc_path = self.download_arquivo(grupo, uf, ano, mes)
+            if not dbc_path:
+                print(f"⏭️  Download de {uf} {ano}/{mes:02d} falhou, pulando...")
+            return dbc_path
+
+        with DBCDockerWorker() as worker:
+            def converter(item, dbc_path):
+                grupo, uf, ano, mes = item
+                return self._converter_mes(dbc_path, uf, ano, mes, grupo, engine, worker, parcial)
+
+            pipeline = PipelineEstagios([('download', baixar, workers),
+                                         ('conversão', converter, conversores),
+                                         *estagios])
+            print(f"⚡ {len(itens)} arquivos, {max(1, workers)} downloads simultâneos")
+            try:
+                yield from pipeline.executar(itens)
+            finally:
+                pipeline.imprimir_estatisticas()
+                self.estatisticas_pipeline = pipeline.estatisticas()
+
+    @staticmethod
+    def _processar_cns_mes(item, df):
+        """Estágio de CNS do pipeline: processa um mês (sem CNS, segue o DataFrame original)"""
+        df_proc, erro = processar_cns(df, verbose=False)
+        if erro:
+            grupo, uf, ano, mes = item
+            print(f"   ⚠️  CNS não processado em {grupo}{uf} {ano}/{mes:02d}: {erro}")
+            return df
+        return df_proc
+
+    def sincronizar(self, ufs, anos=None, grupo="AM", dataset_dir=None, workers=4, engine='native'):
+        """
+        Sincronização incremental com o FTP do DATASUS.
+
+        Compara a listagem do servidor com o manifesto _sync_manifest.json do
+        dataset (tamanho e data de cada arquivo já processado) e baixa, converte
+        e processa CNS apenas dos arquivos novos ou republicados. Cada arquivo
+        vira a partição grupo=/uf=/ano=/mes= do dataset e o manifesto é
+        atualizado logo em seguida, então uma execução interrompida retoma de
+        onde parou.
+
+        Returns:
+            dict: contagens de novos, alterados, inalterados, falhas e registros
+        """
+        import json
+        import re
+
+        ufs = [uf.upper() for uf in ufs]
+        dataset_dir = Path(dataset_dir or diretorio_dados() / 'SIA_dataset')
+        manifesto_path = dataset_dir / '_sync_manifest.json'
+        try:
+            manifesto = json.loads(manifesto_path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            manifesto = {}
+
+        def salvar_manifesto():
+            dataset_dir.mkdir(parents=True, exist_ok=True)
+            tmp = manifesto_path.with_name('_sync_manifest.json.tmp')
+            tmp.write_text(json.dumps(manifesto, indent=1), encoding='utf-8')
+            os.replace(tmp, manifesto_path)
+
+        print(f"\n🔄 Sincronizando {grupo} {', '.join(ufs)}")
+        print("=" * 60)
+
+        listagem = self.listar_diretorio(atualizar=True)
+        if listagem is None:
+            return None
+
+        padrao = re.compile(rf"^{grupo}({'|'.join(ufs)})(\d{{2}})(\d{{2}})\.DBC$")
+        anos = {int(a) for a in anos} if anos else None
+        resumo = {'novos': 0, 'alterados': 0, 'inalterados': 0, 'falhas': 0, 'registros': 0}
+        pendentes = {}
+
+        for chave in sorted(listagem):
+            encontrado = padrao.match(chave)
+            if not encontrado:
+                continue
+            uf, ano, mes = encontrado.group(1), 2000 + int(encontrado.group(2)), int(encontrado.group(3))
+            if anos is not None and ano not in anos:
+                continue
+
+            info = self.info_arquivo(listagem[chave]['nome'])
+            modificado = info['modificado'].isoformat() if info['modificado'] else None
+            anterior = manifesto.get(info['nome'])
+            if anterior is None:
+                resumo['novos'] += 1
+            elif (anterior['tamanho'], anterior['modificado']) != (info['tamanho'], modificado):
+                resumo['alterados'] += 1
+            else:
+                resumo['inalterados'] += 1
+                continue
+            pendentes[(grupo, uf, ano, mes)] = (info['nome'], info['tamanho'], modificado)
+
+        print(f"📋 {resumo['novos']} novos, {resumo['alterados']} alterados, "
+              f"{resumo['inalterados']} inalterados")
+
+        def gravar(item, df_proc):
+            # Um único worker: manifesto gravado sem concorrência
+            nome, tamanho, modificado = pendentes[item]
+            destino = gravar_particao(df_proc, dataset_dir, *item)
+            manifesto[nome] = {
+                'tamanho': tamanho,
+                'modificado': modificado,
+                'particao': destino.parent.relative_to(dataset_dir).as_posix(),
+                'registros': len(df_proc),
+                'processado_em': datetime.now().isoformat(timespec='seconds'),
+            }
+            salvar_manifesto()
+            return len(df_proc)
+
+        estagios = [('cns', self._processar_cns_mes, 1), ('gravação', gravar, 1)]
+        for item, registros in self._baixar_e_converter(list(pendentes), engine, workers, estagios):
+            if registros is None:
+                resumo['falhas'] += 1
+                continue
+            resumo['registros'] += registros
+        resumo['estagios'] = self.estatisticas_pipeline
+
+        print(f"\n✅ Sincronização concluída: {len(pendentes) - resumo['falhas']} arquivos processados, "
+              f"{resumo['registros']:,} registros, {resumo['falhas']} falhas")
+        return resumo
+
+    def processar_estado(self, uf, ano, grupo="AM", meses=None, engine='native', workers=1,
+                         particionado=False, dataset_dir=None, salvar=True, processar=False, compacto=False,
+                         parcial=None):
+        """
+        Processa os meses de um estado (padrão: o ano todo, 1 a 12).
+        Quando a conversão precisa do Docker, um único DBCDockerWorker atende
+        todos os meses do lote e é encerrado ao final.
 
-        except Exception as e:
-            print(f"❌ Erro FTP: {e}")
-            return None
+        Os meses passam pelo pipeline download → conversão → CNS → gravação
+        (_baixar_e_converter): com workers > 1 até `workers` meses são baixados
+        em paralelo, e cada mês segue para os próximos estágios assim que seu
+        download termina. O resultado mantém a ordem de `meses`.
 
-    def processar_estado(self, uf, ano, grupo="AM", meses=None):
-        """Processa todos os meses de um estado"""
+        Com processar=True o CNS é processado mês a mês dentro do pipeline (o
+        resultado é o mesmo de processar_cns no DataFrame consolidado).
+        Com particionado=True, em vez de um Parquet único por execução, cada mês
+        é gravado assim que processado em dataset_dir/grupo=/uf=/ano=/mes=
+        (padrão: dados/SIA_dataset), substituindo apenas as partições processadas.
+        Com salvar=False nada é gravado (quem chama exporta o resultado).
+        Com compacto=True o resultado consolidado usa o esquema compacto de
+        tipos (compactar_tipos), mantido no Parquet salvo.
+        Com `parcial`, parcial(df, total) recebe os dados antes do fim: com um
+        só mês, os registros já convertidos do DBC; com vários, os meses já
+        concluídos (total=None).
+        """
         if meses is None:
-            meses = [1]  # Apenas mês 1 para teste
+            meses = list(range(1, 13))
         
         print(f"\n🚀 Processando {uf}-{ano}")
         print("=" * 60)
         
-        dataframes = []
+        # Meses ausentes no FTP são descartados antes de qualquer download
+        disponiveis = [item['mes'] for item in self.planejar_downloads(grupo, uf, ano, meses)]
+        resultados = {}
+        estagios = []
+        if processar:
+            estagios.append(('cns', self._processar_cns_mes, 1))
+        if particionado:
+            dataset_dir = Path(dataset_dir or diretorio_dados() / 'SIA_dataset')
+
+            def gravar(item, df):
+                gravar_particao(df, dataset_dir, *item)
+                return df
+
+            estagios.append(('gravação', gravar, 1))
         
-        for mes in meses:
-            print(f"\n📅 Mês {mes:02d}")
-            
-            # 1. Download
-            dbc_path = self.download_arquivo(grupo, uf, ano, mes)
-            if not dbc_path:
-                print("⏭️  Download falhou, pulando...")
-                continue
-            
-            # 2. Converter DBC com encoding correto (latin-1 = ISO-8859-1 padrão DATASUS)
-            df = DBCConverter.read_dbc(dbc_path, encoding='latin-1')
-            
-            if df is not None and len(df) > 0:
-                # Adicionar metadados
-                df['UF'] = uf
-                df['ANO'] = ano
-                df['MES'] = mes
-                df['GRUPO'] = grupo
-                
-                dataframes.append(df)
-                print(f"✅ Convertido: {len(df):,} registros")
-            else:
-                print(f"❌ Conversão falhou ou dados vazios")
-            
-            # Limpar arquivo temporário
-            try:
-                os.unlink(dbc_path)
-            except:
-                pass
+        itens = [(grupo, uf, ano, mes) for mes in disponiveis]
+        parcial_mes = parcial if len(itens) == 1 else None
+        for (_, _, _, mes), df in self._baixar_e_converter(itens, engine, workers, estagios,
+                                                           parcial=parcial_mes):
+            resultados[mes] = df
+            if parcial is not None and parcial_mes is None and df is not None and len(resultados) < len(itens):
+                concluidos = [resultados[m] for m in meses if resultados.get(m) is not None]
+                parcial(pd.concat(concluidos, ignore_index=True, sort=False), None)
+        
+        dataframes = [resultados[mes] for mes in meses if resultados.get(mes) is not None]
         
         # Consolidar dados
         if dataframes:
             print(f"\n📊 Consolidando dados...")
-            df_final = pd.concat(dataframes, ignore_index=True, sort=False)
+            df_final = _consolidar_meses(dataframes)
+            if 'estatisticas_cns' in df_final.attrs:
+                stats = df_final.attrs['estatisticas_cns']
+                _imprimir_estatisticas_cns(stats, stats['pacientes_unicos'])
+            if compacto:
+                df_final = compactar_tipos(df_final)
             
-            # Salvar
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            output_file = Path(base_path) / f"SIA_{uf}_{ano}_{timestamp}.parquet"
-            
-            df_final.to_parquet(output_file, index=False)
+            # Salvar (no modo particionado os meses já foram gravados)
+            if particionado:
+                output_file = dataset_dir
+            elif not salvar:
+                output_file = None
+            else:
+                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                output_file = diretorio_dados() / f"SIA_{uf}_{ano}_{timestamp}.parquet"
+                df_final.to_parquet(output_file, index=False)
             
             print(f"\n🎉 PROCESSAMENTO CONCLUÍDO!")
             print(f"📊 Total registros: {len(df_final):,}")
             print(f"📋 Total colunas: {len(df_final.columns)}")
-            print(f"💾 Arquivo salvo: {output_file}")
+            if output_file is not None:
+                print(f"💾 {'Dataset' if particionado else 'Arquivo'} salvo: {output_file}")
             
             return df_final, len(df_final)
         else:
@@ -644,8 +2326,153 @@ class SIADownloader:
             return None, 0
 
 
-def carregar_arquivo(caminho):
-    """Carrega arquivo em vários formatos"""
+# Colunas de metadados de processar_estado e chaves de partição correspondentes
+PARTICOES = {'GRUPO': 'grupo', 'UF': 'uf', 'ANO': 'ano', 'MES': 'mes'}
+
+
+def gravar_particao(df, dataset_dir, grupo, uf, ano, mes):
+    """
+    Grava um mês no dataset particionado (grupo=/uf=/ano=/mes=/dados.parquet).
+
+    O arquivo é escrito ao lado e renomeado (os.replace), então leitores nunca
+    veem a partição pela metade; uma nova execução substitui só esta partição.
+    """
+    particao = Path(dataset_dir) / f"grupo={grupo}" / f"uf={uf}" / f"ano={ano}" / f"mes={int(mes):02d}"
+    particao.mkdir(parents=True, exist_ok=True)
+
+    destino = particao / 'dados.parquet'
+    tmp = particao / '.dados.parquet.tmp'
+    df.to_parquet(tmp, index=False)
+    os.replace(tmp, destino)
+
+    # Arquivos antigos da mesma partição
+    for antigo in particao.glob('*.parquet'):
+        if antigo != destino:
+            antigo.unlink()
+
+    print(f"   💾 Partição gravada: {particao.relative_to(dataset_dir)}")
+    return destino
+
+
+# Códigos com poucos valores: sempre categóricos no esquema compacto
+COLUNAS_CATEGORICAS = ('UF', 'GRUPO', 'CNS_TIPO', 'AP_SEXO', 'AP_CIDPRI', 'AP_PRIPAL', 'AP_MVM')
+
+
+def compactar_tipos(df, limite_distintos=0.5, verbose=True):
+    """
+    Aplica o esquema compacto de tipos (opcional) a um DataFrame do SIA.
+
+    - Texto (só strings; datas e booleanos object ficam como estão) em
+      COLUNAS_CATEGORICAS ou com até limite_distintos × linhas valores
+      distintos (CNS_PADRONIZADO, AP_CNSPCN, município...) vira category:
+      códigos int8/int16/int32 por linha e cada valor guardado uma vez.
+      Zeros à esquerda e 'SEM_CNS' ficam intactos.
+    - Inteiros (ANO, MES) usam o menor tipo que comporta os valores
+      (int8/int16; Int8/Int16 se houver nulos).
+    - Booleanos (CNS_VALIDO) já ocupam 1 byte por linha e ficam como estão.
+
+    O Parquet grava category como dictionary e os inteiros com a largura
+    reduzida, então o esquema volta igual ao carregar o arquivo exportado.
+    O consumo de memória por coluna, antes e depois, fica em df.attrs['memoria'].
+    """
+    colunas = {}
+    for col in df.columns:
+        serie = df[col]
+        if isinstance(serie.dtype, pd.CategoricalDtype) or pd.api.types.is_bool_dtype(serie.dtype):
+            continue
+        if pd.api.types.is_integer_dtype(serie.dtype):
+            reduzida = pd.to_numeric(serie, downcast='integer')
+            if reduzida.dtype != serie.dtype:
+                colunas[col] = reduzida
+        elif ((serie.dtype == object or pd.api.types.is_string_dtype(serie.dtype))
+              and pd.api.types.infer_dtype(serie, skipna=True) == 'string'):
+            # Só texto: datas (campos D) e booleanos com nulos (campos L) também
+            # são object, mas como category não voltam iguais do Parquet
+            if col in COLUNAS_CATEGORICAS or serie.nunique(dropna=False) <= limite_distintos * len(serie):
+                colunas[col] = serie.astype('category')
+
+    df_compacto = df.assign(**colunas)
+
+    antes = df.memory_usage(deep=True, index=False)
+    depois = df_compacto.memory_usage(deep=True, index=False)
+    df_compacto.attrs['memoria'] = {
+        col: {
+            'tipo_antes': str(df[col].dtype),
+            'tipo_depois': str(df_compacto[col].dtype),
+            'antes_bytes': int(antes[col]),
+            'depois_bytes': int(depois[col]),
+        }
+        for col in df.columns
+    }
+    if verbose:
+        _imprimir_memoria(df_compacto.attrs['memoria'])
+    return df_compacto
+
+
+def _imprimir_memoria(memoria):
+    """Imprime o relatório de memória por coluna de compactar_tipos"""
+    mb = 1024 * 1024
+    total_antes = sum(c['antes_bytes'] for c in memoria.values())
+    total_depois = sum(c['depois_bytes'] for c in memoria.values())
+
+    print(f"\n📦 MEMÓRIA POR COLUNA (antes → depois):")
+    for col, c in memoria.items():
+        reducao = 1 - c['depois_bytes'] / c['antes_bytes'] if c['antes_bytes'] else 0.0
+        print(f"   {col:<18} {c['tipo_antes']:>8} → {c['tipo_depois']:<8} "
+              f"{c['antes_bytes'] / mb:8.2f} → {c['depois_bytes'] / mb:7.2f} MB  (-{reducao:.0%})")
+    reducao = 1 - total_depois / total_antes if total_antes else 0.0
+    print(f"   {'TOTAL':<18} {'':>8}   {'':<8} "
+          f"{total_antes / mb:8.2f} → {total_depois / mb:7.2f} MB  (-{reducao:.0%})")
+
+
+# Registros do primeiro lote exibido durante um carregamento progressivo
+LINHAS_PREVIA = 50_000
+
+
+def _ler_parquet_progressivo(caminho, parcial, linhas=LINHAS_PREVIA):
+    """
+    Lê um Parquet em lotes de `linhas` registros, passando a parcial(df, total)
+    o que já foi lido: o primeiro lote assim que decodificado e depois a cada
+    4× registros, até a metade do arquivo (as conversões parciais custam no
+    máximo 2/3 da conversão final). O resultado é o mesmo de pd.read_parquet
+    (tipos, índice e attrs).
+    """
+    import json
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    arquivo = pq.ParquetFile(caminho)
+    esquema = arquivo.schema_arrow
+    total = arquivo.metadata.num_rows
+    lotes = []
+    lidos = entregues = 0
+
+    def para_pandas():
+        df = pa.Table.from_batches(lotes, schema=esquema).to_pandas()
+        atributos = (esquema.metadata or {}).get(b'PANDAS_ATTRS')
+        if atributos:
+            df.attrs = json.loads(atributos)
+        return df
+
+    for lote in arquivo.iter_batches(batch_size=linhas):
+        lotes.append(lote)
+        lidos += lote.num_rows
+        if lidos >= 4 * entregues and lidos <= total // 2:
+            parcial(para_pandas(), total)
+            entregues = lidos
+    return para_pandas()
+
+
+def carregar_arquivo(caminho, ufs=None, meses=None, compacto=False, parcial=None):
+    """
+    Carrega arquivo em vários formatos.
+    Um diretório é lido como dataset Parquet particionado (grupo=/uf=/ano=/mes=);
+    `ufs` e `meses` restringem as partições lidas.
+    Com compacto=True aplica o esquema compacto de tipos (compactar_tipos).
+    Com `parcial`, Parquet e DBC são lidos em lotes e parcial(df, total)
+    recebe os registros já lidos (sem o esquema compacto) enquanto a leitura
+    continua; os demais formatos são lidos de uma vez.
+    """
     try:
         caminho = Path(caminho)
         if not caminho.exists():
@@ -654,8 +2481,22 @@ def carregar_arquivo(caminho):
         extensao = caminho.suffix.lower()
         print(f"📂 Carregando: {caminho.name}")
         
-        if extensao == '.parquet':
-            df = pd.read_parquet(caminho)
+        if caminho.is_dir():
+            filtros = []
+            if ufs:
+                filtros.append(('uf', 'in', list(ufs)))
+            if meses:
+                filtros.append(('mes', 'in', [int(m) for m in meses]))
+            df = pd.read_parquet(caminho, filters=filtros or None)
+            if len(df) == 0:
+                return None, "Nenhuma partição encontrada para o filtro"
+            # As chaves de partição repetem as colunas UF/ANO/MES/GRUPO dos arquivos
+            df = df.drop(columns=[p for c, p in PARTICOES.items() if c in df.columns and p in df.columns])
+        elif extensao == '.parquet':
+            if parcial is not None:
+                df = _ler_parquet_progressivo(caminho, parcial)
+            else:
+                df = pd.read_parquet(caminho)
         elif extensao == '.csv':
             # Tentar diferentes encodings
             encodings = ['latin-1', 'iso-8859-1', 'cp1252', 'utf-8']
@@ -681,12 +2522,15 @@ def carregar_arquivo(caminho):
                 
         elif extensao == '.dbc':
             # Converter DBC com encoding correto
-            df = DBCConverter.read_dbc(str(caminho), encoding='latin-1')
+            df = DBCConverter.read_dbc(str(caminho), encoding='latin-1', parcial=parcial)
             if df is None or len(df) == 0:
                 return None, "Não foi possível converter o DBC"
         else:
             return None, f"Formato não suportado: {extensao}"
         
+        if compacto:
+            df = compactar_tipos(df)
+        
         print(f"📊 Carregado: {len(df):,} registros, {len(df.columns)} colunas")
         return df, None
         
@@ -733,187 +2577,997 @@ def validar_cns(cns):
             dv = 11 - resto
             cns_calculado = pis + "001" + str(dv)
         else:
-            cns_calculado = pis + "000" + str(dv)
+            cns_calculado = pis + "000" + str(dv)
+
+        valido = (cns_limpo == cns_calculado)
+        return valido, 'definitivo' if valido else 'invalido'
+
+    # CNS Provisório: inicia com 7, 8 ou 9
+    elif primeiro_digito in ['7', '8', '9']:
+        # Algoritmo para CNS provisório
+        soma = sum(int(cns_limpo[i]) * (15 - i) for i in range(15))
+        resto = soma % 11
+        valido = (resto == 0)
+        return valido, 'provisorio' if valido else 'invalido'
+
+    # Primeiro dígito inválido
+    return False, 'invalido'
+
+
+def _codigo_cns_digitos(d):
+    """
+    Dígitos verificadores de CNS de 15 dígitos já em matriz N×15 (uint8, 0-9).
+
+    Returns:
+        np.ndarray int8: 0 inválido, 1 definitivo, 2 provisório
+    """
+    pesos = np.arange(15, 0, -1, dtype=np.int64)
+    primeiro = d[:, 0]
+
+    # Definitivo (1 ou 2): PIS de 11 dígitos + "000"/"001" + DV
+    soma = d[:, :11] @ pesos[:11]
+    dv = 11 - soma % 11
+    ajuste = dv == 10
+    dv = np.where(ajuste, 11 - (soma + 2) % 11, np.where(dv == 11, 0, dv))
+    ok_def = ((d[:, 11] == 0) & (d[:, 12] == 0) & (d[:, 13] == ajuste)
+              & (dv < 10) & (d[:, 14] == dv))
+    definitivo = ((primeiro == 1) | (primeiro == 2)) & ok_def
+
+    # Provisório (7, 8 ou 9): soma ponderada 15..1 múltipla de 11
+    provisorio = (primeiro >= 7) & (primeiro <= 9) & ((d @ pesos) % 11 == 0)
+
+    return np.where(definitivo, 1, np.where(provisorio, 2, 0)).astype(np.int8)
+
+
+# Valores de CNS_TIPO (o índice é o código usado internamente)
+TIPOS_CNS = ('invalido', 'definitivo', 'provisorio', 'sem_cns')
+
+
+def _texto_arrow(valores):
+    """
+    Valores distintos de uma coluna como pyarrow string, equivalente ao
+    .astype(str) + fillna(''): texto passa direto (sem objetos Python), outros
+    tipos via str() e nulos viram ''.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    serie = pd.Series(valores)
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        serie = serie.astype(object)
+    if pd.api.types.infer_dtype(serie, skipna=True) not in ('string', 'empty'):
+        serie = serie.astype(str)
+    texto = pa.array(serie, type=pa.string(), from_pandas=True)
+    if isinstance(texto, pa.ChunkedArray):   # string[pyarrow] pode vir em blocos
+        texto = texto.combine_chunks()
+    return pc.fill_null(texto, '')
+
+
+def _padronizar_cns_arrow(texto):
+    """
+    Padroniza CNS: só dígitos ASCII; vazio → 'SEM_CNS'; senão zeros à esquerda
+    até 15 dígitos ou os 15 primeiros se maior (só zeros → '000000000000000').
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    limpo = pc.replace_substring_regex(texto, pattern='[^0-9]', replacement='')
+    padronizado = pc.utf8_slice_codeunits(pc.utf8_lpad(limpo, width=15, padding='0'), 0, 15)
+    return pc.if_else(pc.equal(pc.utf8_length(limpo), 0), pa.scalar('SEM_CNS'), padronizado)
+
+
+def _padronizar_municipio_arrow(texto):
+    """Código de município: 6 primeiros dígitos ASCII com zeros à esquerda; sem dígitos → '000000'"""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    limpo = pc.utf8_slice_codeunits(pc.replace_substring_regex(texto, pattern='[^0-9]', replacement=''), 0, 6)
+    return pc.if_else(pc.equal(pc.utf8_length(limpo), 0), pa.scalar('000000'),
+                      pc.utf8_lpad(limpo, width=6, padding='0'))
+
+
+def _fatorar_arrow(arr):
+    """Como pd.factorize para um pyarrow StringArray: (códigos np.ndarray, valores únicos pyarrow)"""
+    import pyarrow.compute as pc
+
+    codificado = pc.dictionary_encode(arr)
+    return codificado.indices.to_numpy(zero_copy_only=False), codificado.dictionary
+
+
+def _digitos_arrow(arr):
+    """Matriz N×15 (uint8, 0-9) de um pyarrow StringArray só com CNS de 15 dígitos ASCII"""
+    _, offsets, dados = arr.buffers()
+    inicio = int(np.frombuffer(offsets, dtype=np.int32)[arr.offset])
+    bytes_ = np.frombuffer(dados, dtype=np.uint8, count=len(arr) * 15, offset=inicio)
+    return (bytes_ - 0x30).reshape(len(arr), 15)
+
+
+def _estatisticas_cns(df_proc):
+    """Contagens de CNS de um DataFrame processado (somáveis entre lotes)"""
+    return {
+        'total': len(df_proc),
+        'sem_cns': int((df_proc['CNS_PADRONIZADO'] == 'SEM_CNS').sum()),
+        'validos': int(df_proc['CNS_VALIDO'].sum()),
+        'definitivos': int((df_proc['CNS_TIPO'] == 'definitivo').sum()),
+        'provisorios': int((df_proc['CNS_TIPO'] == 'provisorio').sum()),
+        'invalidos': int((df_proc['CNS_TIPO'] == 'invalido').sum()),
+    }
+
+
+def _imprimir_estatisticas_cns(stats, unicos):
+    """Imprime as estatísticas de processamento e validação CNS"""
+    total = stats['total']
+    sem_cns = stats['sem_cns']
+
+    print(f"\n📊 ESTATÍSTICAS:")
+    print(f"   📈 Registros: {total:,}")
+    print(f"   👥 Pacientes únicos: {unicos:,}")
+    print(f"   ✅ Com CNS: {total - sem_cns:,}")
+    print(f"   ❌ Sem CNS: {sem_cns:,}")
+    if 'cns_distintos' in stats:
+        print(f"   🔁 CNS distintos: {stats['cns_distintos']:,} "
+              f"({stats['razao_deduplicacao']:.1f} registros por CNS)")
+    print(f"\n🔍 VALIDAÇÃO CNS:")
+    print(f"   ✅ Válidos: {stats['validos']:,}")
+    print(f"   📗 Definitivos: {stats['definitivos']:,}")
+    print(f"   📙 Provisórios: {stats['provisorios']:,}")
+    print(f"   ❌ Inválidos: {stats['invalidos']:,}")
+
+
+def _consolidar_meses(dataframes):
+    """
+    Junta os meses de processar_estado. Se todos vieram com CNS processado,
+    refaz as estatísticas do conjunto (pacientes se repetem entre os meses).
+    """
+    df_final = pd.concat(dataframes, ignore_index=True, sort=False)
+    df_final.attrs.pop('estatisticas_cns', None)
+
+    if all('ID_PACIENTE' in df.columns for df in dataframes):
+        stats = _estatisticas_cns(df_final)
+        stats['pacientes_unicos'] = int(df_final['ID_PACIENTE'].nunique())
+        stats['cns_distintos'] = int(df_final['CNS_PADRONIZADO'].nunique())
+        stats['razao_deduplicacao'] = len(df_final) / stats['cns_distintos'] if stats['cns_distintos'] else 0.0
+        df_final.attrs['estatisticas_cns'] = stats
+    return df_final
+
+
+def processar_cns_lotes(lotes):
+    """
+    Processa CNS lote a lote (ex.: DBCConverter.iter_batches), sem juntar o arquivo.
+    As estatísticas são acumuladas e impressas ao final.
+
+    Yields:
+        pd.DataFrame: cada lote processado
+    """
+    print("🔍 Processando CNS em lotes...")
+
+    acumulado = None
+    pacientes = set()
+
+    for lote in lotes:
+        df_proc, erro = processar_cns(lote, verbose=False)
+        if erro:
+            raise ValueError(erro)
+
+        stats = _estatisticas_cns(df_proc)
+        if acumulado is None:
+            acumulado = stats
+        else:
+            for chave, valor in stats.items():
+                acumulado[chave] += valor
+        pacientes.update(df_proc['ID_PACIENTE'].unique())
+
+        yield df_proc
+
+    if acumulado is not None:
+        _imprimir_estatisticas_cns(acumulado, len(pacientes))
+
+
+def anexar_colunas(df, derivadas):
+    """
+    Anexa colunas derivadas (ex.: processar_cns(somente_derivadas=True)) a um
+    DataFrame sem copiar as colunas originais: o resultado é uma cópia rasa
+    que compartilha os dados de `df`, mais as colunas de `derivadas`.
+    Sem copy-on-write (pandas < 3), alterar no lugar uma coluna original do
+    resultado altera também `df`.
+    """
+    resultado = df.copy(deep=False)
+    for col in derivadas.columns:
+        resultado[col] = derivadas[col]
+    resultado.attrs.update(derivadas.attrs)
+    return resultado
+
+
+def processar_cns(df, verbose=True, somente_derivadas=False, compacto=False):
+    """
+    Processa CNS e cria ID único.
+    Com verbose=False não imprime diagnóstico nem estatísticas (uso por lotes).
+
+    O DataFrame de entrada não é copiado: o resultado compartilha as colunas
+    originais de `df` (veja anexar_colunas) e só CNS_PADRONIZADO, CNS_VALIDO,
+    CNS_TIPO e ID_PACIENTE ocupam memória nova. Com somente_derivadas=True
+    retorna apenas essas quatro colunas (mesmo índice de `df`), para anexar
+    depois com anexar_colunas(). Com compacto=True as colunas de texto
+    derivadas já saem como category, montadas direto dos códigos da
+    fatoração, sem materializar uma string por linha.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    try:
+        if verbose:
+            print("🔍 Processando CNS...")
+        
+        # DIAGNÓSTICO
+        if verbose:
+            print(f"📋 Colunas disponíveis ({len(df.columns)}):")
+            for i, col in enumerate(df.columns[:20]):
+                print(f"  {i+1:2d}. {col}")
+        
+        # Procurar coluna CNS
+        coluna_cns = None
+        for col in df.columns:
+            col_upper = str(col).upper()
+            if any(pattern in col_upper for pattern in ['CNS', 'CNSPCN', 'AP_CNS']):
+                coluna_cns = col
+                break
+        
+        if not coluna_cns:
+            return None, "Coluna CNS não encontrada"
+        
+        # Procurar coluna município
+        coluna_mun = None
+        for col in df.columns:
+            col_upper = str(col).upper()
+            if any(pattern in col_upper for pattern in ['MUN', 'MUNIC', 'COD_MUN']):
+                coluna_mun = col
+                break
+        
+        if verbose:
+            print(f"✅ CNS: {coluna_cns}, Município: {coluna_mun or '000000 (sem coluna)'}")
+        
+        # Pacientes se repetem mês a mês: limpar, padronizar e validar apenas
+        # os valores distintos e replicar o resultado para as linhas pelos códigos.
+        # Limpeza, padding e concatenação rodam em kernels do pyarrow.compute.
+        codigos_cns, distintos_cns = pd.factorize(df[coluna_cns], use_na_sentinel=False)
+
+        # LIMPAR E PADRONIZAR CNS (15 dígitos, zeros à esquerda preservados)
+        texto_cns = _texto_arrow(distintos_cns)
+        codigos_pad, cns_unicos = _fatorar_arrow(_padronizar_cns_arrow(texto_cns))
+
+        # VALIDAR CNS (cada CNS padronizado uma vez)
+        if verbose:
+            print("🔍 Validando CNS...")
+        sem_cns = pc.is_in(cns_unicos, value_set=pa.array(['SEM_CNS', '000000000000000']))
+        tipo_unico = np.full(len(cns_unicos), TIPOS_CNS.index('sem_cns'), dtype=np.int8)
+        validar = np.flatnonzero(~sem_cns.to_numpy(zero_copy_only=False))
+        if len(validar):
+            tipo_unico[validar] = _codigo_cns_digitos(_digitos_arrow(cns_unicos.take(pa.array(validar))))
+        tipo_linha = tipo_unico[codigos_pad][codigos_cns]
+
+        # PROCESSAR MUNICÍPIO (sem coluna: todos os registros em '000000')
+        if coluna_mun:
+            codigos_mun, distintos_mun = pd.factorize(df[coluna_mun], use_na_sentinel=False)
+        else:
+            codigos_mun = np.zeros(len(df), dtype=np.intp)
+            distintos_mun = np.array(['000000'], dtype=object)
+        codigos_mun_pad, mun_unicos = _fatorar_arrow(_padronizar_municipio_arrow(_texto_arrow(distintos_mun)))
+        
+        # CRIAR ID ÚNICO (um por par município/CNS distinto)
+        n_cns = max(len(cns_unicos), 1)
+        chave = codigos_mun_pad[codigos_mun].astype(np.int64) * n_cns + codigos_pad[codigos_cns]
+        codigos_id, chaves_unicas = pd.factorize(chave)
+        ids = pc.binary_join_element_wise(mun_unicos.take(pa.array(chaves_unicas // n_cns)),
+                                          cns_unicos.take(pa.array(chaves_unicas % n_cns)), '_')
+        
+        # Só as colunas derivadas são alocadas; as originais são compartilhadas com df
+        if compacto:
+            derivadas = {
+                'CNS_PADRONIZADO': pd.Categorical.from_codes(codigos_pad[codigos_cns], cns_unicos.to_pandas()),
+                'CNS_VALIDO': (tipo_linha == 1) | (tipo_linha == 2),
+                'CNS_TIPO': pd.Categorical.from_codes(tipo_linha, TIPOS_CNS),
+                'ID_PACIENTE': pd.Categorical.from_codes(codigos_id, ids.to_pandas()),
+            }
+        else:
+            derivadas = {
+                'CNS_PADRONIZADO': cns_unicos.take(pa.array(codigos_pad[codigos_cns])).to_pandas().values,
+                'CNS_VALIDO': (tipo_linha == 1) | (tipo_linha == 2),
+                'CNS_TIPO': pa.array(TIPOS_CNS).take(pa.array(tipo_linha)).to_pandas().values,
+                'ID_PACIENTE': ids.take(pa.array(codigos_id)).to_pandas().values,
+            }
+        if somente_derivadas:
+            df_proc = pd.DataFrame(derivadas, index=df.index, copy=False)
+        else:
+            df_proc = df.copy(deep=False)
+            for col, valores in derivadas.items():
+                df_proc[col] = valores
+        del derivadas
+        
+        # ESTATÍSTICAS (contadas pelos códigos, sem comparar strings por linha)
+        por_tipo = np.bincount(tipo_linha, minlength=len(TIPOS_CNS))
+        linhas_por_cns = np.bincount(codigos_pad[codigos_cns], minlength=len(cns_unicos))
+        sem_literal = pc.equal(cns_unicos, 'SEM_CNS').to_numpy(zero_copy_only=False)
+        stats = {
+            'total': len(df_proc),
+            'sem_cns': int(linhas_por_cns[sem_literal].sum()),
+            'validos': int(por_tipo[1] + por_tipo[2]),
+            'definitivos': int(por_tipo[1]),
+            'provisorios': int(por_tipo[2]),
+            'invalidos': int(por_tipo[0]),
+        }
+        stats['pacientes_unicos'] = len(chaves_unicas)
+        stats['cns_distintos'] = len(cns_unicos)
+        stats['razao_deduplicacao'] = len(df_proc) / len(cns_unicos) if len(cns_unicos) else 0.0
+        df_proc.attrs['estatisticas_cns'] = stats
+        if verbose:
+            _imprimir_estatisticas_cns(stats, stats['pacientes_unicos'])
+        
+        return df_proc, None
+        
+    except Exception as e:
+        print(f"❌ Erro no processamento: {e}")
+        traceback.print_exc()
+        return None, f"Erro: {str(e)}"
+
+
+# Linhas por lote na exportação (no Parquet, um row group por lote)
+LINHAS_LOTE_EXPORTACAO = 250_000
+
+
+def _lotes_dataframe(df, linhas):
+    """Fatias de `linhas` registros de um DataFrame (views, sem cópia); DataFrame vazio sai inteiro"""
+    if len(df) == 0:
+        yield df
+    for inicio in range(0, len(df), linhas):
+        yield df.iloc[inicio:inicio + linhas]
+
+
+def _conversor_arrow():
+    """
+    Função lote → pyarrow.Table com esquema fixo: o esquema vem do primeiro
+    lote (coluna object toda nula nele vira texto) e os seguintes são
+    convertidos para ele. Os campos N/F/D/L de iter_batches já têm dtype
+    fixo pelo cabeçalho (float64, date32, boolean), vazios ou não.
+    """
+    import json
+    import pyarrow as pa
+
+    esquema = None
+
+    def converter(lote):
+        nonlocal esquema
+        if esquema is None:
+            esquema = pa.Schema.from_pandas(lote, preserve_index=False)
+            for i, campo in enumerate(esquema):
+                if pa.types.is_null(campo.type):
+                    esquema = esquema.set(i, pa.field(campo.name, pa.string()))
+            if lote.attrs:
+                # Como o DataFrame.to_parquet: attrs voltam no read_parquet
+                esquema = esquema.with_metadata({**(esquema.metadata or {}),
+                                                 b'PANDAS_ATTRS': json.dumps(lote.attrs, default=str)})
+        tabela = pa.Table.from_pandas(lote, schema=esquema, preserve_index=False)
+        return tabela.replace_schema_metadata(esquema.metadata)
+
+    return converter
+
+
+def _tabelas_arrow(lotes):
+    """
+    Converte os lotes para tabelas Arrow numa thread enquanto o chamador grava
+    a anterior: no máximo dois lotes convertidos existem ao mesmo tempo (o que
+    está sendo gravado e o próximo).
+
+    Yields:
+        tuple: (pyarrow.Table, registros do lote)
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    lotes = iter(lotes)
+    converter = _conversor_arrow()
+
+    def proximo_lote():
+        lote = next(lotes, None)
+        if lote is None:
+            return None
+        return converter(lote), len(lote)
+
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="exportacao") as conversor:
+        proximo = conversor.submit(proximo_lote)
+        while True:
+            pronto = proximo.result()
+            if pronto is None:
+                return
+            proximo = conversor.submit(proximo_lote)
+            yield pronto
+
+
+# Compressões aceitas no CSV/TXT e a extensão acrescentada ao arquivo
+COMPRESSOES_TEXTO = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+def _dados_texto(pedaco):
+    """Buffer de dados de um pedaço large_string e o intervalo (início, fim) que seus valores ocupam"""
+    _, offsets, dados = pedaco.buffers()
+    inicio, = struct.unpack_from('<q', offsets, 8 * pedaco.offset)
+    fim, = struct.unpack_from('<q', offsets, 8 * (pedaco.offset + len(pedaco)))
+    return dados, inicio, fim
+
+
+def _tem_caracteres_especiais(texto, caracteres):
+    """Se algum byte dos valores da coluna large_string está em `caracteres` (busca direto no buffer)"""
+    for pedaco in texto.chunks:
+        dados, inicio, fim = _dados_texto(pedaco)
+        if fim > inicio:
+            valores = np.frombuffer(dados, dtype=np.uint8)[inicio:fim]
+            if any((valores == ord(c)).any() for c in caracteres):
+                return True
+    return False
+
+
+def _formatar_coluna_texto(coluna, separador):
+    """
+    Coluna Arrow → large_string com os valores como o DataFrame.to_csv os
+    escreve: booleanos True/False, floats com '.0' e expoente de dois dígitos
+    (1e-07), datas sem a hora quando todas do lote caem à meia-noite, segundos
+    fracionários só com os dígitos necessários, e aspas apenas nos textos com
+    separador, aspas ou quebra de linha. Nulos continuam nulos (campo vazio).
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    tipo = coluna.type
+    if pa.types.is_dictionary(tipo):
+        coluna = coluna.cast(tipo.value_type)
+        tipo = coluna.type
+    if pa.types.is_boolean(tipo):
+        return pc.if_else(coluna, 'True', 'False').cast(pa.large_string())
+    if pa.types.is_floating(tipo):
+        texto = coluna.cast(pa.large_string())
+        texto = pc.replace_substring_regex(texto, r'^(-?\d+)$', r'\1.0')
+        return pc.replace_substring_regex(texto, r'e([+-])(\d)$', r'e\10\2')
+    if pa.types.is_timestamp(tipo):
+        local = pc.local_timestamp(coluna) if tipo.tz else coluna
+        if not tipo.tz and pc.all(pc.equal(local, pc.floor_temporal(local, unit='day'))).as_py() is not False:
+            return pc.strftime(local, format='%Y-%m-%d').cast(pa.large_string())
+        segundo = pc.floor_temporal(local, unit='second')
+        texto = pc.strftime(segundo.cast(pa.timestamp('s')), format='%Y-%m-%d %H:%M:%S')
+        # Parte fracionária com 3, 6 ou 9 dígitos, os mínimos que representam o lote
+        digitos = {'s': 0, 'ms': 3, 'us': 6, 'ns': 9}[tipo.unit]
+        fracao = pc.subtract(local.cast(pa.int64()), segundo.cast(pa.int64()))
+        while digitos and pc.all(pc.equal(pc.multiply(pc.divide(fracao, 1000), 1000), fracao)).as_py() is not False:
+            fracao = pc.divide(fracao, 1000)
+            digitos -= 3
+        if digitos:
+            fracao = pc.utf8_lpad(fracao.cast(pa.string()), width=digitos, padding='0')
+            texto = pc.binary_join_element_wise(texto, fracao, '.')
+        if tipo.tz:
+            # Deslocamento como o pandas: -03:00
+            deslocamento = pc.replace_substring_regex(pc.strftime(coluna, format='%z'), r'(\d\d)$', r':\1')
+            texto = pc.binary_join_element_wise(texto, deslocamento, '')
+        return texto.cast(pa.large_string())
+    texto = coluna.cast(pa.large_string())
+    if ((pa.types.is_string(tipo) or pa.types.is_large_string(tipo))
+            and _tem_caracteres_especiais(texto, separador + '"\r\n')):
+        especiais = pc.match_substring_regex(texto, f'[{separador}"\r\n]')
+        if pc.any(especiais).as_py():
+            aspas, vazio = pa.scalar('"', pa.large_string()), pa.scalar('', pa.large_string())
+            citado = pc.binary_join_element_wise(aspas, pc.replace_substring(texto, '"', '""'), aspas, vazio)
+            texto = pc.if_else(especiais, citado, texto)
+    return texto
+
+
+class _ArquivoTexto:
+    """
+    Arquivo CSV (';' com BOM UTF-8) ou TXT (tab, UTF-8) no formato do
+    DataFrame.to_csv, opcionalmente comprimido em gzip/zstd. As colunas são
+    formatadas e unidas em linhas por funções do Arrow (C++, sem o GIL), e o
+    buffer resultante vai direto para o arquivo, então vários arquivos gravam
+    em paralelo.
+    """
+
+    def __init__(self, arquivo, formato, compressao=None):
+        import pyarrow as pa
+
+        self.arquivo = arquivo
+        self.registros = 0
+        self._separador = ';' if formato == 'CSV' else '\t'
+        self._gzip = None
+        if compressao == 'gzip':
+            import gzip
+            # gzip do zlib no nível 6: o do Arrow usa o nível 9, ~2x mais lento
+            # para arquivos <1% menores. mtime=0 deixa o SHA-256 reproduzível.
+            self._destino = open(arquivo, 'wb')
+            self._gzip = gzip.GzipFile(fileobj=self._destino, mode='wb', compresslevel=6, mtime=0)
+            self._saida = pa.PythonFile(self._gzip, mode='w')
+        else:
+            self._destino = pa.OSFile(str(arquivo), 'wb')
+            self._saida = pa.CompressedOutputStream(self._destino, compressao) if compressao else self._destino
+        # BOM UTF-8 no CSV para o Excel reconhecer a codificação
+        self._saida.write(b'\xef\xbb\xbf' if formato == 'CSV' else b'')
+        self._cabecalho = False
+
+    @property
+    def bytes(self):
+        """Bytes já gravados em disco (comprimidos, se for o caso)"""
+        return self._destino.tell()
+
+    def escrever(self, tabela):
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        if not self._cabecalho:
+            especiais = set(self._separador + '"\r\n')
+            nomes = ['"' + n.replace('"', '""') + '"' if especiais & set(n) else n
+                     for n in map(str, tabela.column_names)]
+            self._saida.write((self._separador.join(nomes) + '\n').encode('utf-8'))
+            self._cabecalho = True
+        if tabela.num_rows and tabela.num_columns:
+            colunas = [_formatar_coluna_texto(c, self._separador) for c in tabela.columns]
+            separador, fim_linha = pa.scalar(self._separador, pa.large_string()), pa.scalar('\n', pa.large_string())
+            linhas = pc.binary_join_element_wise(*colunas, separador, null_handling='replace')
+            linhas = pc.binary_join_element_wise(linhas, pa.scalar('', pa.large_string()), fim_linha)
+            for pedaco in linhas.chunks:
+                # Os textos das linhas ficam contíguos no buffer de dados do Arrow
+                dados, inicio, fim = _dados_texto(pedaco)
+                self._saida.write(dados[inicio:fim])
+        self.registros += tabela.num_rows
+
+    def fechar(self):
+        self._saida.close()   # CompressedOutputStream fecha também o arquivo por baixo
+        if self._gzip is not None:
+            self._gzip.close()
+        if not self._destino.closed:
+            self._destino.close()
+
+
+class _MedidorExportacao:
+    """Registros/s e bytes/s da exportação, repassados a `progresso` a cada lote"""
+
+    def __init__(self, total=None, progresso=None, intervalo=2.0):
+        import time
+
+        self._time = time
+        self.total = total
+        self.progresso = progresso
+        self.intervalo = intervalo
+        self.inicio = time.monotonic()
+        self._ultimo_print = self.inicio
+        self.registros = 0
+        self.bytes = 0
+        self.lotes = 0
+
+    def info(self):
+        segundos = max(self._time.monotonic() - self.inicio, 1e-9)
+        return {'registros': self.registros, 'total': self.total, 'bytes': self.bytes,
+                'lotes': self.lotes, 'segundos': round(segundos, 3),
+                'registros_s': round(self.registros / segundos, 1),
+                'mb_s': round(self.bytes / (1024 * 1024) / segundos, 3)}
+
+    def lote(self, registros, bytes_total):
+        self.registros += registros
+        self.bytes = bytes_total
+        self.lotes += 1
+        info = self.info()
+        if self.progresso is not None:
+            self.progresso(info)
+        agora = self._time.monotonic()
+        if agora - self._ultimo_print >= self.intervalo:
+            self._ultimo_print = agora
+            total = f"/{self.total:,}" if self.total else ""
+            volume = f", {info['mb_s']:.2f} MB/s" if self.bytes else ""
+            print(f"   📤 {info['registros']:,}{total} registros "
+                  f"({info['registros_s']:,.0f} registros/s{volume})")
+
+    def resumo(self):
+        info = self.info()
+        volume = f", {info['mb_s']:.2f} MB/s" if self.bytes else ""
+        return (f"{info['lotes']} lote{'s' if info['lotes'] != 1 else ''}, "
+                f"{info['registros_s']:,.0f} registros/s{volume}")
+
+
+def _exportar_lotes(lotes, caminho, formato, timestamp, total=None, progresso=None,
+                    compressao=None, linhas_grupo=None):
+    """
+    Exporta um iterável de DataFrames escrevendo lote a lote (CSV, TXT ou Parquet).
+
+    CSV/TXT saem no formato do DataFrame.to_csv (';' com BOM UTF-8 / tab em UTF-8),
+    comprimidos em gzip/zstd se `compressao` for informada (.csv.gz, .csv.zst),
+    e Parquet pelo ParquetWriter com o codec `compressao` e row groups de até
+    `linhas_grupo` linhas. A conversão do próximo lote para Arrow roda em
+    paralelo à gravação do atual.
+
+    Returns:
+        tuple: (caminho do arquivo, registros exportados)
+    """
+    exts = {'CSV': '.csv', 'Parquet': '.parquet', 'TXT': '.txt'}
+    arquivo = caminho.with_name(f"{caminho.stem}_{timestamp}{exts[formato]}")
+    registros = 0
+
+    if formato in ('CSV', 'TXT'):
+        arquivo = arquivo.with_name(arquivo.name + COMPRESSOES_TEXTO.get(compressao, ''))
+        medidor = _MedidorExportacao(total, progresso)
+        saida = _ArquivoTexto(arquivo, formato, compressao)
+        try:
+            for tabela, n in _tabelas_arrow(lotes):
+                saida.escrever(tabela)
+                registros += n
+                medidor.lote(n, saida.bytes)
+        finally:
+            saida.fechar()
+        medidor.bytes = arquivo.stat().st_size
+        codificacao = "UTF-8-BOM" if formato == 'CSV' else "UTF-8"
+        extra = f", {compressao}" if compressao else ""
+        print(f"   💾 Arquivo {formato} salvo com encoding {codificacao}{extra} ({medidor.resumo()})")
+
+    elif formato == 'Parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        medidor = _MedidorExportacao(total, progresso)
+        writer = None
+        with pa.OSFile(str(arquivo), 'wb') as destino:
+            try:
+                for tabela, n in _tabelas_arrow(lotes):
+                    if writer is None:
+                        writer = pq.ParquetWriter(destino, tabela.schema, compression=compressao)
+                    writer.write_table(tabela, row_group_size=linhas_grupo)
+                    registros += n
+                    medidor.lote(n, destino.tell())
+            finally:
+                if writer is not None:
+                    writer.close()
+        if writer is None:
+            pd.DataFrame().to_parquet(arquivo, index=False, engine='pyarrow')
+        print(f"   💾 Arquivo Parquet salvo com compressão {compressao or 'nenhuma'} ({medidor.resumo()})")
+
+    return arquivo, registros
+
+
+# Excel: 1.048.576 linhas por planilha, uma delas o cabeçalho
+LINHAS_EXCEL = 1_048_575
+
+
+def _rotulo_parte(texto, limite=31):
+    """Nome válido de planilha/arquivo: sem []:*?/\\ e com no máximo `limite` caracteres"""
+    for caractere in '[]:*?/\\':
+        texto = texto.replace(caractere, '-')
+    return texto[:limite]
+
+
+def _exportar_excel(lotes, caminho, timestamp, total=None, progresso=None, dividir_por=None,
+                    limite_linhas=None, destino='planilhas'):
+    """
+    Exporta para Excel com planilhas write-only do openpyxl: as linhas vão
+    direto para arquivos temporários, então a memória não cresce com o número
+    de registros. Cada parte (cada valor da coluna `dividir_por`, ou o
+    dataset inteiro) ocupa quantas planilhas forem necessárias para caber em
+    `limite_linhas` linhas cada; com destino='arquivos' cada planilha vira um
+    arquivo .xlsx.
+
+    Returns:
+        tuple: (lista de arquivos, registros exportados)
+    """
+    from openpyxl import Workbook
+
+    if destino not in ('planilhas', 'arquivos'):
+        raise ValueError(f"Destino inválido: {destino}")
+    limite = min(limite_linhas or LINHAS_EXCEL, LINHAS_EXCEL)
+    medidor = _MedidorExportacao(total, progresso)
+    livros = {}       # arquivo → Workbook ainda não salvo
+    salvos = []
+    partes = {}       # valor de dividir_por → [planilha, arquivo, linhas na planilha, número]
+    colunas = None
+    registros = 0
+    planilhas = 0
+
+    def nome_arquivo(sufixo):
+        if sufixo is None:
+            return caminho.with_name(f"{caminho.stem}_{timestamp}.xlsx")
+        return caminho.with_name(f"{caminho.stem}_{timestamp}_{_rotulo_parte(sufixo, 100)}.xlsx")
+
+    def salvar(arquivo):
+        livros.pop(arquivo).save(arquivo)
+        salvos.append(arquivo)
+
+    def nova_planilha(valor, numero, rotulo=None):
+        nonlocal planilhas
+        planilhas += 1
+        if rotulo is None:
+            rotulo = 'Dados' if dividir_por is None else f"{dividir_por}_{valor}"
+        if destino == 'arquivos':
+            sufixo = f"parte{numero}" if rotulo == 'Dados' else rotulo + (f"_{numero}" if numero > 1 else "")
+            arquivo, titulo = nome_arquivo(sufixo), 'Dados'
+        else:
+            arquivo, titulo = nome_arquivo(None), rotulo + (f"_{numero}" if numero > 1 else "")
+        if arquivo not in livros:
+            livros[arquivo] = Workbook(write_only=True)
+        planilha = livros[arquivo].create_sheet(_rotulo_parte(titulo))
+        planilha.append(colunas)
+        return [planilha, arquivo, 0, numero]
 
-        valido = (cns_limpo == cns_calculado)
-        return valido, 'definitivo' if valido else 'invalido'
+    def gravar(valor, parte):
+        nonlocal registros
+        # Colunas como objetos Python (NA → célula vazia), linha a linha para a planilha
+        valores = [parte[c].to_numpy(dtype=object, na_value=None) for c in parte.columns]
+        inicio = 0
+        while inicio < len(parte):
+            atual = partes.get(valor)
+            if atual is None or atual[2] >= limite:
+                numero = 1
+                if atual is not None:
+                    numero = atual[3] + 1
+                    if destino == 'arquivos':
+                        salvar(atual[1])   # arquivo cheio: libera antes de abrir o próximo
+                atual = partes[valor] = nova_planilha(valor, numero)
+            fim = min(len(parte), inicio + limite - atual[2])
+            planilha = atual[0]
+            for linha in zip(*[v[inicio:fim] for v in valores]):
+                planilha.append(linha)
+            atual[2] += fim - inicio
+            registros += fim - inicio
+            inicio = fim
 
-    # CNS Provisório: inicia com 7, 8 ou 9
-    elif primeiro_digito in ['7', '8', '9']:
-        # Algoritmo para CNS provisório
-        soma = sum(int(cns_limpo[i]) * (15 - i) for i in range(15))
-        resto = soma % 11
-        valido = (resto == 0)
-        return valido, 'provisorio' if valido else 'invalido'
+    for lote in lotes:
+        if colunas is None:
+            colunas = [str(c) for c in lote.columns]
+            if dividir_por is not None and dividir_por not in lote.columns:
+                raise ValueError(f"Coluna para dividir inexistente: {dividir_por}")
+        if dividir_por is None:
+            gravar(None, lote)
+        else:
+            for valor, parte in lote.groupby(dividir_por, sort=False, observed=True, dropna=False):
+                gravar(valor, parte)
+        medidor.lote(len(lote), 0)
 
-    # Primeiro dígito inválido
-    return False, 'invalido'
+    if not livros and not salvos:
+        # Sem registros: uma planilha só com o cabeçalho
+        colunas = colunas or []
+        nova_planilha(None, 1, 'Dados')
+    for arquivo in list(livros):
+        salvar(arquivo)
 
+    medidor.bytes = sum(arquivo.stat().st_size for arquivo in salvos)
+    print(f"   💾 Excel salvo em {planilhas} planilha(s) e {len(salvos)} arquivo(s) ({medidor.resumo()})")
+    return salvos, registros
 
-def processar_cns(df):
-    """Processa CNS e cria ID único"""
-    try:
-        print("🔍 Processando CNS...")
 
-        df_proc = df.copy()
-        
-        # DIAGNÓSTICO
-        print(f"📋 Colunas disponíveis ({len(df.columns)}):")
-        for i, col in enumerate(df.columns[:20]):
-            print(f"  {i+1:2d}. {col}")
-        
-        # Procurar coluna CNS
-        coluna_cns = None
-        for col in df_proc.columns:
-            col_upper = str(col).upper()
-            if any(pattern in col_upper for pattern in ['CNS', 'CNSPCN', 'AP_CNS']):
-                coluna_cns = col
-                break
-        
-        if not coluna_cns:
-            return None, "Coluna CNS não encontrada"
-        
-        # Procurar coluna município
-        coluna_mun = None
-        for col in df_proc.columns:
-            col_upper = str(col).upper()
-            if any(pattern in col_upper for pattern in ['MUN', 'MUNIC', 'COD_MUN']):
-                coluna_mun = col
+def _lotes_em_partes(lotes, partes, linhas):
+    """
+    (parte, lote) para `partes` arquivos de tamanho parecido. DataFrame: cada
+    parte recebe um intervalo contínuo de linhas, em fatias de `linhas`,
+    intercaladas entre as partes para todas gravarem ao mesmo tempo. Iterável:
+    os lotes são distribuídos em rodízio.
+    """
+    if not isinstance(lotes, pd.DataFrame):
+        for i, lote in enumerate(lotes):
+            yield i % partes, lote
+        return
+    df = lotes
+    if len(df) == 0:
+        yield 0, df
+        return
+    por_parte = -(-len(df) // partes)
+    intervalos = [(inicio, min(inicio + por_parte, len(df))) for inicio in range(0, len(df), por_parte)]
+    for deslocamento in range(0, por_parte, linhas):
+        for i, (inicio, fim) in enumerate(intervalos):
+            if inicio + deslocamento < fim:
+                yield i, df.iloc[inicio + deslocamento:min(inicio + deslocamento + linhas, fim)]
+
+
+def _exportar_texto_partes(lotes, caminho, formato, timestamp, partes=None, dividir_por=None,
+                           compressao=None, linhas=LINHAS_LOTE_EXPORTACAO, total=None, progresso=None):
+    """
+    CSV/TXT dividido em vários arquivos gravados em paralelo: `partes` arquivos
+    por número de linhas ou um arquivo por valor da coluna `dividir_por` (ex.:
+    'UF', 'MES'). Cada arquivo tem sua thread, que converte para Arrow, formata
+    e comprime (gzip/zstd) seus lotes, então o tempo cai com o número de
+    núcleos em vez de ficar preso a um único compressor. Cada thread segura no
+    máximo dois lotes.
+
+    Grava {nome}_{timestamp}_manifesto.json com registros, bytes e SHA-256 de
+    cada arquivo.
+
+    Returns:
+        tuple: (lista de arquivos, registros exportados)
+    """
+    import json
+    import queue
+
+    exts = {'CSV': '.csv', 'TXT': '.txt'}
+    ext = exts[formato] + COMPRESSOES_TEXTO.get(compressao, '')
+    medidor = _MedidorExportacao(total, progresso)
+    lock = threading.Lock()
+    escritores = {}
+    erros = []
+
+    def trabalhar(escritor):
+        converter = _conversor_arrow()
+        saida = None
+        try:
+            saida = _ArquivoTexto(escritor['arquivo'], formato, compressao)
+        except Exception as e:
+            erros.append(e)
+        while True:
+            lote = escritor['fila'].get()
+            if lote is None:
                 break
-        
-        if not coluna_mun:
-            coluna_mun = 'MUN_DUMMY'
-            df_proc[coluna_mun] = '000000'
-        
-        print(f"✅ CNS: {coluna_cns}, Município: {coluna_mun}")
-        
-        # LIMPAR CNS
-        df_proc['CNS_LIMPO'] = (
-            df_proc[coluna_cns]
-            .astype(str)
-            .fillna('')
-            .str.replace(r'[^0-9]', '', regex=True)
-        )
-        
-        # PADRONIZAR CNS (15 dígitos) - Preserva zeros à esquerda
-        def padronizar_cns(cns):
-            """
-            Padroniza CNS para 15 dígitos preservando zeros à esquerda.
-            CNS deve ter exatamente 15 dígitos conforme especificação e-SUS.
-            """
-            if not cns or cns == '':
-                return 'SEM_CNS'
-
-            # Remover apenas espaços, manter números
-            cns = cns.strip()
-
-            # Se for apenas zeros, considerar como inválido
-            if cns == '0' * len(cns):
-                return '000000000000000'
-
-            # Preencher com zeros à esquerda se necessário
-            if len(cns) < 15:
-                return cns.zfill(15)
-            elif len(cns) > 15:
-                # Truncar se maior (manter os primeiros 15)
-                return cns[:15]
+            if erros:
+                continue   # alguma parte falhou: só esvaziar a fila
+            try:
+                saida.escrever(converter(lote))
+                with lock:
+                    escritor['bytes'] = saida.bytes
+                    medidor.lote(len(lote), sum(e['bytes'] for e in escritores.values()))
+            except Exception as e:
+                erros.append(e)
+        try:
+            if saida is not None:
+                saida.fechar()
+                escritor['registros'] = saida.registros
+                escritor['sha256'] = DBCCache._sha256(escritor['arquivo'])
+        except Exception as e:
+            erros.append(e)
+
+    def escritor_da_parte(chave):
+        escritor = escritores.get(chave)
+        if escritor is None:
+            if dividir_por is None:
+                sufixo = f"parte{chave + 1:03d}"
             else:
-                return cns
-        
-        df_proc['CNS_PADRONIZADO'] = df_proc['CNS_LIMPO'].apply(padronizar_cns)
+                sufixo = _rotulo_parte(f"{dividir_por}_{chave}", 100)
+            escritor = {'arquivo': caminho.with_name(f"{caminho.stem}_{timestamp}_{sufixo}{ext}"),
+                        'valor': None if dividir_por is None or pd.isna(chave) else chave,
+                        'fila': queue.Queue(maxsize=1), 'bytes': 0, 'registros': 0, 'sha256': None}
+            escritor['thread'] = threading.Thread(target=trabalhar, args=(escritor,), daemon=True,
+                                                  name=f"exportacao-{sufixo}")
+            with lock:
+                escritores[chave] = escritor
+            escritor['thread'].start()
+        return escritor
 
-        # VALIDAR CNS
-        print("🔍 Validando CNS...")
-        validacao = df_proc['CNS_PADRONIZADO'].apply(
-            lambda x: validar_cns(x) if x != 'SEM_CNS' and x != '000000000000000' else (False, 'sem_cns')
-        )
+    def distribuir():
+        if dividir_por is None:
+            yield from _lotes_em_partes(lotes, partes, linhas)
+            return
+        fonte = _lotes_dataframe(lotes, linhas) if isinstance(lotes, pd.DataFrame) else lotes
+        for lote in fonte:
+            if dividir_por not in lote.columns:
+                raise ValueError(f"Coluna para dividir inexistente: {dividir_por}")
+            if len(lote) == 0:
+                continue
+            for valor, parte in lote.groupby(dividir_por, sort=False, observed=True, dropna=False):
+                yield valor, parte
 
-        df_proc['CNS_VALIDO'] = validacao.apply(lambda x: x[0])
-        df_proc['CNS_TIPO'] = validacao.apply(lambda x: x[1])
-
-        # PROCESSAR MUNICÍPIO
-        df_proc['MUN_CODIGO'] = (
-            df_proc[coluna_mun]
-            .astype(str)
-            .fillna('000000')
-            .str.replace(r'[^0-9]', '', regex=True)
-            .str[:6]
-            .apply(lambda x: x.zfill(6) if x.isdigit() else '000000')
-        )
-        
-        # CRIAR ID ÚNICO
-        df_proc['ID_PACIENTE'] = df_proc['MUN_CODIGO'] + "_" + df_proc['CNS_PADRONIZADO']
-        
-        # LIMPAR COLUNAS TEMPORÁRIAS
-        df_proc = df_proc.drop(['CNS_LIMPO', 'MUN_CODIGO'], axis=1, errors='ignore')
-        if coluna_mun == 'MUN_DUMMY':
-            df_proc = df_proc.drop(['MUN_DUMMY'], axis=1, errors='ignore')
-        
-        # ESTATÍSTICAS
-        total = len(df_proc)
-        unicos = df_proc['ID_PACIENTE'].nunique()
-        sem_cns = (df_proc['CNS_PADRONIZADO'] == 'SEM_CNS').sum()
-
-        # Estatísticas de validação
-        cns_validos = df_proc['CNS_VALIDO'].sum()
-        cns_definitivos = (df_proc['CNS_TIPO'] == 'definitivo').sum()
-        cns_provisorios = (df_proc['CNS_TIPO'] == 'provisorio').sum()
-        cns_invalidos = (df_proc['CNS_TIPO'] == 'invalido').sum()
-
-        print(f"\n📊 ESTATÍSTICAS:")
-        print(f"   📈 Registros: {total:,}")
-        print(f"   👥 Pacientes únicos: {unicos:,}")
-        print(f"   ✅ Com CNS: {total - sem_cns:,}")
-        print(f"   ❌ Sem CNS: {sem_cns:,}")
-        print(f"\n🔍 VALIDAÇÃO CNS:")
-        print(f"   ✅ Válidos: {cns_validos:,}")
-        print(f"   📗 Definitivos: {cns_definitivos:,}")
-        print(f"   📙 Provisórios: {cns_provisorios:,}")
-        print(f"   ❌ Inválidos: {cns_invalidos:,}")
-        
-        return df_proc, None
-        
-    except Exception as e:
-        print(f"❌ Erro no processamento: {e}")
-        traceback.print_exc()
-        return None, f"Erro: {str(e)}"
+    try:
+        for chave, lote in distribuir():
+            if erros:
+                break
+            escritor_da_parte(chave)['fila'].put(lote)
+        if not escritores:
+            # Nada para gravar: um arquivo só com o cabeçalho (ou vazio, sem colunas)
+            escritor = escritor_da_parte(0 if dividir_por is None else 'vazio')
+            if isinstance(lotes, pd.DataFrame):
+                escritor['fila'].put(lotes.iloc[:0])
+    finally:
+        for escritor in list(escritores.values()):
+            escritor['fila'].put(None)
+        for escritor in list(escritores.values()):
+            escritor['thread'].join()
+    if erros:
+        raise erros[0]
+
+    ordenados = sorted(escritores.values(), key=lambda e: e['arquivo'].name)
+    arquivos = [e['arquivo'] for e in ordenados]
+    registros = sum(e['registros'] for e in ordenados)
+    manifesto = {
+        'criado_em': datetime.now().isoformat(timespec='seconds'),
+        'formato': formato,
+        'compressao': compressao,
+        'dividir_por': dividir_por,
+        'registros': registros,
+        'arquivos': [{'arquivo': e['arquivo'].name,
+                      'valor': e['valor'].item() if hasattr(e['valor'], 'item') else e['valor'],
+                      'registros': e['registros'],
+                      'bytes': e['arquivo'].stat().st_size,
+                      'sha256': e['sha256']}
+                     for e in ordenados],
+    }
+    if dividir_por is None:
+        for item in manifesto['arquivos']:
+            del item['valor']
+    caminho_manifesto = caminho.with_name(f"{caminho.stem}_{timestamp}_manifesto.json")
+    tmp = caminho_manifesto.with_name(caminho_manifesto.name + '.tmp')
+    tmp.write_text(json.dumps(manifesto, ensure_ascii=False, indent=1, default=str), encoding='utf-8')
+    os.replace(tmp, caminho_manifesto)
+
+    medidor.bytes = sum(arquivo.stat().st_size for arquivo in arquivos)
+    extra = f", {compressao}" if compressao else ""
+    print(f"   💾 {formato} salvo em {len(arquivos)} arquivo(s){extra} ({medidor.resumo()})")
+    print(f"   📄 Manifesto: {caminho_manifesto.name}")
+    return arquivos, registros
+
+
+def exportar_dados(df, caminho, formato, progresso=None, compressao=None,
+                   linhas_lote=LINHAS_LOTE_EXPORTACAO, linhas_grupo=None,
+                   dividir_por=None, limite_linhas=None, excel_destino='planilhas', partes=None):
+    """
+    Exporta dados para arquivo.
+    `df` pode ser um DataFrame ou um iterável de DataFrames (ex.: lotes de
+    DBCConverter.iter_batches / processar_cns_lotes), gravado lote a lote.
+
+    CSV, TXT e Parquet são sempre gravados em lotes (DataFrame em fatias de
+    `linhas_lote` linhas), com a memória extra limitada a dois lotes. No
+    Parquet cada lote vira um row group, ou vários de até `linhas_grupo`
+    linhas (DataFrame: fatias de `linhas_grupo`). `progresso(info)` é chamado
+    a cada lote com registros, bytes, registros/s e MB/s.
 
+    `compressao`: codec do Parquet ('snappy', o padrão, 'zstd', 'gzip',
+    'brotli', 'lz4' ou 'none') ou do CSV/TXT ('gzip' ou 'zstd'; padrão sem
+    compressão).
 
-def exportar_dados(df, caminho, formato):
-    """Exporta dados para arquivo"""
+    CSV/TXT com `partes=N` ou `dividir_por` (ex.: 'UF', 'MES') saem em vários
+    arquivos gravados em paralelo, mais um manifesto com registros e SHA-256
+    de cada um (ver _exportar_texto_partes).
+
+    Excel é gravado em streaming (planilhas write-only) sem truncar: os dados
+    são divididos em planilhas de até `limite_linhas` linhas (no máximo o
+    limite do Excel), uma série por valor de `dividir_por` se informado, e com
+    excel_destino='arquivos' em um .xlsx por planilha.
+    """
     try:
         caminho = Path(caminho)
         caminho.parent.mkdir(parents=True, exist_ok=True)
 
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        
-        if formato == 'CSV':
-            arquivo = caminho.with_name(f"{caminho.stem}_{timestamp}.csv")
-            # Exportar com UTF-8 BOM para garantir compatibilidade com Excel
-            df.to_csv(arquivo, index=False, sep=';', encoding='utf-8-sig', lineterminator='\n')
-            print(f"   💾 Arquivo CSV salvo com encoding UTF-8-BOM")
-        elif formato == 'Parquet':
-            arquivo = caminho.with_name(f"{caminho.stem}_{timestamp}.parquet")
-            df.to_parquet(arquivo, index=False, engine='pyarrow', compression='snappy')
-            print(f"   💾 Arquivo Parquet salvo com compressão snappy")
-        elif formato == 'Excel':
-            arquivo = caminho.with_name(f"{caminho.stem}_{timestamp}.xlsx")
-            # Excel tem limite de 1.048.576 linhas
-            max_rows = min(len(df), 1048576)
-            if len(df) > max_rows:
-                print(f"   ⚠️  Excel limitado a {max_rows:,} registros de {len(df):,}")
-            df.head(max_rows).to_excel(arquivo, index=False, engine='openpyxl')
-        elif formato == 'TXT':
-            arquivo = caminho.with_name(f"{caminho.stem}_{timestamp}.txt")
-            # TXT com UTF-8
-            df.to_csv(arquivo, index=False, sep='\t', encoding='utf-8', lineterminator='\n')
-            print(f"   💾 Arquivo TXT salvo com encoding UTF-8")
-        else:
+
+        if formato not in ('CSV', 'Parquet', 'Excel', 'TXT'):
             return False, f"Formato inválido: {formato}"
-        
-        size_mb = arquivo.stat().st_size / (1024 * 1024)
-        rows_exported = min(len(df), max_rows if formato == 'Excel' else len(df))
-        return True, f"✅ Salvo: {arquivo.name} ({size_mb:.2f} MB, {rows_exported:,} registros)"
+        if formato == 'Parquet' and (partes or dividir_por):
+            return False, "Divisão em arquivos disponível só para CSV, TXT e Excel"
+        if formato == 'Excel' and partes:
+            return False, "Excel divide por limite_linhas ou dividir_por, não por partes"
+        if partes and dividir_por:
+            return False, "Use partes ou dividir_por, não os dois"
+
+        if compressao is None:
+            compressao = 'snappy' if formato == 'Parquet' else 'none'
+        if formato in ('CSV', 'TXT') and compressao not in ('none', *COMPRESSOES_TEXTO):
+            return False, f"Compressão indisponível para {formato}: {compressao}"
+        if formato in ('CSV', 'TXT', 'Parquet') and compressao != 'none':
+            import pyarrow as pa
+            try:
+                disponivel = pa.Codec.is_available(compressao)
+            except ValueError:
+                disponivel = False
+            if not disponivel:
+                return False, f"Compressão indisponível: {compressao}"
+        compressao = None if compressao == 'none' else compressao
+
+        total = len(df) if isinstance(df, pd.DataFrame) else None
+        if formato in ('CSV', 'TXT') and (partes and partes > 1 or dividir_por):
+            arquivos, rows_exported = _exportar_texto_partes(df, caminho, formato, timestamp, partes=partes,
+                                                             dividir_por=dividir_por, compressao=compressao,
+                                                             linhas=linhas_lote, total=total,
+                                                             progresso=progresso)
+        else:
+            lotes = df
+            if isinstance(df, pd.DataFrame):
+                linhas = linhas_grupo if formato == 'Parquet' and linhas_grupo else linhas_lote
+                lotes = _lotes_dataframe(df, linhas)
+
+            if formato == 'Excel':
+                arquivos, rows_exported = _exportar_excel(lotes, caminho, timestamp, total=total,
+                                                          progresso=progresso, dividir_por=dividir_por,
+                                                          limite_linhas=limite_linhas, destino=excel_destino)
+            else:
+                arquivo, rows_exported = _exportar_lotes(lotes, caminho, formato, timestamp, total=total,
+                                                         progresso=progresso, compressao=compressao,
+                                                         linhas_grupo=linhas_grupo)
+                arquivos = [arquivo]
+
+        size_mb = sum(arquivo.stat().st_size for arquivo in arquivos) / (1024 * 1024)
+        nome = arquivos[0].name if len(arquivos) == 1 else f"{len(arquivos)} arquivos {caminho.stem}_{timestamp}_*"
+        return True, f"✅ Salvo: {nome} ({size_mb:.2f} MB, {rows_exported:,} registros)"
         
     except Exception as e:
         print(f"❌ Erro na exportação: {e}")
@@ -956,10 +3610,168 @@ def gerar_relatorio(df):
         return f"❌ Erro no relatório: {str(e)}"
 
 
+def processar_lote(ufs, anos, meses=None, grupos=("AM",), formato='Parquet', saida=None,
+                   workers=4, engine='native', processar=True, relatorio=False, compacto=False,
+                   ftp_host="ftp.datasus.gov.br", ftp_port=21, **opcoes_exportacao):
+    """
+    Pipeline sem interface gráfica: para cada grupo × UF × ano baixa e converte
+    os meses, processa CNS, exporta e, opcionalmente, grava o relatório em texto.
+
+    Todos os meses de todos os grupos/UFs/anos entram em um único pipeline
+    (download → conversão → CNS), então o download do próximo UF corre
+    enquanto o anterior é convertido. Cada grupo/UF/ano é consolidado e
+    exportado assim que seu último mês sai do pipeline. Com compacto=True a
+    exportação usa o esquema compacto de tipos (compactar_tipos). Os arquivos
+    vêm de `ftp_host`:`ftp_port`. Demais opções (compressao, linhas_grupo,
+    dividir_por, ...) vão para exportar_dados.
+
+    Returns:
+        dict: resumo serializável em JSON (um item por grupo/UF/ano, a vazão de
+        cada estágio e o status geral)
+    """
+    import time
+
+    meses = list(meses) if meses else list(range(1, 13))
+    saida = Path(saida or diretorio_dados())
+    saida.mkdir(parents=True, exist_ok=True)
+    downloader = SIADownloader(ftp_host=ftp_host, ftp_port=ftp_port)
+    inicio = time.monotonic()
+    resumo = {'inicio': datetime.now().isoformat(timespec='seconds'), 'formato': formato, 'itens': []}
+
+    def finalizar(grupo, uf, ano, item, resultados):
+        try:
+            dataframes = [resultados[mes] for mes in meses if resultados.get(mes) is not None]
+            if not dataframes:
+                item['erro'] = "Nenhum dado baixado"
+                return
+
+            print(f"\n📊 Consolidando {grupo} {uf}-{ano}...")
+            df = _consolidar_meses(dataframes)
+            if processar:
+                item['estatisticas_cns'] = df.attrs.get('estatisticas_cns')
+                if item['estatisticas_cns'] is None:
+                    item['erro'] = "CNS não processado em todos os meses"
+                else:
+                    _imprimir_estatisticas_cns(item['estatisticas_cns'],
+                                               item['estatisticas_cns']['pacientes_unicos'])
+
+            if compacto:
+                df = compactar_tipos(df)
+                item['memoria_mb'] = {
+                    'antes': round(sum(c['antes_bytes'] for c in df.attrs['memoria'].values()) / (1024 * 1024), 2),
+                    'depois': round(sum(c['depois_bytes'] for c in df.attrs['memoria'].values()) / (1024 * 1024), 2),
+                }
+
+            item['meses'] = sorted(int(m) for m in df['MES'].unique())
+            item['registros'] = len(df)
+            item['colunas'] = len(df.columns)
+
+            sucesso, mensagem = exportar_dados(df, saida / f"SIA_{grupo}_{uf}_{ano}", formato,
+                                               **opcoes_exportacao)
+            item['exportacao'] = mensagem
+            if not sucesso:
+                item['erro'] = mensagem
+
+            if relatorio:
+                caminho_rel = saida / f"relatorio_{grupo}_{uf}_{ano}.txt"
+                caminho_rel.write_text(gerar_relatorio(df), encoding='utf-8')
+                item['relatorio'] = str(caminho_rel)
+        except Exception as e:
+            traceback.print_exc()
+            item['erro'] = str(e)
+        finally:
+            item['duracao_s'] = round(time.monotonic() - inicio, 2)
+
+    # Planejar todos os meses antes de começar
+    pendentes = {}
+    itens = []
+    for grupo in grupos:
+        for uf in ufs:
+            for ano in anos:
+                ano = int(ano)
+                item = {'grupo': grupo, 'uf': uf, 'ano': ano, 'meses': [], 'registros': 0,
+                        'colunas': 0, 'estatisticas_cns': None, 'exportacao': None,
+                        'relatorio': None, 'erro': None}
+                resumo['itens'].append(item)
+                try:
+                    disponiveis = [p['mes'] for p in downloader.planejar_downloads(grupo, uf, ano, meses)]
+                except Exception as e:
+                    traceback.print_exc()
+                    disponiveis = []
+                    item['erro'] = str(e)
+                if not disponiveis:
+                    item['erro'] = item['erro'] or "Nenhum dado baixado"
+                    item['duracao_s'] = round(time.monotonic() - inicio, 2)
+                    continue
+                pendentes[(grupo, uf, ano)] = {'item': item, 'faltam': len(disponiveis), 'resultados': {}}
+                itens.extend((grupo, uf, ano, mes) for mes in disponiveis)
+
+    estagios = [('cns', downloader._processar_cns_mes, 1)] if processar else []
+    try:
+        for (grupo, uf, ano, mes), df in downloader._baixar_e_converter(itens, engine, workers, estagios):
+            pendente = pendentes[(grupo, uf, ano)]
+            pendente['resultados'][mes] = df
+            pendente['faltam'] -= 1
+            if pendente['faltam'] == 0:
+                finalizar(grupo, uf, ano, pendente['item'], pendentes.pop((grupo, uf, ano))['resultados'])
+    except Exception as e:
+        traceback.print_exc()
+        for pendente in pendentes.values():
+            pendente['item']['erro'] = str(e)
+            pendente['item']['duracao_s'] = round(time.monotonic() - inicio, 2)
+    finally:
+        downloader.fechar()
+
+    resumo['estagios'] = downloader.estatisticas_pipeline
+    resumo['duracao_s'] = round(time.monotonic() - inicio, 2)
+    resumo['ok'] = all(item['erro'] is None for item in resumo['itens'])
+    return resumo
+
+
+def converter_arquivos(arquivos, formato='Parquet', saida=None, processar=True, batch_rows=200000,
+                       encoding='latin-1', **opcoes_exportacao):
+    """
+    Converte .dbc/.dbf locais sem carregar nenhum deles inteiro na memória:
+    cada arquivo é lido em lotes (DBCConverter.iter_batches), tem o CNS
+    processado lote a lote (processar_cns_lotes) e é gravado lote a lote por
+    exportar_dados em `saida` (padrão: ao lado do arquivo), com o mesmo nome
+    mais data/hora.
+    Demais opções (compressao, linhas_grupo, partes, ...) vão para exportar_dados.
+
+    Returns:
+        list: (arquivo, sucesso, mensagem) por arquivo
+    """
+    resultados = []
+    for arquivo in arquivos:
+        arquivo = Path(arquivo)
+        destino = Path(saida) if saida else arquivo.parent
+        print(f"\n📂 {arquivo.name}")
+        try:
+            destino.mkdir(parents=True, exist_ok=True)
+            lotes = DBCConverter.iter_batches(str(arquivo), batch_rows=batch_rows, encoding=encoding)
+            if processar:
+                lotes = processar_cns_lotes(lotes)
+            sucesso, mensagem = exportar_dados(lotes, destino / arquivo.stem, formato, **opcoes_exportacao)
+        except Exception as e:
+            traceback.print_exc()
+            sucesso, mensagem = False, str(e)
+        print(f"   {mensagem}" if sucesso else f"   ❌ {mensagem}")
+        resultados.append((str(arquivo), sucesso, mensagem))
+    return resultados
+
+
+def _carregar_tkinter():
+    """Importa o Tkinter só para a interface gráfica (o modo de linha de comando roda sem display)"""
+    global tk, filedialog, messagebox, ttk
+    import tkinter as tk
+    from tkinter import filedialog, messagebox, ttk
+
+
 class JanelaCarregamento:
     """Janela de carregamento"""
 
     def __init__(self, parent, mensagem="Processando..."):
+        _carregar_tkinter()
         self.janela = tk.Toplevel(parent)
         self.janela.title("Aguarde")
         self.janela.geometry("300x100")
@@ -984,26 +3796,260 @@ class JanelaCarregamento:
         self.progress.start(10)
 
     def atualizar(self, mensagem):
+        if not self.janela.winfo_exists():   # atualização agendada depois de fechar
+            return
         self.label.config(text=mensagem)
         self.janela.update()
 
     def fechar(self):
+        if not self.janela.winfo_exists():   # já fechada ao exibir a prévia
+            return
         self.progress.stop()
         self.janela.destroy()
 
 
+class GradeVirtual:
+    """
+    Grade de dados virtual sobre um ttk.Treeview.
+
+    O Treeview só tem as linhas que cabem na tela; a cada rolagem elas são
+    reescritas com a página correspondente do DataFrame, formatada coluna a
+    coluna. Redesenhar custa o mesmo com 10 mil ou 20 milhões de registros.
+    A barra de rolagem, o "ir para linha" e a ordenação (clique no cabeçalho)
+    valem para o dataset inteiro.
+    """
+
+    MAX_TEXTO = 50
+
+    def __init__(self, parent, altura=25):
+        _carregar_tkinter()
+        self.df = None
+        self.colunas = []
+        self.ordem = None          # posições na ordem exibida (None: ordem original)
+        self.ordenacao = None      # (coluna, crescente)
+        self.inicio = 0
+        self.linhas_visiveis = altura
+
+        # Ir para linha / posição atual
+        barra = ttk.Frame(parent)
+        barra.grid(row=0, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=(0, 5))
+        ttk.Label(barra, text="Ir para linha:").pack(side=tk.LEFT, padx=(0, 5))
+        self.linha_var = tk.StringVar()
+        entrada = ttk.Entry(barra, textvariable=self.linha_var, width=12)
+        entrada.pack(side=tk.LEFT)
+        entrada.bind('<Return>', lambda e: self.ir_para_linha())
+        ttk.Button(barra, text="Ir", width=4, command=self.ir_para_linha).pack(side=tk.LEFT, padx=5)
+        self.posicao_label = ttk.Label(barra, text="", foreground='gray')
+        self.posicao_label.pack(side=tk.RIGHT)
+
+        # A barra vertical representa o dataset inteiro, não os itens do Treeview
+        self.v_scroll = ttk.Scrollbar(parent, orient=tk.VERTICAL, command=self._rolar_barra)
+        h_scroll = ttk.Scrollbar(parent, orient=tk.HORIZONTAL)
+        self.tree = ttk.Treeview(parent, xscrollcommand=h_scroll.set, show='tree headings',
+                                 selectmode='extended', height=altura)
+        h_scroll.config(command=self.tree.xview)
+
+        self.tree.grid(row=1, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
+        self.v_scroll.grid(row=1, column=1, sticky=(tk.N, tk.S))
+        h_scroll.grid(row=2, column=0, sticky=(tk.W, tk.E))
+        parent.columnconfigure(0, weight=1)
+        parent.rowconfigure(1, weight=1)
+
+        self.tree.bind('<MouseWheel>', self._roda_mouse)
+        self.tree.bind('<Button-4>', lambda e: self.rolar(-3))   # Linux
+        self.tree.bind('<Button-5>', lambda e: self.rolar(3))
+        self.tree.bind('<Prior>', lambda e: self.rolar(-self.linhas_visiveis) or 'break')
+        self.tree.bind('<Next>', lambda e: self.rolar(self.linhas_visiveis) or 'break')
+        self.tree.bind('<Control-Home>', lambda e: self.rolar(-self.total) or 'break')
+        self.tree.bind('<Control-End>', lambda e: self.rolar(self.total) or 'break')
+        self.tree.bind('<Up>', lambda e: self._seta(-1))
+        self.tree.bind('<Down>', lambda e: self._seta(1))
+        self.tree.bind('<Configure>', self._redimensionar)
+
+    @property
+    def total(self):
+        return 0 if self.df is None else len(self.df)
+
+    def mostrar(self, df, colunas):
+        """Troca o DataFrame exibido e volta ao início, sem ordenação"""
+        self.df = df
+        self.colunas = list(colunas)
+        self.ordem = None
+        self.ordenacao = None
+        self.inicio = 0
+
+        self.tree["columns"] = self.colunas
+        self.tree["displaycolumns"] = self.colunas
+        self.tree.heading("#0", text="#", anchor='center')
+        self.tree.column("#0", width=80, minwidth=60, stretch=False, anchor='center')
+        amostra = df.head(100)
+        for col in self.colunas:
+            # Largura pelo nome da coluna e pelas primeiras 100 linhas (máximo 400px)
+            largura = max(100, len(str(col)) * 8 + 20)
+            if len(amostra) > 0:
+                maior = amostra[col].astype(str).str.len().max()
+                largura = max(largura, min(maior * 8 + 20, 400))
+            self.tree.column(col, width=largura, minwidth=80, stretch=True, anchor='w')
+        self._cabecalhos()
+        self.desenhar()
+
+    def atualizar(self, df):
+        """Troca o DataFrame mantendo colunas, posição e ordenação (dados ainda chegando)"""
+        self.df = df
+        if self.ordenacao:
+            self.ordem = self._posicoes_ordenadas(*self.ordenacao)
+        self.desenhar()
+
+    def _cabecalhos(self):
+        for col in self.colunas:
+            nome = str(col) if len(str(col)) <= 20 else str(col)[:17] + "..."
+            if self.ordenacao and self.ordenacao[0] == col:
+                nome += " ▲" if self.ordenacao[1] else " ▼"
+            self.tree.heading(col, text=nome, anchor='w', command=lambda c=col: self.ordenar(c))
+
+    def _pagina(self, posicoes):
+        """Textos da página: uma conversão por coluna, não por célula"""
+        textos = []
+        for col in self.colunas:
+            valores = self.df[col].iloc[posicoes]
+            texto = pd.Series(valores.astype(str).to_numpy(dtype=object), copy=False)
+            texto[valores.isna().to_numpy()] = ""
+            longo = texto.str.len() > self.MAX_TEXTO
+            if longo.any():
+                texto[longo] = texto[longo].str[:self.MAX_TEXTO - 3] + "..."
+            textos.append(texto.tolist())
+        return list(zip(*textos)) if textos else [()] * len(posicoes)
+
+    def desenhar(self):
+        """Reescreve as linhas visíveis a partir de self.inicio"""
+        total = self.total
+        self.inicio = max(0, min(self.inicio, total - self.linhas_visiveis))
+        n = max(0, min(self.linhas_visiveis, total - self.inicio))
+        if self.ordem is None:
+            posicoes = np.arange(self.inicio, self.inicio + n)
+        else:
+            posicoes = self.ordem[self.inicio:self.inicio + n]
+        linhas = self._pagina(posicoes) if n else []
+
+        # Reaproveita os itens do Treeview: cria/remove só a diferença
+        itens = self.tree.get_children()
+        if len(itens) > n:
+            self.tree.delete(*itens[n:])
+        for i in range(len(itens), n):
+            self.tree.insert("", tk.END, iid=f"l{i}")
+        for i, (posicao, valores) in enumerate(zip(posicoes, linhas)):
+            self.tree.item(f"l{i}", text=f"{posicao + 1:,}", values=valores)
+
+        if total:
+            self.v_scroll.set(self.inicio / total, (self.inicio + n) / total)
+            self.posicao_label.config(text=f"Linhas {self.inicio + 1:,}–{self.inicio + n:,} de {total:,}")
+        else:
+            self.v_scroll.set(0, 1)
+            self.posicao_label.config(text="")
+
+    def rolar(self, linhas):
+        inicio = max(0, min(self.inicio + int(linhas), self.total - self.linhas_visiveis))
+        if inicio != self.inicio:
+            self.inicio = inicio
+            self.tree.selection_remove(self.tree.selection())
+            self.desenhar()
+
+    def _rolar_barra(self, acao, valor, unidade=None):
+        if acao == 'moveto':
+            self.rolar(int(float(valor) * self.total) - self.inicio)
+        elif acao == 'scroll':
+            passo = int(valor) * (self.linhas_visiveis if unidade == 'pages' else 1)
+            self.rolar(passo)
+
+    def _roda_mouse(self, event):
+        # Windows: múltiplos de 120; macOS: valores pequenos
+        passo = event.delta // 120 if abs(event.delta) >= 120 else event.delta
+        self.rolar(-3 * passo)
+        return 'break'
+
+    def _seta(self, direcao):
+        # Nas bordas da página as setas rolam o dataset em vez de parar
+        itens = self.tree.get_children()
+        foco = self.tree.focus()
+        if itens and foco == itens[0 if direcao < 0 else -1]:
+            self.rolar(direcao)
+            self.tree.selection_set(foco)
+            return 'break'
+        return None
+
+    def _redimensionar(self, event):
+        altura_linha = int(ttk.Style().lookup('Treeview', 'rowheight') or 20)
+        caixa = self.tree.bbox('l0') if self.tree.exists('l0') else None
+        cabecalho = caixa[1] if caixa else 25
+        linhas = max(1, (event.height - cabecalho) // altura_linha)
+        if linhas != self.linhas_visiveis:
+            self.linhas_visiveis = linhas
+            self.desenhar()
+
+    def ir_para_linha(self):
+        """Vai para a linha digitada (numeração da ordem exibida, a partir de 1)"""
+        try:
+            linha = int(self.linha_var.get().replace('.', '').replace(',', '').strip())
+        except ValueError:
+            self.tree.bell()
+            return
+        if not self.total:
+            return
+        self.inicio = max(0, min(linha - 1, self.total - 1))
+        deslocamento = linha - 1 - max(0, min(self.inicio, self.total - self.linhas_visiveis))
+        self.desenhar()
+        alvo = f"l{max(0, min(deslocamento, len(self.tree.get_children()) - 1))}"
+        if self.tree.exists(alvo):
+            self.tree.selection_set(alvo)
+            self.tree.focus(alvo)
+            self.tree.see(alvo)
+
+    def ordenar(self, coluna):
+        """Ordena o dataset inteiro pela coluna (segundo clique inverte); nulos por último"""
+        crescente = not (self.ordenacao and self.ordenacao[0] == coluna and self.ordenacao[1])
+        self.tree.config(cursor='watch')
+        self.tree.update_idletasks()
+        try:
+            self.ordem = self._posicoes_ordenadas(coluna, crescente)
+        finally:
+            self.tree.config(cursor='')
+        self.ordenacao = (coluna, crescente)
+        self.inicio = 0
+        self._cabecalhos()
+        self.desenhar()
+
+    def _posicoes_ordenadas(self, coluna, crescente):
+        serie = self.df[coluna].reset_index(drop=True)
+        if isinstance(serie.dtype, pd.CategoricalDtype):
+            # Categorias em ordem alfabética, não na ordem de aparição
+            serie = serie.cat.reorder_categories(serie.cat.categories.sort_values())
+        try:
+            ordenada = serie.sort_values(ascending=crescente, kind='stable', na_position='last')
+        except TypeError:
+            # Tipos misturados (object): ordenar pelo texto
+            ordenada = serie.astype(str).where(serie.notna()).sort_values(
+                ascending=crescente, kind='stable', na_position='last')
+        return ordenada.index.to_numpy()
+
+
 class SIAApp:
     """Aplicação principal"""
 
     def __init__(self, root):
+        _carregar_tkinter()
         self.root = root
         self.root.title("SIA APAC Medicamentos")
         self.root.geometry("1200x800")
         
+        # Um único dataset carregado; o CNS processado guarda só as colunas derivadas
         self.df_original = None
-        self.df_processado = None
+        self.cns_derivadas = None
         self.downloader = SIADownloader()
         
+        # Carregamento progressivo: a grade mostra a prévia até os dados completos chegarem
+        self.carregando = False
+        self.previa = False
+        
         self.setup_ui()
 
     def setup_ui(self):
@@ -1048,6 +4094,11 @@ class SIAApp:
                                 values=["2024", "2023", "2022"], width=8, state='readonly')
         ano_combo.pack(side=tk.LEFT)
         
+        # Ano completo (12 meses, downloads em paralelo)
+        self.ano_completo_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(section1, text="Ano completo (12 meses)",
+                        variable=self.ano_completo_var).pack(anchor=tk.W, pady=5)
+        
         # Botão download
         self.btn_download = ttk.Button(section1, text="🌐 Baixar DBC", 
                                       command=self.download_and_process,
@@ -1058,6 +4109,10 @@ class SIAApp:
         self.status_download = ttk.Label(section1, text="Pronto", foreground="green")
         self.status_download.pack()
         
+        # Cache de DBC baixados
+        ttk.Button(section1, text="🧹 Limpar cache DBC",
+                  command=self.limpar_cache_dbc, width=20).pack(pady=(10, 0))
+        
         # SEÇÃO 2: ARQUIVO LOCAL
         section2 = ttk.LabelFrame(left_frame, text="2. CARREGAR ARQUIVO", padding="10")
         section2.pack(fill=tk.X, pady=(0, 15))
@@ -1069,6 +4124,8 @@ class SIAApp:
         ttk.Entry(frame_file, textvariable=self.file_path).pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
         ttk.Button(frame_file, text="📁", width=3, 
                   command=self.browse_file).pack(side=tk.LEFT)
+        ttk.Button(frame_file, text="🗂", width=3,
+                  command=self.browse_dataset).pack(side=tk.LEFT, padx=(2, 0))
         
         ttk.Button(section2, text="📥 Carregar", 
                   command=self.load_file, width=20).pack(pady=5)
@@ -1080,6 +4137,11 @@ class SIAApp:
         ttk.Button(section3, text="🔍 Processar CNS", 
                   command=self.process_cns, width=20).pack(pady=5)
         
+        # Esquema compacto (categóricos, inteiros reduzidos) nos dados carregados
+        self.compacto_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(section3, text="Tipos compactos (menos memória)",
+                        variable=self.compacto_var).pack(anchor=tk.W, pady=5)
+        
         ttk.Button(section3, text="📊 Gerar Relatório", 
                   command=self.generate_report, width=20).pack(pady=5)
         
@@ -1099,6 +4161,17 @@ class SIAApp:
         ttk.Radiobutton(frame_format, text="Excel", 
                        variable=self.export_format, value="Excel").pack(side=tk.LEFT)
         
+        # Divisão em arquivos (CSV) ou planilhas/arquivos (Excel, sem truncar no limite de linhas)
+        frame_dividir = ttk.Frame(section4)
+        frame_dividir.pack(fill=tk.X, pady=5)
+        ttk.Label(frame_dividir, text="Dividir por (CSV/Excel):").pack(side=tk.LEFT, padx=(0, 5))
+        self.dividir_var = tk.StringVar(value="")
+        ttk.Combobox(frame_dividir, textvariable=self.dividir_var,
+                     values=["", "UF", "MES", "ANO", "GRUPO"], width=8, state='readonly').pack(side=tk.LEFT)
+        self.excel_arquivos_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(section4, text="Excel: um arquivo por planilha",
+                        variable=self.excel_arquivos_var).pack(anchor=tk.W, pady=5)
+        
         ttk.Button(section4, text="💾 Exportar", 
                   command=self.export_data, width=20).pack(pady=10)
         
@@ -1140,36 +4213,12 @@ class SIAApp:
                                    font=('Arial', 10), foreground='gray')
         self.info_label.pack(pady=(0, 10))
         
-        # Treeview com scrollbars
+        # Grade virtual: só as linhas visíveis existem no Treeview
         tree_frame = ttk.Frame(right_frame)
         tree_frame.pack(fill=tk.BOTH, expand=True)
         
-        # Criar canvas para scroll horizontal
-        canvas = tk.Canvas(tree_frame, borderwidth=0, highlightthickness=0)
-        
-        # Scrollbars
-        v_scroll = ttk.Scrollbar(tree_frame, orient=tk.VERTICAL)
-        h_scroll = ttk.Scrollbar(tree_frame, orient=tk.HORIZONTAL)
-        
-        # Tree
-        self.tree = ttk.Treeview(tree_frame, 
-                                yscrollcommand=v_scroll.set,
-                                xscrollcommand=h_scroll.set,
-                                show='tree headings',
-                                selectmode='extended',
-                                height=25)
-        
-        v_scroll.config(command=self.tree.yview)
-        h_scroll.config(command=self.tree.xview)
-        
-        # Layout tree com grid para melhor controle
-        self.tree.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
-        v_scroll.grid(row=0, column=1, sticky=(tk.N, tk.S))
-        h_scroll.grid(row=1, column=0, sticky=(tk.W, tk.E))
-        
-        # Configurar pesos para expansão correta
-        tree_frame.columnconfigure(0, weight=1)
-        tree_frame.rowconfigure(0, weight=1)
+        self.grade = GradeVirtual(tree_frame, altura=25)
+        self.tree = self.grade.tree
         
         # Configurar pesos globais
         left_frame.columnconfigure(0, weight=1)
@@ -1183,6 +4232,27 @@ class SIAApp:
         self.text_log.see(tk.END)
         self.root.update()
 
+    @property
+    def df_processado(self):
+        """Dataset com as colunas de CNS anexadas, sem copiar as colunas originais"""
+        if self.df_original is None or self.cns_derivadas is None:
+            return None
+        return anexar_colunas(self.df_original, self.cns_derivadas)
+
+    def dados_atuais(self):
+        """DataFrame exibido, analisado e exportado (com o CNS, se já processado)"""
+        df = self.df_processado
+        return df if df is not None else self.df_original
+
+    def log_memoria(self, df):
+        """Registra no log a economia de memória do esquema compacto"""
+        memoria = df.attrs.get('memoria')
+        if not memoria:
+            return
+        antes = sum(c['antes_bytes'] for c in memoria.values()) / (1024 * 1024)
+        depois = sum(c['depois_bytes'] for c in memoria.values()) / (1024 * 1024)
+        self.log(f"📦 Memória: {antes:,.1f} MB → {depois:,.1f} MB (tipos compactos)")
+
     def browse_file(self):
         """Seleciona arquivo"""
         filename = filedialog.askopenfilename(
@@ -1199,14 +4269,38 @@ class SIAApp:
             self.file_path.set(filename)
             self.log(f"📁 Selecionado: {Path(filename).name}")
 
+    def browse_dataset(self):
+        """Seleciona diretório de dataset Parquet particionado"""
+        diretorio = filedialog.askdirectory(title="Selecionar dataset particionado")
+        if diretorio:
+            self.file_path.set(diretorio)
+            self.log(f"🗂 Selecionado: {Path(diretorio).name}")
+
+    def limpar_cache_dbc(self):
+        """Remove os DBC e as conversões guardados no cache local"""
+        cache = self.downloader.cache
+        conversoes = CacheConversao()
+        
+        total_mb = ((cache.tamanho_total if cache is not None else 0) + conversoes.tamanho_total) / (1024 * 1024)
+        if not messagebox.askyesno("Limpar cache", f"Remover os DBC e as conversões em cache ({total_mb:.2f} MB)?"):
+            return
+        
+        # DBCCache.limpar também esvazia o cache de conversão
+        removidos, liberado = cache.limpar(0) if cache is not None else conversoes.limpar(0)
+        self.log(f"🧹 Cache: {removidos} arquivos removidos, {liberado / (1024 * 1024):.2f} MB liberados")
+
     def download_and_process(self):
         """Download e processamento"""
         uf = self.uf_var.get()
         ano = self.ano_var.get()
+        ano_completo = self.ano_completo_var.get()
+        compacto = self.compacto_var.get()
         
         if not uf or not ano:
             messagebox.showerror("Erro", "Selecione UF e Ano")
             return
+        if self.carga_em_andamento():
+            return
         
         self.log(f"\n{'='*60}")
         self.log(f"🚀 DOWNLOAD {uf}-{ano}")
@@ -1216,26 +4310,35 @@ class SIAApp:
         self.btn_download.config(state='disabled')
         self.status_download.config(text="Baixando...", foreground="blue")
         
-        # Janela carregamento
+        # Janela carregamento (fecha quando a prévia aparece)
         janela = JanelaCarregamento(self.root, "Conectando ao DATASUS...")
+        parcial = self.iniciar_carga(janela)
         
         def processar():
             try:
                 janela.atualizar("Baixando dados...")
                 
                 # Download e conversão
-                df, total = self.downloader.processar_estado(uf, int(ano))
+                if ano_completo:
+                    df, total = self.downloader.processar_estado(uf, int(ano), meses=list(range(1, 13)),
+                                                                 workers=4, compacto=compacto, parcial=parcial)
+                else:
+                    df, total = self.downloader.processar_estado(uf, int(ano), meses=[1], compacto=compacto,
+                                                                 parcial=parcial)
                 
                 if df is not None and total > 0:
                     self.df_original = df
+                    self.cns_derivadas = None
+                    if compacto:
+                        self.log_memoria(df)
                     
                     janela.atualizar("Processando CNS...")
                     
-                    # Processar CNS
-                    df_proc, erro = processar_cns(df)
+                    # Processar CNS (só as colunas derivadas; o dataset não é duplicado)
+                    derivadas, erro = processar_cns(df, somente_derivadas=True, compacto=compacto)
                     
-                    if df_proc is not None:
-                        self.df_processado = df_proc
+                    if derivadas is not None:
+                        self.cns_derivadas = derivadas
                         
                         janela.fechar()
                         
@@ -1243,9 +4346,8 @@ class SIAApp:
                         self.log(f"📊 Registros: {total:,}")
                         self.log(f"📋 Colunas: {len(df.columns)}")
                         
-                        if 'ID_PACIENTE' in df_proc.columns:
-                            unicos = df_proc['ID_PACIENTE'].nunique()
-                            self.log(f"👥 Pacientes únicos: {unicos:,}")
+                        unicos = derivadas.attrs['estatisticas_cns']['pacientes_unicos']
+                        self.log(f"👥 Pacientes únicos: {unicos:,}")
                         
                         # Mostrar dados
                         self.root.after(0, self.mostrar_dados)
@@ -1262,13 +4364,16 @@ class SIAApp:
                     janela.fechar()
                     self.log(f"\n❌ FALHA NO DOWNLOAD")
                     self.status_download.config(text="❌ Falha", foreground="red")
+                    self.root.after(0, self.descartar_previa)
                     
             except Exception as e:
                 janela.fechar()
                 self.log(f"\n❌ ERRO: {str(e)}")
                 traceback.print_exc()
                 self.status_download.config(text="❌ Erro", foreground="red")
+                self.root.after(0, self.descartar_previa)
             finally:
+                self.carregando = False
                 self.root.after(0, lambda: self.btn_download.config(state='normal'))
         
         # Thread
@@ -1279,45 +4384,120 @@ class SIAApp:
         if not self.file_path.get():
             messagebox.showerror("Erro", "Selecione arquivo")
             return
+        if self.carga_em_andamento():
+            return
         
         self.log(f"\n📂 CARREGANDO ARQUIVO...")
         
+        # Parquet e DBC: a janela fecha quando a prévia aparece e o resto carrega em segundo plano
         janela = JanelaCarregamento(self.root, "Carregando...")
+        compacto = self.compacto_var.get()
+        parcial = self.iniciar_carga(janela)
         
         def carregar():
             try:
-                df, erro = carregar_arquivo(self.file_path.get())
+                df, erro = carregar_arquivo(self.file_path.get(), compacto=compacto, parcial=parcial)
                 
                 janela.fechar()
                 
                 if erro:
+                    self.root.after(0, self.descartar_previa)
                     messagebox.showerror("Erro", erro)
                     self.log(f"❌ {erro}")
                 else:
                     self.df_original = df
+                    self.cns_derivadas = None
                     self.log(f"\n✅ CARREGADO!")
                     self.log(f"📊 Registros: {len(df):,}")
                     self.log(f"📋 Colunas: {len(df.columns)}")
+                    if compacto:
+                        self.log_memoria(df)
                     
                     self.root.after(0, self.mostrar_dados)
                     
             except Exception as e:
                 janela.fechar()
                 self.log(f"❌ ERRO: {str(e)}")
+                self.root.after(0, self.descartar_previa)
+            finally:
+                self.carregando = False
         
         threading.Thread(target=carregar, daemon=True).start()
 
+    def carga_em_andamento(self):
+        """Avisa (e retorna True) se um carregamento ainda não terminou"""
+        if self.carregando:
+            messagebox.showinfo("Aguarde", "Os dados ainda estão sendo carregados")
+            return True
+        return False
+
+    def iniciar_carga(self, janela=None):
+        """
+        Marca o início de um carregamento e retorna o callback parcial(df, total)
+        para a thread de leitura: cada parte chega à grade pelo root.after.
+        """
+        import time
+
+        self.carregando = True
+        self.previa = False
+        inicio = time.monotonic()
+
+        def parcial(df, total):
+            self.root.after(0, self.mostrar_parcial, df, total, janela, time.monotonic() - inicio)
+        return parcial
+
+    def mostrar_parcial(self, df, total=None, janela=None, segundos=None):
+        """Mostra os registros já lidos enquanto o carregamento continua"""
+        if not self.carregando:
+            return   # os dados completos já chegaram
+        if not self.previa:
+            if janela is not None:
+                janela.fechar()
+            self.grade.mostrar(df, self.colunas_visiveis(df))
+            self.previa = True
+            self.log(f"👁️  Prévia: {len(df):,} registros em {segundos:.1f}s, carregando o restante...")
+        else:
+            self.grade.atualizar(df)
+        
+        previsto = f" de ~{total:,}" if total else ""
+        self.info_label.config(text=f"⏳ {len(df):,}{previsto} registros carregados | "
+                                    f"📋 {len(df.columns)} colunas")
+
+    def descartar_previa(self):
+        """Carregamento falhou: a grade volta ao dataset anterior"""
+        if not self.previa:
+            return
+        self.previa = False
+        if self.df_original is not None:
+            self.mostrar_dados()
+        else:
+            self.grade.mostrar(pd.DataFrame(), [])
+            self.info_label.config(text="⏳ Nenhum dado")
+
+    def colunas_visiveis(self, df):
+        """Colunas da grade: as importantes primeiro, até 15 no total"""
+        colunas_imp = ['ID_PACIENTE', 'CNS_PADRONIZADO', 'AP_CNSPCN', 'AP_MUNPCN',
+                      'AP_CIDPRI', 'AP_PRIPAL', 'AP_VL_AP', 'AP_UFMUN', 'UF', 'ANO', 'MES']
+        
+        # Tentar colunas importantes primeiro
+        colunas = [c for c in colunas_imp if c in df.columns]
+        
+        # Se não tiver colunas importantes, pegar todas (até 15)
+        if not colunas:
+            colunas = list(df.columns)[:15]
+        else:
+            # Adicionar outras colunas até completar 15
+            outras = [c for c in df.columns if c not in colunas]
+            colunas.extend(outras[:max(0, 15 - len(colunas))])
+        return colunas
+
     def mostrar_dados(self):
-        """Mostra dados na treeview"""
+        """Mostra dados na grade virtual"""
         if self.df_original is None:
             return
 
-        # Limpar tree
-        for item in self.tree.get_children():
-            self.tree.delete(item)
-
         # Qual DataFrame mostrar
-        df_show = self.df_processado if self.df_processado is not None else self.df_original
+        df_show = self.dados_atuais()
 
         # 🔍 DEBUG: Mostrar amostra do AP_CNSPCN no terminal
         print("\n" + "="*60)
@@ -1342,98 +4522,52 @@ class SIAApp:
         print("="*60 + "\n")
         
         # Colunas para mostrar - TODAS as colunas importantes ou primeiras 15
-        colunas_imp = ['ID_PACIENTE', 'CNS_PADRONIZADO', 'AP_CNSPCN', 'AP_MUNPCN',
-                      'AP_CIDPRI', 'AP_PRIPAL', 'AP_VL_AP', 'AP_UFMUN', 'UF', 'ANO', 'MES']
-        
-        # Tentar colunas importantes primeiro
-        colunas = [c for c in colunas_imp if c in df_show.columns]
+        colunas = self.colunas_visiveis(df_show)
         
-        # Se não tiver colunas importantes, pegar todas (até 15)
-        if not colunas:
-            colunas = list(df_show.columns)[:15]
+        # Grade virtual: todas as linhas navegáveis, só as visíveis são desenhadas.
+        # Depois de uma prévia com as mesmas colunas, posição e ordenação continuam.
+        if self.previa and colunas == self.grade.colunas:
+            self.grade.atualizar(df_show)
         else:
-            # Adicionar outras colunas até completar 15
-            outras = [c for c in df_show.columns if c not in colunas]
-            colunas.extend(outras[:max(0, 15 - len(colunas))])
-        
-        # Configurar tree
-        self.tree["columns"] = colunas
-        self.tree["displaycolumns"] = colunas
-        
-        # Configurar coluna #0 (índice)
-        self.tree.heading("#0", text="#", anchor='center')
-        self.tree.column("#0", width=60, minwidth=60, stretch=False, anchor='center')
-        
-        # Configurar cada coluna
-        for col in colunas:
-            # Nome exibido (truncar se muito longo)
-            nome_exibido = col if len(col) <= 20 else col[:17] + "..."
-            
-            self.tree.heading(col, text=nome_exibido, anchor='w')
-            
-            # Calcular largura baseada no conteúdo
-            # Largura mínima: 100px
-            # Largura baseada no nome da coluna
-            col_width = max(100, len(col) * 8 + 20)
-            
-            # Verificar tamanho máximo dos dados (primeiras 100 linhas)
-            if len(df_show) > 0:
-                sample = df_show[col].head(100).astype(str)
-                max_len = sample.str.len().max()
-                data_width = min(max_len * 8 + 20, 400)  # Máximo 400px
-                col_width = max(col_width, data_width)
-            
-            self.tree.column(col, width=col_width, minwidth=80, stretch=True, anchor='w')
-        
-        # Adicionar dados (primeiras 1000 linhas para performance)
-        df_preview = df_show.head(1000)
-        
-        for idx, row in df_preview.iterrows():
-            valores = []
-            for col in colunas:
-                val = row[col]
-                if pd.isna(val):
-                    valores.append("")
-                else:
-                    val_str = str(val)
-                    # Truncar valores muito longos
-                    if len(val_str) > 50:
-                        valores.append(val_str[:47] + "...")
-                    else:
-                        valores.append(val_str)
-            
-            self.tree.insert("", tk.END, text=str(idx+1), values=valores)
+            self.grade.mostrar(df_show, colunas)
+        self.previa = False
         
         # Atualizar informações
         total = len(df_show)
         cols = len(df_show.columns)
-        showing = min(1000, total)
         
-        info = f"📊 {total:,} registros ({showing:,} exibidos) | 📋 {cols} colunas"
+        info = f"📊 {total:,} registros | 📋 {cols} colunas"
         
-        if self.df_processado is not None and 'ID_PACIENTE' in self.df_processado.columns:
-            unicos = self.df_processado['ID_PACIENTE'].nunique()
+        if 'ID_PACIENTE' in df_show.columns:
+            stats = df_show.attrs.get('estatisticas_cns')
+            if stats is not None:
+                unicos = stats['pacientes_unicos']
+            else:
+                unicos = df_show['ID_PACIENTE'].nunique()
             info += f" | 👥 {unicos:,} pacientes únicos"
         
         self.info_label.config(text=info)
         
         print(f"\n📺 Visualização atualizada:")
         print(f"   • Colunas exibidas: {len(colunas)}")
-        print(f"   • Registros exibidos: {showing:,} de {total:,}")
+        print(f"   • Registros navegáveis: {total:,}")
 
     def process_cns(self):
         """Processa CNS"""
         if self.df_original is None:
             messagebox.showerror("Erro", "Carregue dados primeiro")
             return
+        if self.carga_em_andamento():
+            return
         
         self.log(f"\n🔍 PROCESSANDO CNS...")
         
         janela = JanelaCarregamento(self.root, "Processando...")
+        compacto = self.compacto_var.get()
         
         def processar():
             try:
-                df_proc, erro = processar_cns(self.df_original)
+                derivadas, erro = processar_cns(self.df_original, somente_derivadas=True, compacto=compacto)
                 
                 janela.fechar()
                 
@@ -1441,7 +4575,7 @@ class SIAApp:
                     messagebox.showerror("Erro", erro)
                     self.log(f"❌ {erro}")
                 else:
-                    self.df_processado = df_proc
+                    self.cns_derivadas = derivadas
                     self.log(f"\n✅ CNS PROCESSADO!")
                     
                     self.root.after(0, self.mostrar_dados)
@@ -1454,7 +4588,9 @@ class SIAApp:
 
     def generate_report(self):
         """Gera relatório"""
-        df = self.df_processado if self.df_processado is not None else self.df_original
+        if self.carga_em_andamento():
+            return
+        df = self.dados_atuais()
         if df is None:
             messagebox.showerror("Erro", "Carregue dados primeiro")
             return
@@ -1467,7 +4603,9 @@ class SIAApp:
 
     def export_data(self):
         """Exporta dados"""
-        df = self.df_processado if self.df_processado is not None else self.df_original
+        if self.carga_em_andamento():
+            return
+        df = self.dados_atuais()
         if df is None:
             messagebox.showerror("Erro", "Carregue dados primeiro")
             return
@@ -1498,9 +4636,17 @@ class SIAApp:
         
         janela = JanelaCarregamento(self.root, f"Exportando {formato}...")
         
+        def progresso(info):
+            total = f"/{info['total']:,}" if info['total'] else ""
+            texto = f"{info['registros']:,}{total} registros, {info['mb_s']:.1f} MB/s"
+            self.root.after(0, janela.atualizar, texto)
+
+        opcoes = dict(dividir_por=(self.dividir_var.get() or None) if formato != 'Parquet' else None,
+                      excel_destino='arquivos' if self.excel_arquivos_var.get() else 'planilhas')
+
         def exportar():
             try:
-                sucesso, msg = exportar_dados(df, filename, formato)
+                sucesso, msg = exportar_dados(df, filename, formato, progresso=progresso, **opcoes)
                 
                 janela.fechar()
                 
@@ -1519,6 +4665,103 @@ class SIAApp:
 
 
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Sistema SIA APAC Medicamentos")
+    parser.add_argument('--dados', metavar='DIR',
+                        help="diretório de dados (padrão: $SIA_DADOS ou ./dados ao lado do script)")
+    parser.add_argument('--limpar-cache', metavar='MB', type=float, nargs='?', const=0,
+                        help="poda o cache de DBC até MB (sem valor: esvazia) e sai")
+    parser.add_argument('--sync', metavar='UF', nargs='+',
+                        help="sincroniza o dataset particionado com o FTP (só arquivos novos/alterados) e sai")
+    parser.add_argument('--ufs', metavar='UF', nargs='+',
+                        help="processa os UFs sem interface gráfica (download, CNS, exportação) e sai")
+    parser.add_argument('--converter', metavar='ARQUIVO', nargs='+',
+                        help="converte .dbc/.dbf locais em lotes (CNS, exportação), sem carregá-los inteiros, e sai")
+    parser.add_argument('--anos', metavar='ANO', type=int, nargs='+', help="anos (--ufs / --sync)")
+    parser.add_argument('--meses', metavar='MES', type=int, nargs='+', help="meses (padrão: 1 a 12)")
+    parser.add_argument('--grupos', metavar='GRUPO', nargs='+', default=['AM'], help="grupos SIA (padrão: AM)")
+    parser.add_argument('--formato', choices=['CSV', 'Parquet', 'Excel', 'TXT'], default='Parquet')
+    parser.add_argument('--saida', metavar='DIR', help="diretório de saída (padrão: diretório de dados; --converter: o do arquivo)")
+    parser.add_argument('--workers', type=int, default=4, help="downloads simultâneos")
+    parser.add_argument('--engine', choices=['native', 'docker'], default='native')
+    parser.add_argument('--ftp-host', metavar='HOST', default="ftp.datasus.gov.br",
+                        help="servidor FTP (padrão: ftp.datasus.gov.br), ex.: um espelho local")
+    parser.add_argument('--ftp-porta', metavar='PORTA', type=int, default=21, help="porta do FTP (padrão: 21)")
+    parser.add_argument('--sem-cns', action='store_true', help="não processa CNS")
+    parser.add_argument('--relatorio', action='store_true', help="grava o relatório em texto")
+    parser.add_argument('--compacto', action='store_true',
+                        help="exporta com o esquema compacto de tipos (categóricos, inteiros reduzidos)")
+    parser.add_argument('--compressao', choices=['snappy', 'zstd', 'gzip', 'brotli', 'lz4', 'none'],
+                        help="codec do Parquet (padrão: snappy) ou do CSV/TXT (gzip, zstd; padrão: sem compressão)")
+    parser.add_argument('--linhas-grupo', metavar='N', type=int,
+                        help=f"linhas por row group do Parquet (padrão: {LINHAS_LOTE_EXPORTACAO:,})")
+    parser.add_argument('--dividir-por', metavar='COLUNA',
+                        help="CSV/TXT: um arquivo por valor da coluna (ex.: UF, MES); Excel: uma série de planilhas")
+    parser.add_argument('--partes', metavar='N', type=int,
+                        help="CSV/TXT: divide em N arquivos gravados em paralelo, com manifesto")
+    parser.add_argument('--limite-linhas', metavar='N', type=int,
+                        help=f"Excel: linhas por planilha (padrão e máximo: {LINHAS_EXCEL:,})")
+    parser.add_argument('--excel-arquivos', action='store_true',
+                        help="Excel: um arquivo .xlsx por planilha em vez de várias planilhas no mesmo arquivo")
+    parser.add_argument('--json', metavar='ARQUIVO', default='-',
+                        help="resumo JSON do --ufs (padrão '-': stdout, com o log em stderr)")
+    args = parser.parse_args()
+
+    if args.dados:
+        definir_diretorio_dados(args.dados)
+
+    if args.limpar_cache is not None:
+        DBCCache().limpar(args.limpar_cache)
+        raise SystemExit(0)
+
+    if args.sync:
+        downloader = SIADownloader(ftp_host=args.ftp_host, ftp_port=args.ftp_porta)
+        ok = True
+        for grupo in args.grupos:
+            resumo = downloader.sincronizar(args.sync, anos=args.anos, grupo=grupo.upper(),
+                                            workers=args.workers, engine=args.engine)
+            ok = ok and resumo is not None and resumo['falhas'] == 0
+        downloader.fechar()
+        raise SystemExit(0 if ok else 1)
+
+    if args.converter:
+        resultados = converter_arquivos(
+            args.converter, formato=args.formato, saida=args.saida, processar=not args.sem_cns,
+            compressao=args.compressao, linhas_grupo=args.linhas_grupo, dividir_por=args.dividir_por,
+            limite_linhas=args.limite_linhas, excel_destino='arquivos' if args.excel_arquivos else 'planilhas',
+            partes=args.partes)
+        raise SystemExit(0 if all(sucesso for _, sucesso, _ in resultados) else 1)
+
+    if args.ufs:
+        import contextlib
+        import json
+        import sys
+
+        if not args.anos:
+            parser.error("--ufs requer --anos")
+
+        opcoes = dict(meses=args.meses, grupos=[g.upper() for g in args.grupos], formato=args.formato,
+                      saida=args.saida, workers=args.workers, engine=args.engine,
+                      processar=not args.sem_cns, relatorio=args.relatorio, compacto=args.compacto,
+                      compressao=args.compressao, linhas_grupo=args.linhas_grupo,
+                      dividir_por=args.dividir_por, limite_linhas=args.limite_linhas,
+                      excel_destino='arquivos' if args.excel_arquivos else 'planilhas', partes=args.partes,
+                      ftp_host=args.ftp_host, ftp_port=args.ftp_porta)
+        ufs = [uf.upper() for uf in args.ufs]
+        if args.json == '-':
+            # stdout fica só com o JSON
+            with contextlib.redirect_stdout(sys.stderr):
+                resumo = processar_lote(ufs, args.anos, **opcoes)
+            print(json.dumps(resumo, ensure_ascii=False, indent=2, default=str))
+        else:
+            resumo = processar_lote(ufs, args.anos, **opcoes)
+            Path(args.json).write_text(json.dumps(resumo, ensure_ascii=False, indent=2, default=str),
+                                       encoding='utf-8')
+            print(f"📄 Resumo: {args.json}")
+        raise SystemExit(0 if resumo['ok'] else 1)
+
+    print("🚀 Sistema SIA APAC Medicamentos - Carregando...")
     print("=" * 60)
     print("SISTEMA SIA APAC MEDICAMENTOS")
     print("=" * 60)
@@ -1530,6 +4773,7 @@ if __name__ == "__main__":
 
     # Iniciar
     try:
+        _carregar_tkinter()
         root = tk.Tk()
         app = SIAApp(root)
         
@@ -0,0 +1,41 @@
+"""
+Compara o laço registro a registro original com a decodificação vetorizada
+(DBCConverter._decode_dbf_records) nos registros da amostra repetidos.
+
+    python tests/benchmark_decodificacao.py [repeticoes]
+
+Com o padrão (200 repetições: 240.000 registros, 229.600 não apagados).
+"""
+import struct
+import sys
+import time
+
+from conftest import AMOSTRA_DBC  # também coloca o SIA_Conv_CNS no sys.path
+from SIA_Conv_CNS import DBCConverter
+from test_dbc import dbf_descomprimido, decodificar_registro_a_registro
+
+
+def main(repeticoes=200, encoding='latin-1'):
+    amostra = dbf_descomprimido(AMOSTRA_DBC)
+    record_count, header_length, record_length = struct.unpack('<IHH', amostra[4:12])
+    registros = amostra[header_length:header_length + record_count * record_length]
+    cabecalho = bytearray(amostra[:header_length])
+    cabecalho[4:8] = struct.pack('<I', record_count * repeticoes)
+    dbf = bytes(cabecalho) + registros * repeticoes
+
+    inicio = time.perf_counter()
+    fields, esperado = decodificar_registro_a_registro(dbf, encoding)
+    laco = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    colunas = DBCConverter._decode_dbf_records(dbf, fields, header_length, record_length,
+                                               record_count * repeticoes, encoding)
+    vetorizado = time.perf_counter() - inicio
+
+    assert [list(coluna) for coluna in colunas] == esperado
+    print(f"{len(esperado[0]):,} registros, {len(fields)} campos")
+    print(f"laço original: {laco:.2f} s | vetorizado: {vetorizado:.2f} s | {laco / vetorizado:.1f}x")
+
+
+if __name__ == '__main__':
+    main(*(int(a) for a in sys.argv[1:2]))
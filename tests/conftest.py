@@ -0,0 +1,47 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import SIA_Conv_CNS  # noqa: E402
+
+# DBC pequeno (1.200 registros, 48 apagados) com campos C, N, F, D e L
+AMOSTRA_DBC = Path(__file__).parent / 'dados' / 'amostra.dbc'
+
+
+@pytest.fixture(autouse=True)
+def diretorio_dados(tmp_path, monkeypatch):
+    """Caches e arquivos gerados ficam num diretório temporário por teste"""
+    caminho = tmp_path / 'dados'
+    monkeypatch.setattr(SIA_Conv_CNS, 'base_path', str(caminho))
+    return caminho
+
+
+def escrever_dbf(caminho, campos, registros):
+    """
+    Grava um .dbf dBase III: `campos` é uma lista de (nome, tipo, tamanho,
+    decimais) e cada registro uma tupla de textos (alinhados como no DBF).
+    """
+    import struct
+
+    tamanho_registro = 1 + sum(tamanho for _, _, tamanho, _ in campos)
+    cabecalho = bytearray(32)
+    cabecalho[0] = 0x03
+    cabecalho[4:12] = struct.pack('<IHH', len(registros), 32 + 32 * len(campos) + 1, tamanho_registro)
+    for nome, tipo, tamanho, decimais in campos:
+        descritor = bytearray(32)
+        descritor[:len(nome)] = nome.encode('ascii')
+        descritor[11] = ord(tipo)
+        descritor[16:18] = bytes([tamanho, decimais])
+        cabecalho += descritor
+    cabecalho += b'\r'
+
+    dados = bytearray()
+    for registro in registros:
+        dados += b' '
+        for (_, tipo, tamanho, _), valor in zip(campos, registro):
+            valor = valor.encode('latin-1')
+            dados += valor.rjust(tamanho) if tipo in 'NF' else valor.ljust(tamanho)
+    Path(caminho).write_bytes(bytes(cabecalho) + bytes(dados) + b'\x1a')
@@ -0,0 +1,55 @@
+import pandas as pd
+import pytest
+
+from SIA_Conv_CNS import processar_cns, validar_cns
+
+
+@pytest.mark.parametrize('cns, tipo', [
+    ('100000000000007', 'definitivo'),      # PIS + 000 + DV
+    ('200000000050000', 'definitivo'),      # DV 11 → 0
+    ('100000000060018', 'definitivo'),      # DV 10 → soma + 2 e 001
+    ('100000000060008', 'invalido'),        # 000 onde a regra pede 001
+    ('100000000000017', 'invalido'),        # 001 onde a regra pede 000
+    ('100000000000008', 'invalido'),        # DV errado
+    ('700000000000102', 'provisorio'),
+    ('812345678901208', 'provisorio'),
+    ('900000000000008', 'provisorio'),
+    ('700000000000103', 'invalido'),        # soma não múltipla de 11
+    ('300000000000007', 'invalido'),        # prefixo inválido
+    ('1000 0000 0000 007', 'definitivo'),   # separadores são descartados
+    ('12345', 'invalido'),                  # curto: zeros à esquerda
+    ('10000000000000A', 'invalido'),        # 14 dígitos + letra
+    ('ABC', 'sem_cns'),
+    ('', 'sem_cns'),
+    (None, 'sem_cns'),
+])
+def test_validacao_vetorizada_igual_ao_validar_cns(cns, tipo):
+    df = pd.DataFrame({'AP_CNSPCN': [cns], 'AP_MUNPCN': ['310620']})
+
+    resultado, erro = processar_cns(df, verbose=False)
+
+    assert erro is None
+    linha = resultado.iloc[0]
+    assert linha['CNS_TIPO'] == tipo
+    if tipo == 'sem_cns':
+        assert linha['CNS_PADRONIZADO'] == 'SEM_CNS' and not linha['CNS_VALIDO']
+    else:
+        assert (bool(linha['CNS_VALIDO']), linha['CNS_TIPO']) == validar_cns(linha['CNS_PADRONIZADO'])
+
+
+def test_validacao_vetorizada_em_lote():
+    import random
+
+    aleatorio = random.Random(3)
+    cns = [str(aleatorio.choice('12789')) + ''.join(aleatorio.choice('0123456789') for _ in range(14))
+           for _ in range(5000)]
+    # Com o DV corrigido, parte dos definitivos/provisórios passa a ser válida
+    cns += [c[:14] + str(d) for c in cns[:500] for d in range(10)]
+    df = pd.DataFrame({'AP_CNSPCN': cns, 'AP_MUNPCN': '310620'})
+
+    resultado, erro = processar_cns(df, verbose=False)
+
+    assert erro is None
+    esperado = [validar_cns(c) for c in cns]
+    assert list(zip(resultado['CNS_VALIDO'].astype(bool), resultado['CNS_TIPO'])) == esperado
+    assert {'definitivo', 'provisorio', 'invalido'} <= set(resultado['CNS_TIPO'])
@@ -0,0 +1,183 @@
+import datetime
+import random
+import struct
+
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+import SIA_Conv_CNS
+from SIA_Conv_CNS import CacheConversao, DBCCache, DBCConverter, _iter_pkware_explode, converter_coluna_cns
+from conftest import AMOSTRA_DBC, escrever_dbf
+
+
+def ler_com_dbfread(dbc, tmp_path):
+    """Mesma leitura do script Docker: pyreaddbc + dbfread, com o AP_CNSPCN remapeado"""
+    pyreaddbc = pytest.importorskip('pyreaddbc')
+    dbfread = pytest.importorskip('dbfread')
+
+    dbf = tmp_path / 'amostra.dbf'
+    pyreaddbc.dbc2dbf(str(dbc), str(dbf))
+    df = pd.DataFrame(list(dbfread.DBF(str(dbf), encoding='latin-1')))
+    df['AP_CNSPCN'] = converter_coluna_cns(df['AP_CNSPCN'])
+    return df
+
+
+def test_engine_nativo_igual_ao_dbfread(tmp_path):
+    esperado = ler_com_dbfread(AMOSTRA_DBC, tmp_path)
+    df = DBCConverter.read_dbc(str(AMOSTRA_DBC), engine='native', cache=False)
+
+    # Mesmos valores; os tipos vêm do cabeçalho em vez dos valores
+    pd.testing.assert_frame_equal(df, esperado.astype(df.dtypes.to_dict()))
+
+
+def test_tipos_dos_campos_dbf():
+    df = DBCConverter.read_dbc(str(AMOSTRA_DBC), cache=False)
+
+    assert df['AP_QTAPR'].dtype == 'float64'        # N inteiro sem vazios
+    assert df['AP_NUIDADE'].dtype == 'float64'      # N inteiro com vazios
+    assert df['AP_VL_AP'].dtype == 'float64'        # N(12,0) com decimais
+    assert df['AP_PESO'].dtype == 'float64'         # F
+    assert df['AP_ALTA'].dtype == 'boolean'         # L só com T/F
+    assert df['AP_OBITO'].dtype == 'boolean'        # L com '?'
+    assert df['AP_DTINIC'].dtype == pd.ArrowDtype(pa.date32())
+    assert df['AP_DTINIC'].dropna().map(type).eq(datetime.date).all()
+    assert pd.api.types.is_string_dtype(df['AP_MUNPCN'])
+
+
+def test_cache_de_conversao_preserva_tipos():
+    primeira = DBCConverter.read_dbc(str(AMOSTRA_DBC))
+    segunda = DBCConverter.read_dbc(str(AMOSTRA_DBC))
+
+    pd.testing.assert_frame_equal(primeira, segunda)
+
+
+@pytest.mark.parametrize('batch_rows', [50, 400, 700])   # 1.200 registros: 50 e 400 dividem exato, 700 não
+def test_iter_batches_concatenado_igual_ao_read_dbc(batch_rows):
+    esperado = DBCConverter.read_dbc(str(AMOSTRA_DBC), engine='native', cache=False)
+    lotes = list(DBCConverter.iter_batches(str(AMOSTRA_DBC), batch_rows=batch_rows))
+
+    assert all(0 < len(lote) <= batch_rows for lote in lotes)
+    pd.testing.assert_frame_equal(pd.concat(lotes), esperado)
+
+
+@pytest.mark.parametrize('nome', ['_blast_construir_tabela', '_blast_tabelas', '_BLAST_LEN_BASE'])
+def test_versao_do_conversor_muda_com_o_descompressor(monkeypatch, nome):
+    original = DBCConverter._versao_conversor()
+    monkeypatch.setattr(DBCConverter, '_versao', None)
+    monkeypatch.setattr(SIA_Conv_CNS, nome, (lambda *a: None) if nome.islower() else (0,) * 16)
+
+    assert DBCConverter._versao_conversor() not in (None, original)
+
+
+@pytest.mark.parametrize('nome', ['_decode_dbf_value', '_parse_dbf_from_file', '_montar_dataframe'])
+def test_versao_do_conversor_muda_com_o_parser(monkeypatch, nome):
+    original = DBCConverter._versao_conversor()
+    monkeypatch.setattr(DBCConverter, '_versao', None)
+    monkeypatch.setattr(DBCConverter, nome, staticmethod(lambda *a: None))
+
+    assert DBCConverter._versao_conversor() not in (None, original)
+
+
+def ler_com_cache(sha256, limite_mb):
+    """Lê a amostra com o cache de conversão indexado por um SHA-256 fictício"""
+    return DBCConverter.read_dbc(str(AMOSTRA_DBC), sha256=sha256 * 64, cache_limite_mb=limite_mb)
+
+
+def test_cache_de_conversao_remove_os_menos_usados(diretorio_dados):
+    conversoes = CacheConversao()
+    ler_com_cache('a', 100)
+    tamanho_mb = conversoes.tamanho_total / (1024 * 1024)
+    limite = 2.5 * tamanho_mb     # cabem duas conversões
+
+    ler_com_cache('b', limite)
+    ler_com_cache('a', limite)    # acesso: 'b' passa a ser a menos usada
+    ler_com_cache('c', limite)
+
+    em_cache = [c for c in 'abc'
+                if DBCConverter._caminho_cache_conversao(str(AMOSTRA_DBC), 'latin-1', 'native', c * 64).exists()]
+    assert em_cache == ['a', 'c']
+    assert conversoes.tamanho_total <= limite * 1024 * 1024
+
+
+def test_limpar_cache_dbc_esvazia_cache_de_conversao(diretorio_dados):
+    ler_com_cache('a', 100)
+    ler_com_cache('b', 100)
+
+    removidos, liberado = DBCCache().limpar(0)
+
+    assert removidos == 2 and liberado > 0
+    assert list((diretorio_dados / 'cache_conversao').iterdir()) == []
+
+
+def dbf_descomprimido(dbc):
+    """Cabeçalho e registros do DBC descomprimidos (o .dbf que o pyreaddbc gravaria)"""
+    with open(dbc, 'rb') as f:
+        inicio = f.read(32)
+        cabecalho = bytearray(inicio + f.read(struct.unpack('<H', inicio[8:10])[0] - 32))
+        cabecalho[-1] = 0x0D
+        f.read(4)   # CRC32
+        return bytes(cabecalho) + b''.join(_iter_pkware_explode(f))
+
+
+def decodificar_registro_a_registro(dbf, encoding):
+    """
+    Laço registro a registro que _decode_dbf_records substituiu (referência):
+    uma lista de valores por campo, None nos vazios e em 'nan'.
+    """
+    record_count, header_length, record_length = struct.unpack('<IHH', dbf[4:12])
+    fields, _ = DBCConverter._read_dbf_fields(dbf, (header_length - 33) // 32, encoding, detect_encoding=False)
+
+    records = []
+    for rec_num in range(record_count):
+        record_data = dbf[header_length + rec_num * record_length:header_length + (rec_num + 1) * record_length]
+        if len(record_data) < record_length:
+            break
+        if record_data[0] == 0x2A:  # Deletado
+            continue
+
+        row = []
+        field_pos = 1
+        for field in fields:
+            value_str = record_data[field_pos:field_pos + field['length']].decode(encoding, errors='replace').strip()
+            if field['type'] in ['N', 'C']:
+                value_str = value_str.replace('\x00', '').strip()
+            else:
+                value_str = ''.join(char for char in value_str if char.isprintable() or char in ['\n', '\t'])
+            row.append(value_str.strip())
+            field_pos += field['length']
+
+        if any(row):
+            records.append([None if v in ('', 'nan') else v for v in row])
+
+    return fields, [list(coluna) for coluna in zip(*records)]
+
+
+def dbf_casos_dificeis(caminho):
+    """Espaços, NUL, caracteres de controle, 'nan', acentos, registros vazios e apagados"""
+    campos = [('NOME', 'C', 10, 0), ('AP_QTAPR', 'N', 5, 0), ('AP_DTINIC', 'D', 8, 0), ('AP_OBITO', 'L', 1, 0)]
+    nomes = ['  Ana', 'José  ', 'x\x00y', 'nan', 'Conceição', '', '\x7b|}~', 'a\x01b']
+    datas = ['20240115', '', '00000000', '2024\x0201', 'nan']
+    aleatorio = random.Random(7)
+    registros = [(aleatorio.choice(nomes), aleatorio.choice(['', '1', ' 12', 'nan', '3\x00']),
+                  aleatorio.choice(datas), aleatorio.choice('TF? ')) for _ in range(300)]
+    registros[10] = ('', '', '', ' ')   # registro todo vazio
+    escrever_dbf(caminho, campos, registros)
+
+    dbf = bytearray(caminho.read_bytes())
+    header_length, record_length = struct.unpack('<HH', dbf[8:12])
+    for apagado in (0, 5, 299):
+        dbf[header_length + apagado * record_length] = 0x2A
+    return bytes(dbf)
+
+
+@pytest.mark.parametrize('encoding', ['latin-1', 'cp850', 'utf-8'])
+@pytest.mark.parametrize('origem', ['amostra', 'casos_dificeis'])
+def test_decodificacao_vetorizada_igual_ao_laco_original(tmp_path, origem, encoding):
+    dbf = dbf_descomprimido(AMOSTRA_DBC) if origem == 'amostra' else dbf_casos_dificeis(tmp_path / 'casos.dbf')
+    fields, esperado = decodificar_registro_a_registro(dbf, encoding)
+    record_count, header_length, record_length = struct.unpack('<IHH', dbf[4:12])
+
+    colunas = DBCConverter._decode_dbf_records(dbf, fields, header_length, record_length, record_count, encoding)
+
+    assert [list(coluna) for coluna in colunas] == esperado
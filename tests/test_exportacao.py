@@ -0,0 +1,173 @@
+import datetime
+import gzip
+import hashlib
+import json
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from SIA_Conv_CNS import DBCConverter, compactar_tipos, exportar_dados, processar_cns
+from conftest import AMOSTRA_DBC, escrever_dbf
+
+RAIZ = Path(__file__).resolve().parents[1]
+
+
+def arquivo_exportado(msg, pasta):
+    return pasta / msg.split('Salvo: ')[1].split(' (')[0]
+
+
+@pytest.mark.parametrize('formato, sep, encoding', [('CSV', ';', 'utf-8-sig'), ('TXT', '\t', 'utf-8')])
+def test_texto_igual_ao_to_csv(tmp_path, formato, sep, encoding):
+    df = pd.DataFrame({
+        'CNS_VALIDO': [True, False, True, False],
+        'AP_OBITO': pd.array([True, None, False, None], dtype=object),
+        'AP_VL_TOT': [2.0, 1e-07, None, -0.0],
+        'AP_QTAPR': [1, 2, 3, 4],
+        'NOME': ['a;b', '', 'x"y', 'tab\taqui'],
+        'AP_CIDPRI': ['A01', None, 'linha\nquebrada', 'B02'],
+        'AP_DTINIC': [datetime.date(2020, 1, 2), None, datetime.date(2021, 3, 4), None],
+        'DATA': pd.to_datetime(['2020-01-02', '2020-01-03', None, '2020-01-04']),
+        'HORA': pd.to_datetime(['2020-01-02 10:11:12.5', '2020-01-03', None, '2020-01-04 08:00:00.25'], format='ISO8601'),
+        'UF': pd.Categorical(['MG', 'SP', None, 'MG']),
+        'A;B': [1, 2, 3, 4],
+    })
+
+    ok, msg = exportar_dados(df, tmp_path / 'x', formato, linhas_lote=3)
+
+    assert ok, msg
+    esperado = df.to_csv(index=False, sep=sep, lineterminator='\n').encode(encoding)
+    assert arquivo_exportado(msg, tmp_path).read_bytes() == esperado
+
+
+def test_esquema_compacto_volta_igual_do_parquet(tmp_path):
+    df = DBCConverter.read_dbc(str(AMOSTRA_DBC), cache=False).assign(UF='MG', ANO=2024, MES=1, GRUPO='AM')
+    df, erro = processar_cns(df, verbose=False)
+    assert erro is None
+    compacto = compactar_tipos(df, verbose=False)
+
+    ok, msg = exportar_dados(compacto, tmp_path / 'x', 'Parquet')
+
+    assert ok, msg
+    pd.testing.assert_series_equal(pd.read_parquet(arquivo_exportado(msg, tmp_path)).dtypes, compacto.dtypes)
+
+
+CAMPOS_VAZIOS = [('AP_CNSPCN', 'C', 15, 0), ('AP_MUNPCN', 'C', 6, 0), ('AP_QTAPR', 'N', 5, 0),
+                 ('AP_VL_TOT', 'N', 12, 2), ('AP_DTINIC', 'D', 8, 0), ('AP_OBITO', 'L', 1, 0)]
+
+
+def dbf_com_vazios(caminho):
+    """N, D e L todos vazios nos 10 primeiros registros (o primeiro lote) e preenchidos depois"""
+    registros = []
+    for i in range(35):
+        if i < 10:
+            registros.append(('100000000000007', '310620', '', '', '', ' '))
+        else:
+            registros.append(('700000000000102', '355030', str(i), f'{i * 1.5:.2f}',
+                              f'2024{i % 12 + 1:02d}15', 'TF?'[i % 3]))
+    escrever_dbf(caminho, CAMPOS_VAZIOS, registros)
+    return caminho
+
+
+@pytest.mark.parametrize('formato', ['Parquet', 'CSV'])
+def test_lotes_com_campos_vazios_no_primeiro_lote(tmp_path, formato):
+    dbf = str(dbf_com_vazios(tmp_path / 'vazios.dbf'))
+    esperado = pd.concat(DBCConverter.iter_batches(dbf))
+
+    ok, msg = exportar_dados(DBCConverter.iter_batches(dbf, batch_rows=10), tmp_path / 'x', formato,
+                             linhas_lote=10)
+
+    assert ok, msg
+    arquivo = arquivo_exportado(msg, tmp_path)
+    if formato == 'Parquet':
+        pd.testing.assert_frame_equal(pd.read_parquet(arquivo), esperado.reset_index(drop=True))
+    else:
+        texto = esperado.to_csv(index=False, sep=';', lineterminator='\n').encode('utf-8-sig')
+        assert arquivo.read_bytes() == texto
+    assert esperado['AP_DTINIC'].iloc[10] == datetime.date(2024, 11, 15)
+
+
+def test_cli_converter_em_lotes(tmp_path):
+    dbf = dbf_com_vazios(tmp_path / 'vazios.dbf')
+
+    saida = subprocess.run([sys.executable, str(RAIZ / 'SIA_Conv_CNS.py'), '--dados', str(tmp_path / 'dados'),
+                            '--converter', str(dbf), '--saida', str(tmp_path / 'saida')],
+                           capture_output=True, text=True, timeout=300)
+
+    assert saida.returncode == 0, saida.stdout + saida.stderr
+    arquivo, = (tmp_path / 'saida').glob('vazios_*.parquet')
+    df = pd.read_parquet(arquivo)
+    assert len(df) == 35
+    assert df['CNS_TIPO'].tolist() == ['definitivo'] * 10 + ['provisorio'] * 25
+    assert df['AP_QTAPR'].isna().sum() == 10 and df['AP_OBITO'].dtype == 'boolean'
+
+
+def linhas_por_planilha(pasta):
+    """{(sufixo do arquivo, planilha): AP_MUNPCN das linhas de dados} de todos os .xlsx da pasta"""
+    import openpyxl
+
+    planilhas = {}
+    for arquivo in sorted(pasta.glob('*.xlsx')):
+        sufixo = re.sub(r'^x_\d{8}_\d{6}_?', '', arquivo.stem)
+        livro = openpyxl.load_workbook(arquivo, read_only=True)
+        for planilha in livro.worksheets:
+            assert next(planilha.iter_rows(max_row=1, values_only=True))[2] == 'AP_MUNPCN'
+            planilhas[(sufixo, planilha.title)] = [linha[2] for linha in
+                                                   planilha.iter_rows(min_row=2, max_col=3, values_only=True)]
+        livro.close()
+    return planilhas
+
+
+@pytest.mark.parametrize('dividir_por, destino, esperado', [
+    (None, 'planilhas', [('', 'Dados'), ('', 'Dados_2'), ('', 'Dados_3')]),
+    (None, 'arquivos', [('parte1', 'Dados'), ('parte2', 'Dados'), ('parte3', 'Dados')]),
+    ('GRUPO', 'planilhas', [('', 'GRUPO_AM'), ('', 'GRUPO_AM_2'), ('', 'GRUPO_AM_3')]),
+    ('GRUPO', 'arquivos', [('GRUPO_AM', 'Dados'), ('GRUPO_AM_2', 'Dados'), ('GRUPO_AM_3', 'Dados')]),
+])
+def test_excel_dividido_em_planilhas_e_arquivos(tmp_path, dividir_por, destino, esperado):
+    pytest.importorskip('openpyxl')
+    df = DBCConverter.read_dbc(str(AMOSTRA_DBC), cache=False).assign(GRUPO='AM')
+    pasta = tmp_path / 'excel'
+    pasta.mkdir()
+
+    ok, msg = exportar_dados(df, pasta / 'x', 'Excel', linhas_lote=300, dividir_por=dividir_por,
+                             limite_linhas=500, excel_destino=destino)
+
+    assert ok, msg
+    planilhas = linhas_por_planilha(pasta)
+    assert list(planilhas) == esperado
+    assert [len(linhas) for linhas in planilhas.values()] == [500, 500, 148]
+    assert sum(planilhas.values(), []) == df['AP_MUNPCN'].tolist()
+
+
+@pytest.mark.parametrize('entrada', ['dataframe', 'lotes'])
+def test_csv_gzip_em_partes_com_manifesto(tmp_path, entrada):
+    df = DBCConverter.read_dbc(str(AMOSTRA_DBC), cache=False)
+    dados = df if entrada == 'dataframe' else DBCConverter.iter_batches(str(AMOSTRA_DBC), batch_rows=100)
+
+    ok, msg = exportar_dados(dados, tmp_path / 'x', 'CSV', compressao='gzip', partes=3, linhas_lote=100)
+
+    assert ok, msg
+    manifesto, = tmp_path.glob('x_*_manifesto.json')
+    manifesto = json.loads(manifesto.read_text(encoding='utf-8'))
+    assert [item['arquivo'].split('_')[-1] for item in manifesto['arquivos']] == \
+        ['parte001.csv.gz', 'parte002.csv.gz', 'parte003.csv.gz']
+    assert manifesto['registros'] == len(df) == 1148
+
+    cabecalho, *esperadas = df.to_csv(index=False, sep=';', lineterminator='\n').splitlines()
+    linhas = []
+    for item in manifesto['arquivos']:
+        arquivo = tmp_path / item['arquivo']
+        conteudo = arquivo.read_bytes()
+        assert item['sha256'] == hashlib.sha256(conteudo).hexdigest()
+        assert item['bytes'] == len(conteudo)
+        primeira, *parte = gzip.decompress(conteudo).decode('utf-8-sig').splitlines()
+        assert primeira == cabecalho
+        assert item['registros'] == len(parte) > 0
+        linhas += parte
+
+    # DataFrame: cada parte é um intervalo contínuo; lotes: distribuídos em rodízio
+    assert linhas == esperadas if entrada == 'dataframe' else sorted(linhas) == sorted(esperadas)
@@ -0,0 +1,247 @@
+import ftplib
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+from SIA_Conv_CNS import FTPSessionPool, SIADownloader
+from conftest import AMOSTRA_DBC
+
+pytest.importorskip('pyftpdlib')
+
+from pyftpdlib.authorizers import DummyAuthorizer  # noqa: E402
+from pyftpdlib.handlers import FTPHandler  # noqa: E402
+from pyftpdlib.servers import ThreadedFTPServer  # noqa: E402
+
+RAIZ = Path(__file__).resolve().parents[1]
+
+
+class ServidorFTP:
+    """FTP anônimo local servindo `raiz`, contando conexões e comandos recebidos"""
+
+    def __init__(self, raiz):
+        self.raiz = raiz
+        self.conexoes = 0
+        self.comandos = []
+        self.quedas_retr = 0      # próximos RETR que derrubam a conexão
+        servidor = self
+
+        class Handler(FTPHandler):
+            def on_connect(self):
+                servidor.conexoes += 1
+
+            def pre_process_command(self, line, cmd, arg):
+                servidor.comandos.append(cmd)
+                return super().pre_process_command(line, cmd, arg)
+
+            def ftp_RETR(self, file):
+                if servidor.quedas_retr:
+                    servidor.quedas_retr -= 1
+                    self.close()
+                    return
+                return super().ftp_RETR(file)
+
+        autorizador = DummyAuthorizer()
+        autorizador.add_anonymous(str(raiz))
+        Handler.authorizer = autorizador
+        logging.getLogger('pyftpdlib').setLevel(logging.CRITICAL)
+        self._servidor = ThreadedFTPServer(('127.0.0.1', 0), Handler)
+        self.porta = self._servidor.address[1]
+        self._thread = threading.Thread(target=self._servidor.serve_forever, kwargs={'timeout': 0.05},
+                                        daemon=True)
+        self._thread.start()
+
+    def fechar(self):
+        self._servidor.close_all()
+        self._thread.join(timeout=5)
+
+
+def tamanho(nome):
+    """Operação do pool: SIZE (em modo binário, como no download)"""
+    def operacao(ftp):
+        ftp.voidcmd('TYPE I')
+        return ftp.size(nome)
+    return operacao
+
+
+@pytest.fixture
+def servidor(tmp_path):
+    raiz = tmp_path / 'ftp'
+    (raiz / 'Dados').mkdir(parents=True)
+    (raiz / 'Dados' / 'PAMG2401.dbc').write_bytes(bytes(range(250)) * 4)
+    (raiz / 'Dados' / 'PAMG2402.dbc').write_bytes(b'y' * 500)
+    servidor = ServidorFTP(raiz)
+    yield servidor
+    servidor.fechar()
+
+
+@pytest.fixture
+def downloader(servidor):
+    downloader = SIADownloader(ftp_host='127.0.0.1', ftp_port=servidor.porta, ftp_path='/Dados/', backoff=0)
+    yield downloader
+    downloader.fechar()
+
+
+@pytest.fixture
+def pool(servidor):
+    pool = FTPSessionPool('127.0.0.1', '/Dados/', tamanho=2, port=servidor.porta, timeout=10)
+    yield pool
+    pool.fechar()
+
+
+def test_pool_reaproveita_a_sessao(pool, servidor):
+    assert pool.executar(tamanho('PAMG2401.dbc')) == 1000
+    assert pool.executar(tamanho('PAMG2402.dbc')) == 500
+
+    assert servidor.conexoes == 1
+    assert servidor.comandos.count('CWD') == 1
+
+
+def test_pool_devolve_a_sessao_apos_resposta_5xx(pool, servidor):
+    with pytest.raises(ftplib.error_perm):
+        pool.executar(tamanho('NAOEXISTE.dbc'))
+
+    assert len(pool._livres) == 1
+    assert pool.executar(tamanho('PAMG2401.dbc')) == 1000
+    assert servidor.conexoes == 1
+
+
+def test_pool_conexao_recusada_nao_devolve_sessao(servidor):
+    pool = FTPSessionPool('127.0.0.1', '/inexistente/', port=servidor.porta, timeout=10)
+
+    with pytest.raises(ftplib.error_perm):
+        pool.executar(lambda ftp: ftp.pwd())
+
+    assert pool._livres == []
+
+
+def test_pool_reconecta_apos_queda(pool, servidor):
+    chamadas = []
+
+    def operacao(ftp):
+        chamadas.append(ftp)
+        if len(chamadas) == 1:
+            ftp.sock.shutdown(socket.SHUT_RDWR)
+        return tamanho('PAMG2401.dbc')(ftp)
+
+    assert pool.executar(operacao) == 1000
+
+    assert len(chamadas) == 2 and chamadas[0] is not chamadas[1]
+    assert servidor.conexoes == 2
+    assert [ftp for ftp, _ in pool._livres] == [chamadas[1]]
+
+
+def test_pool_descarta_sessao_parada_que_caiu(pool, servidor):
+    pool.keepalive = 0
+    pool.executar(lambda ftp: ftp.sock.shutdown(socket.SHUT_RDWR))
+
+    assert pool.executar(tamanho('PAMG2402.dbc')) == 500
+    assert servidor.conexoes == 2
+
+
+def test_listagem_em_cache(downloader, servidor):
+    listagem = downloader.listar_diretorio()
+    assert listagem['PAMG2401.DBC']['tamanho'] == 1000
+    assert downloader.info_arquivo('pamg2402.dbc')['tamanho'] == 500
+    assert downloader.info_arquivo('PAMG2403.dbc') is None
+    assert servidor.comandos.count('MLSD') == 1
+
+    downloader.listar_diretorio(atualizar=True)
+    assert servidor.comandos.count('MLSD') == 2
+
+    downloader.cache_ttl = 0
+    downloader.listar_diretorio()
+    assert servidor.comandos.count('MLSD') == 3
+
+
+def test_download_repete_apos_quedas(downloader, servidor):
+    # O pool tenta duas conexões por chamada; a terceira queda esgota a
+    # primeira tentativa do download e a segunda tentativa conclui
+    servidor.quedas_retr = 3
+
+    caminho = downloader.download_arquivo('PA', 'MG', 2024, 1)
+
+    assert caminho is not None
+    assert open(caminho, 'rb').read() == (servidor.raiz / 'Dados' / 'PAMG2401.dbc').read_bytes()
+    assert servidor.comandos.count('RETR') == 4
+    assert servidor.quedas_retr == 0
+
+
+def test_cache_registra_tamanho_e_data_do_servidor_apos_divergencia(downloader, servidor, diretorio_dados):
+    downloader.listar_diretorio()
+    # Arquivo republicado depois da listagem: o download confere e consulta de novo
+    arquivo = servidor.raiz / 'Dados' / 'PAMG2401.dbc'
+    arquivo.write_bytes(b'z' * 1200)
+    os.utime(arquivo, (1893456000, 1893456000))   # 2030-01-01 00:00:00 UTC
+
+    caminho = downloader.download_arquivo('PA', 'MG', 2024, 1)
+
+    assert open(caminho, 'rb').read() == b'z' * 1200
+    entrada = json.loads((diretorio_dados / 'dbc_cache.json').read_text())['PAMG2401.dbc']
+    assert entrada['tamanho'] == 1200
+    assert entrada['modificado'] == '2030-01-01T00:00:00'
+
+
+def parcial(diretorio, conteudo, **origem):
+    """Deixa um PAMG2401.dbc.part com `conteudo` e, se informado, o .part.json com `origem`"""
+    diretorio.mkdir(parents=True, exist_ok=True)
+    (diretorio / 'PAMG2401.dbc.part').write_bytes(conteudo)
+    if origem:
+        (diretorio / 'PAMG2401.dbc.part.json').write_text(json.dumps(origem))
+
+
+def test_download_retoma_parcial_do_mesmo_arquivo(downloader, servidor, diretorio_dados):
+    original = (servidor.raiz / 'Dados' / 'PAMG2401.dbc').read_bytes()
+    info = downloader.info_arquivo('PAMG2401.dbc')
+    parcial(diretorio_dados, original[:400],
+            tamanho=1000, modificado=info['modificado'].isoformat())
+
+    caminho = downloader.download_arquivo('PA', 'MG', 2024, 1)
+
+    assert open(caminho, 'rb').read() == original
+    assert 'REST' in servidor.comandos
+    assert not (diretorio_dados / 'PAMG2401.dbc.part.json').exists()
+
+
+@pytest.mark.parametrize('origem', [
+    {'tamanho': 1000, 'modificado': '2001-01-01T00:00:00'},   # arquivo trocado no servidor
+    {},                                                      # .part sem registro da origem
+])
+def test_download_recomeca_parcial_de_outro_arquivo(downloader, servidor, diretorio_dados, origem):
+    original = (servidor.raiz / 'Dados' / 'PAMG2401.dbc').read_bytes()
+    parcial(diretorio_dados, b'?' * 400, **origem)
+
+    caminho = downloader.download_arquivo('PA', 'MG', 2024, 1)
+
+    assert open(caminho, 'rb').read() == original
+    assert 'REST' not in servidor.comandos
+
+
+def test_cli_sync_usa_grupos_engine_e_host(tmp_path):
+    raiz = tmp_path / 'ftp'
+    pasta = raiz / 'dissemin' / 'publicos' / 'SIASUS' / '200801_' / 'Dados'
+    pasta.mkdir(parents=True)
+    for nome in ('AMMG2401.dbc', 'PAMG2401.dbc', 'PAMG2301.dbc'):
+        shutil.copy(AMOSTRA_DBC, pasta / nome)
+    servidor = ServidorFTP(raiz)
+    dados = tmp_path / 'dados_cli'
+    try:
+        saida = subprocess.run(
+            [sys.executable, str(RAIZ / 'SIA_Conv_CNS.py'), '--dados', str(dados), '--sync', 'MG',
+             '--anos', '2024', '--grupos', 'AM', 'PA', '--engine', 'native',
+             '--ftp-host', '127.0.0.1', '--ftp-porta', str(servidor.porta)],
+            capture_output=True, text=True, timeout=300)
+    finally:
+        servidor.fechar()
+
+    assert saida.returncode == 0, saida.stdout + saida.stderr
+    particoes = sorted(p.relative_to(dados / 'SIA_dataset').parent.as_posix()
+                       for p in (dados / 'SIA_dataset').rglob('*.parquet'))
+    assert particoes == ['grupo=AM/uf=MG/ano=2024/mes=01', 'grupo=PA/uf=MG/ano=2024/mes=01']
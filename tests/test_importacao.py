@@ -0,0 +1,18 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+RAIZ = Path(__file__).resolve().parents[1]
+
+
+def test_importar_nao_carrega_dependencias_pesadas(tmp_path):
+    dados = tmp_path / 'dados'
+    codigo = ("import json, sys; import SIA_Conv_CNS; "
+              "print(json.dumps([m for m in ('pandas', 'numpy', 'tkinter', 'pyarrow') if m in sys.modules]))")
+    saida = subprocess.run([sys.executable, '-c', codigo], cwd=RAIZ, capture_output=True, text=True,
+                           env={**os.environ, 'SIA_DADOS': str(dados)}, check=True)
+
+    assert json.loads(saida.stdout.strip().splitlines()[-1]) == []
+    assert not dados.exists()
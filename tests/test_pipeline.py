@@ -0,0 +1,71 @@
+import itertools
+import threading
+import time
+
+from SIA_Conv_CNS import PipelineEstagios
+
+
+def threads_do_pipeline(antes):
+    return [t for t in threading.enumerate() if t not in antes and t.name.startswith('pipeline-')]
+
+
+def esperar_threads(antes, timeout=5):
+    limite = time.monotonic() + timeout
+    while threads_do_pipeline(antes) and time.monotonic() < limite:
+        time.sleep(0.05)
+    return threads_do_pipeline(antes)
+
+
+def dobrar(item, valor):
+    time.sleep(0.001 * (item % 3))
+    return None if item % 7 == 0 else valor * 2     # múltiplos de 7 saem como None
+
+
+def somar(item, valor):
+    if item % 5 == 0:
+        raise ValueError(f"falha no item {item}")   # múltiplos de 5 levantam exceção
+    return valor + 1
+
+
+def multiplicar(item, valor):
+    time.sleep(0.001 * (item % 2))
+    return valor * 10
+
+
+def test_cada_item_sai_uma_vez_e_falhas_saem_como_none():
+    antes = set(threading.enumerate())
+    pipeline = PipelineEstagios([('dobrar', dobrar, 3), ('somar', somar, 2), ('multiplicar', multiplicar, 4)])
+
+    resultados = list(pipeline.executar(range(60)))
+
+    assert sorted(item for item, _ in resultados) == list(range(60))
+    for item, valor in resultados:
+        if item % 7 == 0 or item % 5 == 0:
+            assert valor is None
+        else:
+            assert valor == (item * 2 + 1) * 10
+
+    stats = {s['estagio']: s for s in pipeline.estatisticas()}
+    assert (stats['dobrar']['itens'], stats['dobrar']['falhas']) == (60, 9)
+    assert (stats['somar']['itens'], stats['somar']['falhas']) == (51, 10)
+    assert (stats['multiplicar']['itens'], stats['multiplicar']['falhas']) == (41, 0)
+    assert esperar_threads(antes) == []
+
+
+def test_consumidor_que_para_cedo_encerra_as_threads():
+    antes = set(threading.enumerate())
+    itens = itertools.count()
+    pipeline = PipelineEstagios([('dobrar', dobrar, 3), ('somar', somar, 2), ('multiplicar', multiplicar, 4)],
+                                capacidade=2)
+
+    recebidos = []
+    for item, valor in pipeline.executar(itens):
+        recebidos.append(item)
+        if len(recebidos) == 5:
+            break
+
+    assert len(set(recebidos)) == 5
+    assert esperar_threads(antes) == []
+    # Backpressure: além dos 5 consumidos, só o que cabe nas 4 filas, nos 9
+    # workers e o item que o alimentador segura foi gerado
+    assert next(itens) <= 5 + 4 * 2 + 9 + 1